@@ -50,5 +50,5 @@ setup(
         "Programming Language :: Python :: 3.7",
         "Topic :: Scientific/Engineering :: Bio-Informatics",
     ],
-    package_data={"styping": ["utils/*", ]}
+    package_data={"styping": ["utils/*", "validation/*.csv"]}
 )
@@ -1,4 +1,4 @@
-import logging
+import logging, logging.handlers, queue, multiprocessing, contextlib
 
 class CustomFormatter(logging.Formatter):
     """Logging Formatter to add colors and count warning / errors"""
@@ -18,7 +18,78 @@ class CustomFormatter(logging.Formatter):
         logging.CRITICAL: bold_red + format + reset
     }
 
+    def __init__(self, datefmt='%m/%d/%Y %I:%M:%S %p'):
+        super().__init__(datefmt=datefmt)
+        # build the formatter for each level once, rather than for every record
+        self.formatters = {level: logging.Formatter(fmt, datefmt=datefmt) for level, fmt in self.FORMATS.items()}
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt,datefmt='%m/%d/%Y %I:%M:%S %p')
-        return formatter.format(record)
\ No newline at end of file
+        formatter = self.formatters.get(record.levelno, self.formatters[logging.INFO])
+        return formatter.format(record)
+
+
+# the logger all styping modules log to, and the listener writing its records
+PACKAGE_LOGGER = logging.getLogger('styping')
+_LISTENER = None
+
+def setup_logging(logfile, debug = False):
+    """
+    Send styping log records through a queue to a background thread that writes them to
+    the terminal and to logfile, so that logging never blocks the pipeline.
+    Debug records (e.g. per-sample messages) are only emitted if debug is True.
+    """
+    global _LISTENER
+    stop_logging()
+    ch = logging.StreamHandler()
+    ch.setFormatter(CustomFormatter())
+    fh = logging.FileHandler(logfile)
+    fh.setFormatter(logging.Formatter('[%(levelname)s:%(asctime)s] %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p'))
+    log_queue = queue.SimpleQueue()
+    _LISTENER = logging.handlers.QueueListener(log_queue, ch, fh)
+    for handler in list(PACKAGE_LOGGER.handlers):
+        PACKAGE_LOGGER.removeHandler(handler)
+    PACKAGE_LOGGER.addHandler(logging.handlers.QueueHandler(log_queue))
+    PACKAGE_LOGGER.setLevel(logging.DEBUG if debug else logging.INFO)
+    _LISTENER.start()
+    return _LISTENER
+
+def stop_logging():
+    """
+    Write any queued records and stop the background thread
+    """
+    global _LISTENER
+    if _LISTENER is not None:
+        _LISTENER.stop()
+        for handler in _LISTENER.handlers:
+            handler.close()
+        _LISTENER = None
+
+@contextlib.contextmanager
+def worker_queue():
+    """
+    A queue for worker processes to send their log records to, written by the handlers
+    of the run for as long as the context is open. None if logging is not set up.
+    """
+    if _LISTENER is None:
+        yield None
+        return
+    log_queue = multiprocessing.Queue()
+    listener = logging.handlers.QueueListener(log_queue, *_LISTENER.handlers)
+    listener.start()
+    try:
+        yield log_queue
+    finally:
+        listener.stop()
+        log_queue.close()
+
+def setup_worker_logging(log_queue, debug = False):
+    """
+    Send the records of a worker process to log_queue, replacing the handlers inherited
+    from the main process. Workers repeat progress messages for every chunk of work, so
+    only warnings and errors are sent unless debug is True.
+    """
+    for handler in list(PACKAGE_LOGGER.handlers):
+        PACKAGE_LOGGER.removeHandler(handler)
+    if log_queue is not None:
+        PACKAGE_LOGGER.addHandler(logging.handlers.QueueHandler(log_queue))
+    PACKAGE_LOGGER.setLevel(logging.DEBUG if debug else logging.WARNING)
@@ -1,22 +1,19 @@
 #!/usr/bin/env python3
-import inspect, pathlib, pandas, re, logging, subprocess
+import inspect, pathlib, pandas, re, logging, subprocess, importlib.util, collections, os, threading, shlex
 import numpy as np
-from styping.CustomLog import CustomFormatter
+from concurrent.futures import ProcessPoolExecutor
 import styping.utils.rules as rules
 import styping.utils.filters as filters
+import styping.utils.cgmlst as cgmlst
+from styping.Typing import read_stream
+from styping.utils.files import atomic_write, atomic_path, locked
+from styping.utils.profile import stage
+from styping.utils.metrics import METRICS
+from styping.CustomLog import worker_queue, setup_worker_logging
 
 
-LOGGER =logging.getLogger(__name__) 
-LOGGER.setLevel(logging.DEBUG)
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-ch.setFormatter(CustomFormatter())
-fh = logging.FileHandler('styper.log')
-fh.setLevel(logging.DEBUG)
-formatter = logging.Formatter('[%(levelname)s:%(asctime)s] %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p') 
-fh.setFormatter(formatter)
-LOGGER.addHandler(ch) 
-LOGGER.addHandler(fh)
+# handlers are set up per run by styping.CustomLog.setup_logging
+LOGGER = logging.getLogger(__name__)
 
 
 class ParseSistr:
@@ -29,8 +26,16 @@ class ParseSistr:
         self.prefix = args.prefix
         self.run_type = args.run_type
         self.input = args.input
+        self.samples = args.samples
+        self.stream = args.stream
+        self.outdir = args.outdir
+        self.merge = args.merge
+        self._load_rules()
 
-
+    def _load_rules(self, rules = rules, filters = filters):
+        """
+        collect the rules, criteria and filters to apply to sistr results
+        """
         self.rule_list = [
             (name, function)
             for name, function in inspect.getmembers(rules, inspect.isfunction)
@@ -62,8 +67,11 @@ class ParseSistr:
         for filt, func in self.filter_list:
             tab[filt] = func(tab) #for each filter add a column which corresponds to filter to the df
             filt_list.append(filt)
-        tab['FILTERS'] = tab[filt_list].apply(lambda x: sum(~x.isnull()), axis=1)
-        tab['serovar'] = tab.apply(lambda x: x.serovar if x[filt_list].isnull().all() else x[filt_list].dropna()[0], axis=1)
+        hits = tab[filt_list].notnull()
+        tab['FILTERS'] = hits.sum(axis=1)
+        # serovar from the first filter that applies, if any
+        first_hit = tab[filt_list].bfill(axis=1).iloc[:, 0]
+        tab['serovar'] = first_hit.where(hits.any(axis=1), tab['serovar'])
     
         return tab
 
@@ -88,9 +96,9 @@ class ParseSistr:
 
     def _run_concat(self, sistrs):
 
-        cmd = f"csvtk concat {' '.join(sistrs)} > sistr_concatenated.csv"
+        cmd = f"csvtk concat {' '.join(shlex.quote(f'{sistr}') for sistr in sistrs)} > .sistr_concatenated.csv.tmp && mv .sistr_concatenated.csv.tmp sistr_concatenated.csv"
         LOGGER.info(f"Concatenating results : {cmd}")
-        p = subprocess.run(cmd, shell = True, capture_output = True , encoding = "utf-8")
+        p = subprocess.run(cmd, shell = True, capture_output = True , encoding = "utf-8", cwd = self.outdir or None)
         if p.returncode == 0:
             return True
         else:
@@ -98,84 +106,526 @@ class ParseSistr:
 
     def _concat_sistr(self):
 
-        sistrs = []
-        LOGGER.info(f"Opening {self.input} to concatenate results")
-        with open(self.input , 'r') as f:
-            data = f.read().strip().split('\n')
-            for d in data:
-                cmd = d.split('\t')[0]
-                sistrs.append(f"{cmd}/sistr.csv")
+        LOGGER.info(f"Collecting results of {len(self.samples)} samples from {self.input} to concatenate")
+        sistrs = [f"{seqid}/sistr.csv" for seqid, contigs in self.samples]
         if self._run_concat(sistrs):
             LOGGER.info(f"Concatenating sistr output to a single file.")
-            return "sistr_concatenated.csv"
+            return pathlib.Path(self.outdir, "sistr_concatenated.csv")
         else:
             LOGGER.critical(f"There seems that something has gone wrong with concatenating your sistr outputs. Please try again.")
             raise SystemExit
 
     def _get_input_file(self):
 
-        input_file = f"{self.prefix}/sistr.csv" if self.run_type == 'assembly' else self._concat_sistr()
+        if self.run_type == 'assembly':
+            input_file = pathlib.Path(self.outdir, self.prefix, 'sistr.csv')
+        elif self.stream:
+            # results of all samples are already in one place
+            input_file = self.stream
+        else:
+            input_file = self._concat_sistr()
 
         return input_file
 
     def _filter_sistr(self, input_file):
         # get tab
         LOGGER.info(f"Opening {input_file}")
-        tab = pandas.read_csv(input_file)
+        with stage('read'):
+            tab = read_stream(input_file) if input_file == self.stream else pandas.read_csv(input_file)
+        return self.type_table(tab)
+
+    def type_table(self, tab):
+        """
+        apply rules, filters and call the status of each sample in a table of sistr results
+        """
         LOGGER.info(f"Applying rules")
         # apply rules
-        tab = self.apply_rules(tab = tab)
+        with stage('rules'):
+            tab = self.apply_rules(tab = tab)
         # apply filters
         LOGGER.info(f"Applying filters")
-        tab = self.filter_rules(tab = tab)
+        with stage('filters'):
+            tab = self.filter_rules(tab = tab)
         # call status
         LOGGER.info(f"Calling status of each sample.")
-        tab = self.call_status(tab)
+        with stage('status'):
+            tab = self.call_status(tab)
         return tab
 
 
+    def merge_results(self, tab, merge):
+        """
+        merge typed results with those of an earlier run (e.g. the run whose failed samples
+        were typed again), results of this run replacing earlier results of the same sample
+        """
+        earlier = pandas.read_csv(merge, dtype = {'genome': str})
+        retyped = set(tab['genome'].astype(str))
+        kept = earlier[~earlier['genome'].isin(retyped)]
+        LOGGER.info(f"Merging the results of {len(tab)} samples with those of {len(kept)} samples from {merge}")
+        return pandas.concat([kept, tab.astype({'genome': str})], ignore_index = True)
+
+    def _outfile(self):
+        return pathlib.Path(self.outdir, 'sistr_filtered.csv') if self.run_type == 'batch' else pathlib.Path(self.outdir, self.prefix, 'sistr_filtered.csv')
+
+    def artifacts(self):
+        """
+        files read and written by parse (name -> path or list of paths), for the journal of the run
+        """
+        if self.run_type == 'assembly':
+            results = pathlib.Path(self.outdir, self.prefix, 'sistr.csv')
+        elif self.stream:
+            results = self.stream
+        else:
+            results = [pathlib.Path(self.outdir, f"{seqid}", 'sistr.csv') for seqid, contigs in self.samples]
+        inputs = {'results': results, 'rules': rules.__file__, 'filters': filters.__file__}
+        if self.merge:
+            inputs['merge'] = self.merge
+        return inputs, {'filtered': self._outfile()}
+
+    def read_filtered(self):
+        """
+        the typed results saved by an earlier parse of this run
+        """
+        return pandas.read_csv(self._outfile())
+
     def parse(self):
-        input_file = self._get_input_file()
+        with stage('collect'):
+            input_file = self._get_input_file()
         tab = self._filter_sistr(input_file = input_file)
-        outfile = 'sistr_filtered.csv' if self.run_type == 'batch' else f"{self.prefix}/sistr_filtered.csv"
+        METRICS.count_status(tab['STATUS'])
+        if self.merge:
+            with stage('merge'):
+                tab = self.merge_results(tab, self.merge)
+        outfile = self._outfile()
         # save table to output
         LOGGER.info(f"Saving filtered results as {outfile}")
-        tab.to_csv(f'{outfile}', index = False)
+        with stage('write'), atomic_write(outfile) as f:
+            tab.to_csv(f, index = False)
+        return tab
+
+class UrgentSistr(ParseSistr):
+    """
+    A class to collate the results of the urgent samples of a batch as soon as they have
+    finished, while the rest of the batch is still being typed
+    """
+    def __init__(self, args):
+
+        self.stream = args.stream
+        self.outdir = args.outdir
+        self.outfile = pathlib.Path(args.outdir, 'sistr_urgent.csv')
+        self._load_rules()
+
+    def record(self, samples):
+        """
+        apply the rules and filters to the sistr results of samples and save them
+        """
+        if self.stream:
+            tab = read_stream(self.stream)
+            tab = tab[tab['genome'].astype(str).isin({f"{seqid}" for seqid, contigs in samples})]
+        else:
+            tab = pandas.concat([pandas.read_csv(pathlib.Path(self.outdir, f"{seqid}", 'sistr.csv')) for seqid, contigs in samples], ignore_index = True)
+        tab = self.type_table(tab)
+        with atomic_write(self.outfile) as f:
+            tab.to_csv(f, index = False)
+        LOGGER.info(f"Results of {len(samples)} urgent samples saved as {self.outfile}, the rest of the batch is still being typed.")
+        return tab
+
+class WatchSistr(ParseSistr):
+    """
+    A class to type samples one at a time as their sistr results are ready and append
+    them to a rolling output, which can be read while stype watch is running
+    """
+    def __init__(self, args):
+
+        self.outfile = args.outfile
+        self.lock = threading.Lock()
+        self._load_rules()
+
+    def typed(self):
+        """
+        IDs of the samples already in the rolling output, so a restarted watch does not type them again
+        """
+        if not pathlib.Path(self.outfile).exists() or os.path.getsize(self.outfile) == 0:
+            return []
+        return pandas.read_csv(self.outfile, usecols = ['genome'])['genome'].astype(str).tolist()
+
+    def record(self, seqid):
+        """
+        apply the rules and filters to the sistr results of a sample and append them to the rolling output
+        """
+        tab = self.type_table(pandas.read_csv(f"{seqid}/sistr.csv"))
+        # the thread lock orders jobs of this watch, the file lock any other watch appending to the same output
+        with self.lock, locked(self.outfile):
+            exists = pathlib.Path(self.outfile).exists() and os.path.getsize(self.outfile) > 0
+            if exists:
+                # keep the columns in the order of the header already written
+                tab = tab.reindex(columns = pandas.read_csv(self.outfile, nrows = 0).columns)
+            # each sample is written with a single call, so readers never see part of a row
+            with open(self.outfile, 'a') as f:
+                f.write(tab.to_csv(header = not exists, index = False))
+        METRICS.count_status(tab['STATUS'])
+        return ', '.join(tab['STATUS'].astype(str))
+
+# columns of the MMS136 and REVIEW sheets of the MDU spreadsheet
+MDU_COLUMNS = ["ID","ITEMCODE","SEQID","cgmlst_subspecies","cgmlst_matching_alleles","serovar_cgmlst","o_antigen","h1","h2","serogroup","serovar_antigen","serovar-original","serovar","STATUS"]
+
+def _write_workbook(outfile, sheets):
+    """
+    write the sheets (name, table) of an MDU spreadsheet to outfile, run in worker processes by stype mdu --runs
+    """
+    tmp = atomic_path(outfile)
+    writer = pandas.ExcelWriter(tmp, engine = 'xlsxwriter')
+    for name, sheet in sheets:
+        sheet.to_excel(writer, sheet_name = name, index = False)
+    writer.close()
+    os.replace(tmp, outfile)
+    return f"{outfile}"
 
 class MduifySistr:
 
     def __init__(self, args):
         self.runid = args.runid
         self.input = args.input
-        self.MDUIDREG = re.compile(r'(?P<id>[0-9]{4}-[0-9]{5,6})-?(?P<itemcode>.{1,2})?')
+        self.outdir = args.outdir
+        self.MDUIDREG = re.compile(r'^(?P<id>[0-9]{4}-[0-9]{5,6})-?(?P<itemcode>.{1,2})?')
+
+    def _annotate(self, tab):
+        """
+        split the SEQID of every sample into MDU ID and item code, and find the sheet it is reported
+        on (MMS136 if PASS, REVIEW unless FAIL), in one pass over the whole table
+        """
+        tab = tab.rename(columns = {'genome': 'SEQID'})
+        ids = tab['SEQID'].astype(str).str.extract(self.MDUIDREG)
+        unparsed = ids['id'].isna()
+        if unparsed.any():
+            LOGGER.warning(f"{unparsed.sum()} SEQID(s) are not MDU IDs (e.g. {tab['SEQID'][unparsed].iloc[0]}), their ID will be empty.")
+        tab['ID'] = ids['id'].fillna('')
+        tab['ITEMCODE'] = ids['itemcode'].fillna('')
+        sheet = pandas.Series(np.select([tab['STATUS'] == 'PASS', tab['STATUS'] == 'FAIL'], ['MMS136', ''], 'REVIEW'), index = tab.index)
+        return tab, sheet
+
+    def _sheets(self, tab, sheet):
+        return [("MMS136", tab[sheet == 'MMS136'][MDU_COLUMNS]), ("REVIEW", tab[sheet == 'REVIEW'][MDU_COLUMNS]), ("ALL", tab)]
+
+    def outfile(self, prefix):
+        return pathlib.Path(self.outdir, f'{prefix}_sistr.xlsx')
 
     def make_spreadsheet(self, tab, prefix):
-        # mdu specific functions... sub class?
-        def assign_itemcode(mduid):
-            m = self.MDUIDREG.match(mduid)
-            itemcode = m.group('itemcode') if m.group('itemcode') else ''
-            return itemcode
-
-        def assign_mduid(mduid):
-            m = self.MDUIDREG.match(mduid)
-            mduid = m.group('id')
-            return mduid
         LOGGER.info('Generating spreadsheet')
-        tab = tab.rename(columns = {'genome': 'SEQID'})
-        tab['ID'] = tab['SEQID'].apply(lambda x:assign_mduid(x))
-        tab['ITEMCODE'] = tab['SEQID'].apply(lambda x:assign_itemcode(x))
-        cols = ["ID","ITEMCODE","SEQID","cgmlst_subspecies","cgmlst_matching_alleles","serovar_cgmlst","o_antigen","h1","h2","serogroup","serovar_antigen","serovar-original","serovar","STATUS"]
-        mms136 = tab[tab['STATUS'] == 'PASS'][cols]
-        review = tab[~tab['STATUS'].isin(['PASS', 'FAIL'])][cols]
+        tab, sheet = self._annotate(tab)
         LOGGER.info(f"Saving spreadsheet")
-        writer = pandas.ExcelWriter(f'{prefix}_sistr.xlsx')
-        mms136.to_excel(writer, sheet_name = "MMS136", index = False)
-        review.to_excel(writer, sheet_name = "REVIEW", index = False)
-        tab.to_excel(writer, sheet_name = "ALL", index = False)
-        writer.close()
+        outfile = self.outfile(prefix)
+        with stage('sheet'):
+            _write_workbook(outfile, self._sheets(tab, sheet))
 
     # function to run
+    def mduify(self, tab = None):
+        """
+        make the spreadsheet from the typed results in input, or from tab if given
+        (as by stype run --mdu, so the table is not written and read back)
+        """
+        if tab is None:
+            LOGGER.info(f"Opening concatenated file.")
+            with stage('read'):
+                tab = pandas.read_csv(self.input)
+        self.make_spreadsheet(tab, self.runid)
+
+class MduifyRuns(MduifySistr):
+    """
+    A class to make the MDU spreadsheets of many runs at once. The results of all runs are read
+    into one table, so the IDs are parsed and the samples sorted into sheets once, and the
+    workbooks are written in parallel worker processes
+    """
+    def __init__(self, args):
+        super().__init__(args)
+        self.runs = args.runs
+        self.jobs = args.jobs
+
+    def _read(self):
+        """
+        the results of every run in one table, with the run ID of each sample in runid
+        """
+        tables = []
+        for runid, path in self.runs:
+            tab = pandas.read_csv(path, dtype = {'runid': str})
+            if runid is not None:
+                tab['runid'] = runid
+            tables.append(tab)
+        tab = pandas.concat(tables, ignore_index = True)
+        if tab['runid'].isna().any():
+            LOGGER.critical(f"{tab['runid'].isna().sum()} sample(s) have no run ID. Please check your input and try again.")
+            raise SystemExit
+        return tab
+
     def mduify(self):
-        LOGGER.info(f"Opening concatenated file.")
-        tab = pandas.read_csv(self.input)
-        self.make_spreadsheet(tab, self.runid)
\ No newline at end of file
+        with stage('read'):
+            tab = self._read()
+        with stage('annotate'):
+            tab, sheet = self._annotate(tab)
+        runs = tab.groupby('runid', sort = False).indices
+        tab = tab.drop(columns = 'runid')
+        jobs = max(1, min(self.jobs, len(runs)))
+        LOGGER.info(f"Generating spreadsheets for {len(runs)} run(s) with {jobs} worker(s)")
+        failed = []
+        with stage('sheet'), ProcessPoolExecutor(max_workers = jobs) as pool:
+            pending = collections.deque()
+            for runid, rows in runs.items():
+                outfile = self.outfile(runid)
+                pending.append((runid, pool.submit(_write_workbook, outfile, self._sheets(tab.iloc[rows], sheet.iloc[rows]))))
+                # keep a bounded number of runs in memory
+                while len(pending) >= 2 * jobs:
+                    self._collect(*pending.popleft(), failed)
+            while pending:
+                self._collect(*pending.popleft(), failed)
+        if failed:
+            LOGGER.critical(f"The spreadsheets of run(s) {', '.join(failed)} could not be made. Please check the log and try again.")
+            raise SystemExit
+        return list(runs)
+
+    def _collect(self, runid, future, failed):
+        try:
+            LOGGER.info(f"Saved spreadsheet {future.result()}")
+        except Exception as e:
+            LOGGER.error(f"Could not make the spreadsheet of {runid}: {e}")
+            failed.append(runid)
+
+class VerifySistr(ParseSistr):
+    """
+    A class to re-apply the current rules and filters to cached sistr results for the
+    reverification panel and report concordance with the expected serovars
+    """
+    def __init__(self, args):
+        self.cache = args.cache
+        self.panel = args.panel
+        self.outfile = args.outfile
+        self._load_rules()
+
+    def _matches(self, called, expected):
+        """
+        True if the expected serovar is one of the serovars called (sistr separates multiple calls with |)
+        """
+        if pandas.isnull(expected) or pandas.isnull(called):
+            return False
+        return expected in called.split('|') or expected == called
+
+    def _concordance(self, row):
+        """
+        decide if the typing of a panel sample is concordant with the expected result
+        """
+        if pandas.isnull(row['STATUS']):
+            return False, 'no sistr result in cache'
+        if pandas.isnull(row['Genoserotype']):
+            if row['STATUS'] == 'PASS':
+                return False, 'expected no serovar but sample passed'
+            return True, ''
+        if row['EdgeCases'] == 'Edge case':
+            if row['STATUS'] == 'PASS' and not self._matches(row['serovar'], row['phenoserotype']):
+                return False, f"edge case passed as {row['serovar']}, phenotypic serovar is {row['phenoserotype']}"
+            return True, ''
+        if not self._matches(row['serovar'], row['Genoserotype']):
+            return False, f"serovar {row['serovar']} does not match expected {row['Genoserotype']}"
+        if row['STATUS'] != 'PASS':
+            return False, f"status {row['STATUS']} for expected {row['Genoserotype']}"
+        return True, ''
+
+    def compare(self, tab, panel):
+        """
+        join typed sistr results to the panel and flag discordant samples
+        """
+        cols = ['genome', 'serovar-original', 'serovar', 'STATUS']
+        report = panel.merge(tab[cols], how = 'left', left_on = 'DummyID', right_on = 'genome').drop('genome', axis = 1)
+        outcome = report.apply(self._concordance, axis = 1, result_type = 'expand')
+        report['CONCORDANT'] = outcome[0].astype(bool)
+        report['REASON'] = outcome[1]
+        return report
+
+    def verify(self):
+        LOGGER.info(f"Opening cached sistr results {self.cache}")
+        tab = self.type_table(pandas.read_csv(self.cache))
+        panel = pandas.read_csv(self.panel, dtype = str)
+        report = self.compare(tab, panel)
+        cached = report['STATUS'].notnull().sum()
+        METRICS.lookup('verify', hits = cached, misses = len(report) - cached)
+        LOGGER.info(f"Saving verification report as {self.outfile}")
+        with atomic_write(self.outfile) as f:
+            report.to_csv(f, index = False)
+        discordant = report[~report['CONCORDANT']]
+        LOGGER.info(f"{len(report) - len(discordant)} of {len(report)} panel samples are concordant ({100 * (len(report) - len(discordant)) / len(report):.1f}%).")
+        for row in discordant.itertuples():
+            LOGGER.warning(f"Discordant : {row.DummyID} - {row.REASON}")
+        if len(discordant) > 0:
+            LOGGER.critical(f"{len(discordant)} panel samples are discordant with the current rules and filters.")
+            raise SystemExit(1)
+        return report
+
+
+# columns of sistr output used by the rules and filters
+SISTR_COLUMNS = ['genome', 'cgmlst_genome_match', 'cgmlst_matching_alleles', 'cgmlst_subspecies', 'h1', 'h2', 'o_antigen', 'serogroup', 'serovar', 'serovar_antigen', 'serovar_cgmlst']
+
+def load_module(path, name):
+    """
+    import a rules or filters module from a file, e.g. an older version of rules.py
+    """
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# old and new rule sets of a replay worker process
+_REPLAY = {}
+
+def _replay_init(log_queue, debug, old_rules, old_filters, new_rules, new_filters):
+    """
+    log to the run's queue and load both rule sets once in each worker process
+    """
+    setup_worker_logging(log_queue, debug)
+    for key, (rules_path, filters_path) in {'old': (old_rules, old_filters), 'new': (new_rules, new_filters)}.items():
+        typer = ParseSistr.__new__(ParseSistr)
+        typer._load_rules(
+            rules = load_module(rules_path, f"{key}_rules") if rules_path else rules,
+            filters = load_module(filters_path, f"{key}_filters") if filters_path else filters
+        )
+        _REPLAY[key] = typer
+
+def _replay_chunk(tab):
+    """
+    type a chunk of sistr results with both rule sets, return the rows whose call changed and counts of each transition
+    """
+    old = _REPLAY['old'].type_table(tab.copy())
+    new = _REPLAY['new'].type_table(tab.copy())
+    changed = (old['STATUS'] != new['STATUS']) | (old['serovar'].fillna('') != new['serovar'].fillna(''))
+    diff = pandas.DataFrame({
+        'genome': tab['genome'],
+        'serovar-original': tab['serovar'],
+        'STATUS_OLD': old['STATUS'],
+        'STATUS_NEW': new['STATUS'],
+        'serovar_OLD': old['serovar'],
+        'serovar_NEW': new['serovar']
+    })
+    counts = collections.Counter(zip(old['STATUS'], new['STATUS']))
+    return diff[changed], counts, len(tab)
+
+class ReplaySistr:
+    """
+    A class to stream stored sistr results through an old and a new set of rules and filters
+    and report the samples whose STATUS or serovar would change
+    """
+    def __init__(self, args):
+        self.sistr = args.sistr
+        self.old_rules = args.old_rules
+        self.old_filters = args.old_filters
+        self.new_rules = args.new_rules
+        self.new_filters = args.new_filters
+        self.jobs = args.jobs
+        self.chunksize = args.chunksize
+        self.outfile = args.outfile
+        self.summary = args.summary
+
+    def _read_chunks(self, path):
+        """
+        read stored sistr results lazily in chunks, keeping only the raw sistr columns the rules need
+        """
+        for chunk in pandas.read_csv(path, chunksize = self.chunksize, usecols = lambda c: c in SISTR_COLUMNS + ['serovar-original']):
+            if 'serovar-original' in chunk.columns:
+                # filtered output - the serovar column has already been changed by filters
+                chunk['serovar'] = chunk.pop('serovar-original')
+            yield chunk
+
+    def _chunks(self):
+        for path in self.sistr:
+            LOGGER.info(f"Replaying {path}")
+            yield from self._read_chunks(path)
+
+    def replay(self):
+        rulesets = (self.old_rules, self.old_filters, self.new_rules, self.new_filters)
+        counts = collections.Counter()
+        total = 0
+        changed = 0
+        # changed rows are collected under a temporary name and renamed once the replay is complete
+        self._partial = atomic_path(self.outfile)
+        self._partial.unlink(missing_ok = True)
+        with worker_queue() as log_queue, ProcessPoolExecutor(max_workers = self.jobs, initializer = _replay_init, initargs = (log_queue, LOGGER.isEnabledFor(logging.DEBUG)) + rulesets) as pool:
+            pending = collections.deque()
+            chunks = self._chunks()
+            for chunk in chunks:
+                pending.append(pool.submit(_replay_chunk, chunk))
+                # keep a bounded number of chunks in memory
+                while len(pending) >= 2 * self.jobs:
+                    total, changed = self._collect(pending.popleft(), counts, total, changed)
+            while pending:
+                total, changed = self._collect(pending.popleft(), counts, total, changed)
+        if not self._partial.exists():
+            pandas.DataFrame(columns = ['genome', 'serovar-original', 'STATUS_OLD', 'STATUS_NEW', 'serovar_OLD', 'serovar_NEW']).to_csv(self._partial, index = False)
+        os.replace(self._partial, self.outfile)
+        summary = pandas.DataFrame([(old, new, n) for (old, new), n in sorted(counts.items())], columns = ['STATUS_OLD', 'STATUS_NEW', 'samples'])
+        with atomic_write(self.summary) as f:
+            summary.to_csv(f, index = False)
+        LOGGER.info(f"{changed} of {total} samples would change STATUS or serovar. Changed rows saved as {self.outfile}, summary saved as {self.summary}.")
+        return summary
+
+    def _collect(self, future, counts, total, changed):
+        diff, chunk_counts, n = future.result()
+        counts.update(chunk_counts)
+        if not diff.empty:
+            write_header = not self._partial.exists()
+            diff.to_csv(self._partial, mode = 'a', header = write_header, index = False)
+        return total + n, changed + len(diff)
+
+class QueryCgmlst:
+    """
+    A class to find the nearest neighbours of samples among the cgMLST profiles of the store,
+    by the number of loci at which their alleles differ
+    """
+    def __init__(self, args):
+        self.store = args.store
+        self.queries = args.queries
+        self.samples = args.samples
+        self.k = args.k
+        self.max_distance = args.max_distance
+        self.pairwise = args.pairwise
+        self.jobs = args.jobs
+        self.outfile = args.outfile
+
+    def _query_profiles(self, store, profiles, positions):
+        """
+        IDs and encoded profiles of the samples to query
+        """
+        if self.queries is not None:
+            missing = set(self.queries.columns) ^ set(store.loci)
+            if missing:
+                LOGGER.warning(f"{len(missing)} loci are only in the query profiles or only in the store, they are not compared.")
+            return list(self.queries.index), cgmlst.encode(self.queries, store.loci)
+        return list(self.samples), np.asarray(profiles[[positions[seqid] for seqid in self.samples]])
+
+    def query(self):
+        store = cgmlst.ProfileStore(self.store)
+        latest = store.latest()
+        # the memmap is only copied if samples typed again have to be left out
+        profiles = store.matrix() if len(latest) == len(store.samples) else store.matrix()[latest]
+        stored = store.samples.iloc[latest].reset_index(drop = True)
+        positions = {seqid: i for i, seqid in enumerate(stored['ID'])}
+        ids, queries = self._query_profiles(store, profiles, positions)
+        LOGGER.info(f"Finding the {self.k} nearest neighbours of {len(ids)} samples among {len(stored)} profiles in {self.store} with {self.jobs} thread(s).")
+        with stage('neighbours'):
+            rows, distances, shared = cgmlst.nearest(queries, profiles, k = self.k, jobs = self.jobs, exclude = [positions.get(seqid, -1) for seqid in ids])
+        found = (rows >= 0) & (distances <= (self.max_distance if self.max_distance is not None else np.iinfo(np.int32).max - 1))
+        query, rank = np.nonzero(found)
+        neighbours = stored.iloc[rows[found]]
+        tab = pandas.DataFrame({
+            'ID': np.array(ids, dtype = object)[query],
+            'RANK': rank + 1,
+            'NEIGHBOUR': neighbours['ID'].to_numpy(),
+            'DISTANCE': distances[found],
+            'SHARED_LOCI': shared[found],
+            'NEIGHBOUR_RUN': neighbours['run'].to_numpy()
+        })
+        with atomic_write(self.outfile) as f:
+            tab.to_csv(f, index = False)
+        LOGGER.info(f"Nearest neighbours saved as {self.outfile}")
+        if self.pairwise:
+            with stage('pairwise'):
+                matrix = pandas.DataFrame(cgmlst.hamming(queries, queries, jobs = self.jobs), index = ids, columns = ids)
+            with atomic_write(self.pairwise) as f:
+                matrix.to_csv(f, index_label = 'ID')
+            LOGGER.info(f"Pairwise distances between the {len(ids)} samples queried saved as {self.pairwise}")
+        return tab
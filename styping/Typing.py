@@ -1,19 +1,43 @@
-import pathlib, pandas, datetime, subprocess, os, logging,subprocess,collections
+import pathlib, pandas, datetime, subprocess, os, logging,subprocess,collections, glob, time, io, threading, csv, math, itertools, contextlib, shlex
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from styping.version import sistr_version
-from styping.CustomLog import CustomFormatter
+import styping.utils.resources as resources
+import styping.utils.fasta as fasta
+import styping.utils.prescreen as prescreen
+import styping.utils.manifest as manifest
+import styping.utils.timings as timings
+import styping.utils.journal as journal
+import styping.utils.cgmlst as cgmlst
+from styping.utils.manifest import sample_id
+from styping.utils.files import atomic_write, atomic_path, locked
+from styping.utils.profile import stage
+from styping.utils.metrics import METRICS
 
 
-LOGGER =logging.getLogger(__name__) 
-LOGGER.setLevel(logging.DEBUG)
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-ch.setFormatter(CustomFormatter())
-fh = logging.FileHandler('abritamr.log')
-fh.setLevel(logging.DEBUG)
-formatter = logging.Formatter('[%(levelname)s:%(asctime)s] %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p') 
-fh.setFormatter(formatter)
-LOGGER.addHandler(ch) 
-LOGGER.addHandler(fh)
+# handlers are set up per run by styping.CustomLog.setup_logging
+LOGGER = logging.getLogger(__name__)
+
+# reference panel used to re-verify the rules and filters, and where its sistr results are cached
+PANEL = pathlib.Path(__file__).parent / 'validation' / 'salmonella_serotyping_reverification_test_set.csv'
+CACHE = pathlib.Path(os.environ.get('STYPING_CACHE', pathlib.Path.home() / '.cache' / 'styping'))
+# default panel of reference sketches for the k-mer pre-screen
+PRESCREEN_PANEL = CACHE / 'prescreen_panel.npz'
+# wall time of past sistr calls on this host, used to plan runs with --dry-run
+TIMINGS = CACHE / 'sistr_timings.csv'
+# default store of the cgMLST allele profiles of typed samples
+CGMLST_STORE = CACHE / 'cgmlst'
+# where the cgMLST profiles written by each sistr call are kept in the run directory
+CGMLST_DIR = 'cgmlst_profiles'
+
+
+def read_stream(path):
+    """
+    read a JSON lines stream of sistr results as a table. Types are taken from the JSON
+    values, so sample IDs stay strings and numbers stay numbers, as in the sistr csv
+    """
+    if os.path.getsize(path) == 0:
+        return pandas.DataFrame(columns = ['genome'])
+    return pandas.read_json(path, lines = True, dtype = False, convert_dates = False)
 
 
 class SetupTyping(object):
@@ -23,8 +47,25 @@ class SetupTyping(object):
     def __init__(self, args):
 
         self.jobs = args.jobs 
+        self.threads = args.threads
         self.contigs = args.contigs
         self.prefix = args.prefix
+        self.min_length = args.min_length
+        self.max_contigs = args.max_contigs
+        self.tmp_dir = args.tmp_dir
+        self.stream = args.stream
+        self.prescreen = args.prescreen
+        self.batch_size = args.batch_size
+        self.outdir = args.outdir
+        self.manifest_format = args.manifest_format
+        self.id_pattern = args.id_pattern
+        self.window = args.window
+        self.partial = args.partial
+        self.merge = args.merge
+        self.mdu = args.mdu
+        self.runid = args.runid
+        self.resume = args.resume
+        self.cgmlst_store = args.cgmlst_store
 
         
     def file_present(self, name):
@@ -54,6 +95,13 @@ class SetupTyping(object):
         else:
             return True
 
+    def _check_runid(self):
+        if self.runid == '':
+            LOGGER.critical(f"Run ID can not be empty, please try again.")
+            raise SystemExit
+        else:
+            return True
+
     def _check_csvtk(self):
         """
         return true if csvtk is installed
@@ -90,39 +138,61 @@ class SetupTyping(object):
             LOGGER.critical(f"It seems that your dependencies are not installed correctly. Please check installation instructions and try again.")
             raise SystemExit
     
+    def _manifest(self):
+        """
+        lazy reader of the samples of a batch
+        """
+        return manifest.Manifest(self.contigs, fmt = self.manifest_format, id_pattern = self.id_pattern)
+
+    def _sniff(self):
+        """
+        read only the first rows of the manifest to check its layout, the rest is read as samples are typed
+        """
+        try:
+            return self._manifest().sniff()
+        except (ValueError, UnicodeDecodeError, ImportError, OSError) as e:
+            LOGGER.critical(f"Your input file should either be a manifest (sample ID and path to contigs in the first two columns of a tab delimited, csv or parquet file, or a directory or glob of contigs) or the path to contigs. Please check your input and try again. {e}")
+            raise SystemExit
+
+    def _format(self):
+        """
+        format of the manifest of a batch, given or guessed from its name
+        """
+        return manifest.manifest_format(self.contigs) if self.manifest_format in (None, '', 'auto') else self.manifest_format
+
     def _get_input_shape(self):
         """
         determine shape of file
         """
         run_type = 'assembly'
-        with open(self.contigs, 'r') as c:
-            data = c.read().strip().split('\n')
-            firstline = data[0]
+        fmt = self._format()
+        if fmt in ('glob', 'parquet'):
+            self._sniff()
+            run_type = 'batch'
+        elif fasta.compression(self.contigs) is not None:
+            LOGGER.info(f"{self.contigs} is a compressed assembly.")
+            return run_type
+        else:
+            with open(self.contigs, 'r') as c:
+                firstline = c.readline()
             if not firstline.startswith('>'):
-                for line in data:
-                    if len(line.split('\t')) != 2:
-                        LOGGER.critical("Your input file should either be a tab delimited file with two columns or the path to contigs. Please check your input and try again.")
-                        raise SystemExit
+                self._sniff()
                 run_type = 'batch'
         LOGGER.info(f"The input file seems to be in the correct format. Thank you.")
         return run_type
-    
+
 
     def _input_files(self):
         """
         Ensure that the files (either contigs or amrfinder output) exist and return running type
         """
-        
+
         running_type = self._get_input_shape()
         if running_type == 'batch':
-            LOGGER.info(f"Checking that the input data is present.")
-            with open(self.contigs, 'r') as c:
-                data = c.read().strip().split('\n')
-                for line in data:
-                    row = line.split('\t')
-                    if not self.file_present(row[1]):
-                        LOGGER.critical(f"{row[1]} is not a valid file path. Please check your input and try again.")
-                        raise SystemExit
+            # missing assemblies are rejected by the pre-flight scan as the manifest is read
+            if not self._sniff():
+                LOGGER.critical(f"No samples were found in {self.contigs}. Please check your input and try again.")
+                raise SystemExit
         elif running_type == 'assembly' and self.file_present(self.contigs):
             LOGGER.info(f"{self.contigs} is present. salmonella_typing can proceed.")
         else:
@@ -130,22 +200,365 @@ class SetupTyping(object):
             raise SystemExit
         
         return running_type
-   
+
+    def _parse_count(self, value):
+        """
+        convert a --jobs/--threads value to an int, None if it should be chosen automatically
+        """
+        if value in (None, '', 'auto', 0, '0'):
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            LOGGER.critical(f"{value} is not a valid number of jobs or threads. Please use a whole number or 'auto'.")
+            raise SystemExit
+
+    def _samples(self, running_type):
+        """
+        (sample ID, path to assembly) to be typed, read lazily from the manifest of a batch
+        """
+        # sistr runs in the run directory, so assemblies are given by their absolute path
+        if running_type != 'batch':
+            return [(self.prefix, os.path.abspath(self.contigs))]
+        return self._manifest()
+
+    def _preflight(self, samples, running_type):
+        """
+        scan all assemblies before any sistr job starts, save the assembly statistics and
+        return only the samples that are worth typing
+        """
+        LOGGER.info(f"Scanning {len(samples)} assemblies before typing.")
+        rows = fasta.preflight(samples, jobs = resources.available_cores(), min_length = self.min_length, max_contigs = self.max_contigs)
+        tab = pandas.DataFrame(rows, columns = fasta.COLUMNS)
+        if running_type == 'batch':
+            outfile = pathlib.Path(self.outdir, 'assembly_stats.csv')
+        else:
+            outfile = pathlib.Path(self.outdir, self.prefix, 'assembly_stats.csv')
+        LOGGER.info(f"Saving assembly statistics as {outfile}")
+        with atomic_write(outfile) as f:
+            tab.to_csv(f, index = False)
+        for row in tab[tab['QC'] != 'PASS'].itertuples():
+            LOGGER.warning(f"{row.ID} ({row.path}) : {row.QC} - {row.QC_REASON}")
+        passed = tab[tab['QC'] != 'REJECT']
+        METRICS.reject(len(tab) - len(passed))
+        if passed.empty:
+            LOGGER.critical(f"None of the assemblies provided are suitable for typing. Please check {outfile} and try again.")
+            raise SystemExit
+        if len(passed) < len(tab):
+            LOGGER.warning(f"{len(tab) - len(passed)} assemblies will not be typed. Please check {outfile} for details.")
+        return list(zip(passed['ID'], passed['path']))
+
+    def _checked_samples(self, samples):
+        """
+        scan the assemblies of a batch a window at a time as they are read from the manifest,
+        saving their statistics (and pre-screen results) as it goes, and yield those worth
+        typing, so that typing starts as soon as the first window has been scanned
+        """
+        outfile = pathlib.Path(self.outdir, 'assembly_stats.csv')
+        screenfile = pathlib.Path(self.outdir, 'prescreen.csv')
+        panel = prescreen.load_panel(self.prescreen) if self.prescreen else None
+        scanned = passed = 0
+        with atomic_write(outfile) as stats, (atomic_write(screenfile) if panel else contextlib.nullcontext()) as screen:
+            stats_writer = csv.writer(stats, lineterminator = '\n')
+            stats_writer.writerow(fasta.COLUMNS)
+            if panel:
+                screen_writer = csv.writer(screen, lineterminator = '\n')
+                screen_writer.writerow(prescreen.COLUMNS)
+            reader = iter(samples)
+            while True:
+                window = list(itertools.islice(reader, self.window))
+                if not window:
+                    break
+                rows = fasta.preflight(window, jobs = resources.available_cores(), min_length = self.min_length, max_contigs = self.max_contigs)
+                stats_writer.writerows(rows)
+                for row in rows:
+                    if row[-2] != 'PASS':
+                        LOGGER.warning(f"{row[0]} ({row[1]}) : {row[-2]} - {row[-1]}")
+                window = [(row[0], row[1]) for row in rows if row[-2] != 'REJECT']
+                if panel and window:
+                    screen_writer.writerows(prescreen.screen_samples(window, panel, jobs = resources.available_cores()))
+                METRICS.reject(len(rows) - len(window))
+                scanned += len(rows)
+                passed += len(window)
+                yield from window
+        for row, reason in getattr(samples, 'skipped', []):
+            LOGGER.warning(f"Row {row} of {self.contigs} was skipped : {reason}")
+        LOGGER.info(f"Scanned {scanned} assemblies, statistics saved as {outfile}" + (f", preliminary serovars saved as {screenfile}." if panel else "."))
+        if passed == 0:
+            LOGGER.critical(f"None of the assemblies provided are suitable for typing. Please check {outfile} and try again.")
+            raise SystemExit
+        if passed < scanned:
+            LOGGER.warning(f"{scanned - passed} assemblies were not typed. Please check {outfile} for details.")
+
+    def _prescreen(self, samples, running_type):
+        """
+        sketch each assembly and compare it with the panel of reference sketches, to give a
+        preliminary serovar for each sample before sistr starts. sistr is still run on every sample
+        """
+        panel = prescreen.load_panel(self.prescreen)
+        LOGGER.info(f"Pre-screening {len(samples)} assemblies against {len(set(panel.serovars))} serovars in {self.prescreen}.")
+        rows = prescreen.screen_samples(samples, panel, jobs = resources.available_cores())
+        tab = pandas.DataFrame(rows, columns = prescreen.COLUMNS)
+        outfile = pathlib.Path(self.outdir, 'prescreen.csv') if running_type == 'batch' else pathlib.Path(self.outdir, self.prefix, 'prescreen.csv')
+        with atomic_write(outfile) as f:
+            tab.to_csv(f, index = False)
+        for serovar, n in tab['PRESCREEN_SEROVAR'].replace('', 'no close reference').value_counts().items():
+            LOGGER.info(f"Pre-screen : {n} sample(s) {serovar}")
+        LOGGER.info(f"Preliminary serovars saved as {outfile}. These are not final, the serovar and STATUS still come from sistr.")
+        return tab
+
+    def _merge_file(self):
+        """
+        typed results of an earlier run to merge with the results of this one, given as
+        the file or the directory of that run
+        """
+        return self._results_file(self.merge)
+
+    def _results_file(self, path):
+        """
+        typed results of a run, given as its sistr_filtered.csv (or any file) or its directory
+        """
+        results = pathlib.Path(path)
+        if results.is_dir():
+            results = results / 'sistr_filtered.csv'
+        if not results.is_file():
+            LOGGER.critical(f"{results} does not exist. Please give the sistr_filtered.csv or the directory of the run and try again.")
+            raise SystemExit
+        return f"{results.resolve()}"
+
+    def _journal(self, running_type):
+        """
+        start the journal of this run, or read that of the interrupted run in outdir to resume it
+        """
+        path = pathlib.Path(self.outdir, journal.JOURNAL)
+        if self.resume and not path.exists():
+            LOGGER.critical(f"There is no run to resume in {self.outdir or os.getcwd()}, {path} does not exist. Please give the --outdir of the interrupted run and try again.")
+            raise SystemExit
+        J = journal.Journal(path, resume = self.resume)
+        settings = {'input': os.path.abspath(self.contigs), 'run_type': running_type, 'prefix': self.prefix, 'stream': self.stream}
+        changed = J.differences(**settings)
+        if changed:
+            LOGGER.critical(f"The {', '.join(changed)} of this run differ from those of the interrupted run in {self.outdir}. Please resume with the same inputs, or start a new run.")
+            raise SystemExit
+        if self.resume:
+            LOGGER.info(f"Resuming the run in {self.outdir}, {len(J.samples)} samples were typed before it was interrupted.")
+            if J.settings.get('manifest') != journal.fingerprint(self.contigs):
+                LOGGER.warning(f"{self.contigs} has changed since the interrupted run, only its samples that were typed and have not changed will be skipped.")
+        J.start(manifest = journal.fingerprint(self.contigs), **settings)
+        return J
+
+    def _plan_jobs(self, running_type, n_samples):
+        """
+        choose the number of concurrent sistr jobs and threads per job from the cores and memory available
+        """
+        jobs, threads = resources.plan_parallelism(
+            # samples typed together share a job
+            n_samples = math.ceil(n_samples / max(1, self.batch_size)),
+            jobs = self._parse_count(self.jobs) if running_type == 'batch' else 1,
+            threads = self._parse_count(self.threads)
+        )
+        LOGGER.info(f"Detected {resources.available_cores()} cores and {resources.available_memory() / 1024 ** 3:.1f} GB of memory. Will run {jobs} sistr job(s) with {threads} thread(s) each.")
+        return jobs, threads
+
+    def plan(self):
+        """
+        predict the wall time, core-hours and peak memory of the run from the timings of earlier
+        sistr calls on this host, without typing anything. Every number of jobs the host can run
+        is planned, and the one with the shortest wall time is suggested once the timings show
+        how sistr scales with its threads
+        """
+        running_type = self._input_files()
+        if running_type == 'assembly':
+            self._check_prefix()
+        samples = list(self._samples(running_type))
+        sizes = [timings.assembly_bytes(contigs) for seqid, contigs in samples]
+        history = timings.load(TIMINGS)
+        if len(history) == 0:
+            LOGGER.warning(f"No sistr timings have been recorded in {TIMINGS} yet, the plan uses a rough default cost. It will improve once batches have been run on this host.")
+        jobs, threads = self._plan_jobs(running_type, len(samples))
+        model = timings.fit(history)
+        plans = []
+        for n in range(1, (resources.max_jobs() if running_type == 'batch' else 1) + 1):
+            n, t = resources.plan_parallelism(len(samples), jobs = n, threads = self._parse_count(self.threads))
+            plans.append(timings.plan(sizes, n, t, self.batch_size, self.window, model))
+        tab = pandas.DataFrame(plans, columns = timings.Plan._fields)
+        outfile = pathlib.Path(self.outdir, 'dry_run.csv')
+        with atomic_write(outfile) as f:
+            tab.to_csv(f, index = False)
+        chosen = tab[tab['jobs'] == jobs]
+        chosen = chosen.iloc[0] if len(chosen) else timings.plan(sizes, jobs, threads, self.batch_size, self.window, model)
+        LOGGER.info(f"{len(samples)} samples ({sum(sizes) / 1e9:.2f} GB of assemblies) with {int(chosen.jobs)} job(s) of {int(chosen.threads)} thread(s) : about {chosen.wall_h:.2f} h wall time, {chosen.core_h:.2f} core-hours and {chosen.peak_memory_gb} GB of memory at peak.")
+        if not timings.scales_with_threads(history):
+            # without it, fewer jobs with more threads are never predicted to be faster, so the most jobs always win
+            LOGGER.info(f"sistr timings with different numbers of threads are needed to tell how it scales with its threads, so no number of jobs is suggested yet. Plans for every number of jobs, taking the time per byte to be the same whatever the threads, saved as {outfile}.")
+            return tab
+        # the fewest jobs that come within a minute of the shortest wall time
+        best = tab[tab['wall_h'] <= tab['wall_h'].min() + 1 / 60].iloc[0]
+        LOGGER.info(f"Suggested : --jobs {int(best.jobs)} --threads {int(best.threads)}, about {best.wall_h:.2f} h wall time, {best.core_h:.2f} core-hours and {best.peak_memory_gb} GB of memory at peak. Plans for every number of jobs saved as {outfile}.")
+        return tab
+
 
     def setup(self):
         LOGGER.info("Checking dependencies.")
-        self._check_deps()
+        with stage('dependencies'):
+            self._check_deps()
         # check that inputs are correct and files are present
         running_type = self._input_files()
         # check that prefix is present (if needed)
         if running_type == 'assembly':
             self._check_prefix()
-        Data = collections.namedtuple('Data', ['run_type', 'input', 'prefix', 'jobs'])
-        input_data = Data(running_type, self.contigs, self.prefix, self.jobs)
+        if self.prescreen and not self.file_present(self.prescreen):
+            LOGGER.critical(f"The pre-screen panel {self.prescreen} does not exist. Please build one with stype panel and try again.")
+            raise SystemExit
+        priority = {}
+        if running_type == 'batch':
+            # assemblies are scanned as the manifest is read, jobs are planned from its first rows
+            batch = self._samples(running_type)
+            if batch.urgent():
+                priority = batch.priorities
+                LOGGER.info(f"{len(priority)} urgent samples will be typed first, and their results saved in sistr_urgent.csv as soon as they have finished.")
+            samples = self._checked_samples(batch)
+            jobs, threads = self._plan_jobs(running_type, len(self._sniff()))
+        else:
+            with stage('preflight'):
+                samples = self._preflight(self._samples(running_type), running_type)
+            if self.prescreen:
+                with stage('prescreen'):
+                    self._prescreen(samples, running_type)
+            jobs, threads = self._plan_jobs(running_type, len(samples))
+        if self.tmp_dir and not pathlib.Path(self.tmp_dir).is_dir():
+            LOGGER.critical(f"{self.tmp_dir} is not a directory. Please check your input and try again.")
+            raise SystemExit
+        if self.stream and running_type != 'batch':
+            LOGGER.info(f"A single sample is written to {self.prefix}/sistr.csv, --stream is only used in batch mode.")
+            self.stream = ''
+        if (self.partial or self.merge) and running_type != 'batch':
+            LOGGER.info(f"--partial and --merge are only used in batch mode.")
+            self.partial, self.merge = False, ''
+        merge = self._merge_file() if self.merge else ''
+        if self.mdu:
+            self._check_runid()
+        if self.batch_size < 1 or self.window < 1:
+            LOGGER.critical(f"The number of samples per sistr call and per window must be at least 1.")
+            raise SystemExit
+        # paths used by sistr, which runs in the run directory
+        tmp_dir = os.path.abspath(self.tmp_dir) if self.tmp_dir else ''
+        stream = f"{pathlib.Path(self.outdir, self.stream)}" if self.stream else ''
+        run_journal = self._journal(running_type)
+        LOGGER.info(f"Results of this run will be saved in {self.outdir or os.getcwd()}")
+        Data = collections.namedtuple('Data', ['run_type', 'input', 'prefix', 'jobs', 'threads', 'samples', 'tmp_dir', 'stream', 'batch_size', 'outdir', 'window', 'manifest_format', 'partial', 'merge', 'priority', 'runid', 'journal', 'cgmlst'])
+        input_data = Data(running_type, os.path.abspath(self.contigs), self.prefix, jobs, threads, samples, tmp_dir, stream, self.batch_size, self.outdir, self.window, self._format() if running_type == 'batch' else '', self.partial, merge, priority, self.runid if self.mdu else '', run_journal, os.path.abspath(self.cgmlst_store) if self.cgmlst_store else '')
         
         return input_data
 
 
+class SetupPanel(SetupTyping):
+    """
+    Setup building a panel of reference sketches for the k-mer pre-screen
+    """
+    def __init__(self, args):
+
+        self.references = args.references
+        self.panel = args.panel
+        self.size = args.size
+        self.k = args.k
+        self.jobs = args.jobs
+
+    def setup(self):
+        """
+        Check the references are present
+        """
+        if not self.file_present(self.references):
+            LOGGER.critical(f"{self.references} is not a valid file path. Please check your input and try again.")
+            raise SystemExit
+        with open(self.references, 'r') as r:
+            references = [tuple(line.split('\t')) for line in r.read().strip().split('\n')]
+        for row in references:
+            if len(row) != 2 or not self.file_present(row[1]):
+                LOGGER.critical(f"{self.references} should be a tab delimited file of serovar and path to a reference assembly, {row} is not valid. Please check your input and try again.")
+                raise SystemExit
+        if not 1 <= self.k <= 32:
+            LOGGER.critical(f"The k-mer size must be between 1 and 32.")
+            raise SystemExit
+        jobs = self._parse_count(self.jobs) or resources.available_cores()
+        pathlib.Path(self.panel).parent.mkdir(parents = True, exist_ok = True)
+        Data = collections.namedtuple('Data', ['references', 'panel', 'size', 'k', 'jobs'])
+        return Data(references, self.panel, self.size, self.k, jobs)
+
+    def build(self):
+        """
+        sketch the references and save the panel
+        """
+        data = self.setup()
+        LOGGER.info(f"Sketching {len(data.references)} references of {len(set(s for s, p in data.references))} serovars.")
+        panel = prescreen.build_panel(data.references, size = data.size, k = data.k, jobs = data.jobs)
+        prescreen.save_panel(panel, data.panel)
+        LOGGER.info(f"Pre-screen panel saved as {data.panel}")
+        return data.panel
+
+
+class SetupCgmlst(SetupTyping):
+    """
+    Setup a query of the cgMLST profile store for the nearest neighbours of samples
+    """
+    def __init__(self, args):
+
+        self.store = args.store
+        self.profiles = args.profiles
+        self.samples = args.samples
+        self.k = args.k
+        self.max_distance = args.max_distance
+        self.pairwise = args.pairwise
+        self.jobs = args.jobs
+        self.outfile = args.outfile
+
+    def _profile_files(self):
+        """
+        cgMLST profiles written by sistr, given as files or as run directories
+        """
+        files = []
+        for path in self.profiles:
+            path = pathlib.Path(path)
+            if path.is_dir():
+                files.extend(sorted((path / CGMLST_DIR if (path / CGMLST_DIR).is_dir() else path).glob('*.csv'), key = os.path.getmtime))
+            elif self.file_present(path):
+                files.append(path)
+            else:
+                LOGGER.critical(f"{path} is not a valid file path. Please check your input and try again.")
+                raise SystemExit
+        return files
+
+    def setup(self):
+        """
+        Check the store and the samples to query.
+        """
+        store = cgmlst.ProfileStore(self.store)
+        if len(store.samples) == 0:
+            LOGGER.critical(f"There are no cgMLST profiles in {self.store}. Please add some with stype run --cgmlst-store and try again.")
+            raise SystemExit
+        if self.k < 1:
+            LOGGER.critical(f"The number of neighbours must be at least 1.")
+            raise SystemExit
+        queries = None
+        if self.profiles:
+            queries = cgmlst.read_profiles(self._profile_files())
+            queries = queries[~queries.index.duplicated(keep = 'last')]
+            if queries.empty:
+                LOGGER.critical(f"No cgMLST profiles were found in {', '.join(self.profiles)}. Please check your input and try again.")
+                raise SystemExit
+        elif self.samples:
+            missing = sorted(set(self.samples) - set(store.samples['ID']))
+            if missing:
+                LOGGER.critical(f"{len(missing)} samples ({', '.join(missing[:10])}) are not in {self.store}. Please check your input and try again.")
+                raise SystemExit
+        else:
+            LOGGER.critical(f"Please give the cgMLST profiles (--profiles) or the IDs of stored samples (--samples) to query.")
+            raise SystemExit
+        jobs = self._parse_count(self.jobs) or resources.available_cores()
+        Data = collections.namedtuple('Data', ['store', 'queries', 'samples', 'k', 'max_distance', 'pairwise', 'jobs', 'outfile'])
+        return Data(self.store, queries, self.samples, self.k, self.max_distance, self.pairwise, jobs, self.outfile)
+
+
 class SetupMDU(SetupTyping):
     """
     Setup MDUify of abritamr results
@@ -154,71 +567,527 @@ class SetupMDU(SetupTyping):
     
         self.runid = args.runid
         self.input = args.sistr
+        self.runs = args.runs
+        self.jobs = args.jobs
+        self.outdir = args.outdir
         
 
-    def _check_runid(self):
-        if self.runid == '':
-            LOGGER.critical(f"Run ID can not be empty, please try again.")
+    def _runs(self):
+        """
+        (run ID, results) of each run to report, from a tab separated list of run IDs and results
+        (files or run directories) or from a results store (typed results of many runs, with the run
+        ID of each sample in a runid column), given as (None, store)
+        """
+        if not self.file_present(self.runs) or os.path.getsize(self.runs) == 0:
+            LOGGER.critical(f"{self.runs} is not a valid file path. Please check your input and try again.")
             raise SystemExit
-        else:
-            return True
+        header = pandas.read_csv(self.runs, nrows = 0).columns
+        if {'runid', 'genome'}.issubset(header):
+            LOGGER.info(f"Reading the results of all runs from the results store {self.runs}")
+            return [(None, f"{pathlib.Path(self.runs).resolve()}")]
+        pairs = pandas.read_csv(self.runs, sep = '\t', header = None, names = ['runid', 'results'], dtype = str, comment = '#', skip_blank_lines = True)
+        if len(pairs) and tuple(pairs.iloc[0]) == ('runid', 'results'):
+            pairs = pairs.iloc[1:]
+        if pairs.empty or pairs.isna().any(axis = None):
+            LOGGER.critical(f"{self.runs} must list a run ID and its results (a sistr_filtered.csv or run directory) on each line, separated by a tab. Please check your input and try again.")
+            raise SystemExit
+        duplicated = pairs['runid'][pairs['runid'].duplicated()].unique()
+        if len(duplicated):
+            LOGGER.critical(f"Run ID(s) {', '.join(duplicated)} are listed more than once in {self.runs}. Please check your input and try again.")
+            raise SystemExit
+        return [(runid, self._results_file(results)) for runid, results in pairs.itertuples(index = False)]
 
     def setup(self):
         """
         Check the inputs for MDU - ensure all files are present for collation.
         """
-        self._check_runid()
+        Data = collections.namedtuple('Data', ['input', 'runid', 'outdir', 'runs', 'jobs'])
+        os.makedirs(self.outdir, exist_ok = True)
 
-        Data = collections.namedtuple('Data', ['input', 'runid'])
+        if self.runs:
+            runs = self._runs()
+            jobs = self._parse_count(self.jobs) or resources.available_cores()
+            return Data(self.input, '', self.outdir, runs, jobs)
+
+        self._check_runid()
+        if not self.input:
+            LOGGER.critical(f"Please give the results of the run to --sistr (its sistr_filtered.csv or its run directory) and try again.")
+            raise SystemExit
+        # a run directory (e.g. stype_<date>_<time>_<pid>) is read as its sistr_filtered.csv
+        self.input = self._results_file(self.input)
 
         if self.file_present(self.input) and self._check_runid():
-            return Data(self.input, self.runid)
+            return Data(self.input, self.runid, self.outdir, [], 1)
         else:
             LOGGER.critical(f"Something has gone wrong with your inputs. Please try again!")
             raise SystemExit
 
-class RunTyping:
+class SetupVerify(SetupTyping):
+    """
+    Setup re-verification of the rules and filters against cached sistr results for the reference panel
+    """
+    def __init__(self, args):
+
+        self.sistr = args.sistr
+        self.cache = args.cache
+        self.panel = args.panel
+        self.outfile = args.outfile
+
+    def _cache_file(self):
+        return pathlib.Path(self.cache) / 'reverification_sistr.csv'
+
+    def _sistr_files(self):
+        """
+        sistr outputs to cache - either a concatenated sistr csv or a directory with one sistr.csv per sample
+        """
+        path = pathlib.Path(self.sistr)
+        if path.is_dir():
+            return sorted(path.glob('*/sistr.csv'))
+        elif self.file_present(self.sistr):
+            return [path]
+        return []
+
+    def _build_cache(self):
+        """
+        store the raw sistr results of the panel so that rules and filters can be re-applied without running sistr
+        """
+        files = self._sistr_files()
+        if files == []:
+            LOGGER.critical(f"No sistr results were found in {self.sistr}. Please check your input and try again.")
+            raise SystemExit
+        tab = pandas.concat([pandas.read_csv(f) for f in files])
+        cache_file = self._cache_file()
+        # the cache is shared by every run on the host, so only one run updates it at a time
+        with locked(cache_file), atomic_write(cache_file) as f:
+            tab.to_csv(f, index = False)
+        LOGGER.info(f"Cached sistr results of {len(tab)} samples in {cache_file}")
+
+    def setup(self):
+        """
+        Check that the cache and panel are present, building the cache if sistr results are provided.
+        """
+        if self.sistr != '':
+            self._build_cache()
+        cache_file = self._cache_file()
+        if not self.file_present(f"{cache_file}"):
+            LOGGER.critical(f"There are no cached sistr results in {self.cache}. Please run stype verify with --sistr to build the cache.")
+            raise SystemExit
+        if not self.file_present(self.panel):
+            LOGGER.critical(f"The panel {self.panel} is missing. Please check your input and try again.")
+            raise SystemExit
+        Data = collections.namedtuple('Data', ['cache', 'panel', 'outfile'])
+        return Data(f"{cache_file}", self.panel, self.outfile)
+
+class SetupReplay(SetupTyping):
     """
-    A base class for setting up abritamr return a valid input object for subsequent steps
+    Setup replay of stored sistr results through old and new rules and filters
     """
     def __init__(self, args):
 
+        self.sistr = args.sistr
+        self.old_rules = args.old_rules
+        self.old_filters = args.old_filters
+        self.new_rules = args.new_rules
+        self.new_filters = args.new_filters
+        self.jobs = args.jobs
+        self.chunksize = args.chunksize
+        self.outfile = args.outfile
+        self.summary = args.summary
+
+    def _expand_sistr(self):
+        """
+        expand globs of stored sistr results and check they are present
+        """
+        files = []
+        for pattern in self.sistr:
+            matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+            for f in matches:
+                if not self.file_present(f):
+                    LOGGER.critical(f"{f} is not a valid file path. Please check your input and try again.")
+                    raise SystemExit
+                files.append(f)
+        if files == []:
+            LOGGER.critical(f"No stored sistr results were found. Please check your input and try again.")
+            raise SystemExit
+        return files
+
+    def setup(self):
+        """
+        Check the stored results and rule sets to replay.
+        """
+        files = self._expand_sistr()
+        for ruleset in [self.old_rules, self.old_filters, self.new_rules, self.new_filters]:
+            if ruleset != '' and not self.file_present(ruleset):
+                LOGGER.critical(f"{ruleset} is not a valid file path. Please check your input and try again.")
+                raise SystemExit
+        if self.old_rules == self.new_rules and self.old_filters == self.new_filters:
+            LOGGER.warning(f"The old and new rule sets are the same, no changes are expected.")
+        jobs = self._parse_count(self.jobs) or resources.available_cores()
+        Data = collections.namedtuple('Data', ['sistr', 'old_rules', 'old_filters', 'new_rules', 'new_filters', 'jobs', 'chunksize', 'outfile', 'summary'])
+        return Data(files, self.old_rules, self.old_filters, self.new_rules, self.new_filters, jobs, self.chunksize, self.outfile, self.summary)
+
+class RunTyping:
+    """
+    A base class for setting up abritamr return a valid input object for subsequent steps.
+    If urgent (a styping.Parse.UrgentSistr) is given, the results of the urgent samples of
+    a batch are collated by it as soon as they have finished
+    """
+    def __init__(self, args, urgent = None):
+
         self.run_type = args.run_type
         self.input = args.input
         self.prefix = args.prefix
         self.jobs = args.jobs
+        self.threads = args.threads
+        self.samples = args.samples
+        self.tmp_dir = args.tmp_dir
+        self.stream = args.stream
+        self.stream_lock = threading.Lock()
+        self.batch_size = args.batch_size
+        self.outdir = args.outdir
+        self.window = args.window
+        self.manifest_format = args.manifest_format
+        self.partial = args.partial
+        self.merge = args.merge
+        self.priority = args.priority
+        self.runid = args.runid
+        self.journal = args.journal
+        self.cgmlst = args.cgmlst
+        self.urgent = urgent
+        # rows of timings of the sistr calls of this run
+        self.timings = []
 
-    def _batch_cmd(self):
+    def _sample_cmd(self, seqid, contigs, stream = False):
         """
-        generate cmd with parallel
+        generate a sistr command for a single sample. Compressed assemblies are streamed
+        into the job's temporary directory.
+        If stream is True, no directory is made for the sample and the results are
+        printed to stdout instead, to be appended to the result stream
         """
-        cmd = f"parallel -j {self.jobs} --colsep '\\t' 'tmp_dir=$(mktemp -d -t sistr-XXXXXXXXXX) && mkdir -p {{1}} && sistr -i {{2}} {{1}} -f csv -o {{1}}/sistr.csv --tmp-dir $tmp_dir --threads 1 -m && rm -r $tmp_dir' :::: {self.input}"
+        method = fasta.compression(contigs)
+        if method is not None:
+            decompress = f"{fasta.DECOMPRESS[method]} {shlex.quote(f'{contigs}')} > \"$tmp_dir\"/contigs.fa && "
+            contigs = '"$tmp_dir"/contigs.fa'
+        else:
+            decompress = ""
+            contigs = shlex.quote(f"{contigs}")
+        if stream:
+            mkdir, output, show = "", '"$tmp_dir"/sistr.csv', ' && cat "$tmp_dir"/sistr.csv'
+        else:
+            # written under a temporary name and renamed once sistr has finished, so a partial file is never taken as a result
+            output = shlex.quote(f"{seqid}/.sistr.csv.tmp")
+            mkdir, show = f"mkdir -p {shlex.quote(f'{seqid}')} && ", f" && mv {output} {shlex.quote(f'{seqid}/sistr.csv')}"
+        profiles, keep = self._profiles_args()
+        cmd = f"{self._tmp_dir_cmd()}{mkdir}{decompress}sistr -i {contigs} {shlex.quote(f'{seqid}')} -f csv -o {output} --threads {self.threads} --tmp-dir \"$tmp_dir\" -m{profiles}{show}{keep}"
 
         return cmd
-    
-    def _single_cmd(self):
+
+    def _group_cmd(self, group):
         """
-        generate a single amrfinder command
+        generate a single sistr command typing a group of samples, so that sistr loads its
+        databases once for the whole group. The results of all samples are printed to stdout
+        to be split per sample, and the temporary directory is removed when the job exits
         """
-        cmd = f"tmp_dir=$(mktemp -d -t sistr-XXXXXXXXXX) && mkdir -p {self.prefix} && sistr -i {self.input} {self.prefix} -f csv -o {self.prefix}/sistr.csv --threads {self.jobs} --tmp-dir $tmp_dir -m && rm -r $tmp_dir"
-        
+        decompress = ""
+        inputs = []
+        for i, (seqid, contigs) in enumerate(group):
+            method = fasta.compression(contigs)
+            if method is not None:
+                decompress += f"{fasta.DECOMPRESS[method]} {shlex.quote(f'{contigs}')} > \"$tmp_dir\"/contigs_{i}.fa && "
+                contigs = f'"$tmp_dir"/contigs_{i}.fa'
+            else:
+                contigs = shlex.quote(f"{contigs}")
+            inputs.append(f"-i {contigs} {shlex.quote(f'{seqid}')}")
+        profiles, keep = self._profiles_args()
+        cmd = f"{self._tmp_dir_cmd()}{decompress}sistr {' '.join(inputs)} -f csv -o \"$tmp_dir\"/sistr.csv --threads {self.threads} --tmp-dir \"$tmp_dir\" -m{profiles} && cat \"$tmp_dir\"/sistr.csv{keep}"
+
         return cmd
-    
-    def _generate_cmd(self):
+
+    def _tmp_dir_cmd(self):
         """
-        Generate a command to run sistr
+        start of a sistr command making the temporary directory of the job, removed when the job exits
+        whether or not sistr succeeded. Every value given to the shell is quoted
         """
-        LOGGER.info(f"Determining command to run salmonella_typing in {self.run_type} mode.")
-        cmd = self._batch_cmd() if self.run_type == 'batch' else self._single_cmd()
-        return cmd
-        
+        mktemp = f"mktemp -d -p {shlex.quote(self.tmp_dir)} sistr-XXXXXXXXXX" if self.tmp_dir else "mktemp -d -t sistr-XXXXXXXXXX"
+        return f"tmp_dir=$({mktemp}) && trap 'rm -rf \"$tmp_dir\"' EXIT && "
+
+    def _profiles_args(self):
+        """
+        arguments of a sistr command writing the cgMLST profiles of its samples, and moving them
+        into CGMLST_DIR (named after the unique temporary directory of the call) once it has finished
+        """
+        if not self.cgmlst:
+            return "", ""
+        return ' --cgmlst-profiles "$tmp_dir"/cgmlst.csv', f' && mv "$tmp_dir"/cgmlst.csv {shlex.quote(CGMLST_DIR)}/"$(basename "$tmp_dir")".csv'
+
+    def _store_profiles(self):
+        """
+        add the cgMLST profiles of the samples typed by this run to the profile store
+        """
+        files = sorted(pathlib.Path(self.outdir, CGMLST_DIR).glob('*.csv'), key = os.path.getmtime)
+        tab = cgmlst.read_profiles(files)
+        typed = {f"{seqid}" for seqid, contigs in self.samples}
+        if not tab.empty:
+            tab = tab[tab.index.isin(typed)]
+            # samples typed again (e.g. after a group failed) keep their latest profile
+            tab = tab[~tab.index.duplicated(keep = 'last')]
+        if len(tab) < len(typed):
+            LOGGER.warning(f"The cgMLST profiles of {len(typed) - len(tab)} samples are missing from {pathlib.Path(self.outdir, CGMLST_DIR)} and will not be stored.")
+        store = cgmlst.ProfileStore(self.cgmlst)
+        try:
+            added = store.add(tab, run = f"{pathlib.Path(self.outdir or '.').resolve()}")
+        except ValueError as e:
+            LOGGER.critical(f"The cgMLST profiles of this run could not be stored : {e}")
+            raise SystemExit
+        LOGGER.info(f"cgMLST profiles of {added} samples added to {self.cgmlst}, which now holds {len(store.samples)} profiles.")
+
+    def _single_cmd(self):
+        """
+        generate a single sistr command
+        """
+        return self._sample_cmd(self.prefix, self.input)
+
+    def _batch_order(self, samples = None):
+        """
+        order samples (by default all samples) highest priority first, then largest assembly
+        first, so that the biggest jobs do not start last and leave the node idle at the end of the batch
+        """
+        samples = sorted(self.samples if samples is None else samples, key = lambda s: (self.priority.get(f"{s[0]}", 0), resources.file_size(s[1])), reverse = True)
+        return samples
+
+    def _results_path(self, seqid):
+        """
+        where the sistr results of a sample are saved, None if they are appended to the stream
+        """
+        if self.stream:
+            return None
+        return pathlib.Path(self.outdir, f"{seqid}", 'sistr.csv')
+
+    def _record_sample(self, seqid, contigs):
+        if self.journal is not None:
+            self.journal.record_sample(seqid, contigs, self._results_path(seqid))
+
+    def _resumed(self, seqid, contigs):
+        """
+        True if the interrupted run being resumed typed the sample, and neither its assembly
+        nor its results have changed since
+        """
+        if self.journal is None or not self.journal.typed(seqid, contigs, self._results_path(seqid)):
+            return False
+        return not self.stream or f"{seqid}" in self._streamed
+
+    def _resume_stream(self):
+        """
+        keep only the results of the samples the journal shows were typed in the stream of the
+        interrupted run, so that samples typed again are not in the stream twice
+        """
+        if not pathlib.Path(self.stream).exists():
+            open(self.stream, 'w').close()
+        tab = read_stream(self.stream)
+        kept = tab['genome'].astype(str).isin(self.journal.samples)
+        self._streamed = set(tab['genome'][kept].astype(str))
+        if kept.all():
+            return
+        with atomic_write(self.stream) as f:
+            if kept.any():
+                f.write(tab[kept].to_json(orient = 'records', lines = True).rstrip('\n') + '\n')
+
+    def _run_sample(self, seqid, contigs):
+        """
+        run sistr on a single sample of a batch
+        """
+        cmd = self._sample_cmd(seqid, contigs, stream = bool(self.stream))
+        # per-sample messages are debug only, and formatted lazily so they cost nothing when turned off
+        LOGGER.debug("%s : running %s", seqid, cmd)
+        start = time.perf_counter()
+        p = subprocess.run(cmd, shell = True, capture_output = True, encoding = "utf-8", cwd = self.outdir or None)
+        METRICS.observe_job(time.perf_counter() - start)
+        if p.returncode == 0:
+            self.timings.append(timings.timing([(seqid, contigs)], self.threads, time.perf_counter() - start))
+        LOGGER.debug("%s : sistr finished with exit code %s in %.1f s", seqid, p.returncode, time.perf_counter() - start)
+        if p.returncode != 0:
+            LOGGER.warning(f"sistr did not complete for {seqid}. The following error has been reported : \n {p.stderr}")
+            return False
+        if self.stream:
+            self._append_stream(p.stdout)
+        self._record_sample(seqid, contigs)
+        return True
+
+    def _split_results(self, results):
+        """
+        split the csv output of sistr for a group of samples into the csv text of each sample
+        """
+        rows = list(csv.reader(io.StringIO(results)))
+        if not rows:
+            return {}
+        header = rows[0]
+        genome = header.index('genome')
+        per_sample = collections.defaultdict(list)
+        for row in rows[1:]:
+            if row:
+                per_sample[row[genome]].append(row)
+        split = {}
+        for seqid, sample_rows in per_sample.items():
+            out = io.StringIO()
+            writer = csv.writer(out, lineterminator = '\n')
+            writer.writerow(header)
+            writer.writerows(sample_rows)
+            split[seqid] = out.getvalue()
+        return split
+
+    def _save_results(self, seqid, results):
+        """
+        save the sistr results of a sample (csv text) where the parse stage expects them
+        """
+        if self.stream:
+            self._append_stream(results)
+        else:
+            with atomic_write(pathlib.Path(self.outdir, f"{seqid}", 'sistr.csv')) as f:
+                f.write(results)
+
+    def _run_group(self, group):
+        """
+        run sistr once on a group of samples and split the output per sample. If sistr fails,
+        or a sample is missing from its output, those samples are retried one at a time
+        """
+        METRICS.started(len(group))
+        if len(group) == 1:
+            return [self._run_sample(*group[0])]
+        cmd = self._group_cmd(group)
+        LOGGER.debug("%s : running %s", ', '.join(seqid for seqid, contigs in group), cmd)
+        start = time.perf_counter()
+        p = subprocess.run(cmd, shell = True, capture_output = True, encoding = "utf-8", cwd = self.outdir or None)
+        METRICS.observe_job(time.perf_counter() - start)
+        if p.returncode == 0:
+            self.timings.append(timings.timing(group, self.threads, time.perf_counter() - start))
+        LOGGER.debug("%d samples : sistr finished with exit code %s in %.1f s", len(group), p.returncode, time.perf_counter() - start)
+        results = self._split_results(p.stdout) if p.returncode == 0 else {}
+        if p.returncode != 0:
+            LOGGER.warning(f"sistr did not complete for a group of {len(group)} samples, they will be typed one at a time. The following error has been reported : \n {p.stderr}")
+        done = []
+        for seqid, contigs in group:
+            if f"{seqid}" in results:
+                self._save_results(seqid, results[f"{seqid}"])
+                self._record_sample(seqid, contigs)
+                done.append(True)
+            else:
+                if p.returncode == 0:
+                    LOGGER.warning(f"{seqid} is missing from the sistr output of its group, it will be typed on its own.")
+                done.append(self._run_sample(seqid, contigs))
+        return done
+
+    def _append_stream(self, results):
+        """
+        append the sistr results of a sample (csv text) to the result stream as JSON lines. Each
+        sample is written with a single call under a lock, so lines from different jobs never interleave
+        """
+        tab = pandas.read_csv(io.StringIO(results), dtype = {'genome': str})
+        lines = tab.to_json(orient = 'records', lines = True)
+        if not lines.endswith('\n'):
+            lines += '\n'
+        with self.stream_lock:
+            with open(self.stream, 'a') as f:
+                f.write(lines)
+
+    def _collect_groups(self, pending, done, block = False):
+        """
+        record the outcome of the groups that have finished, waiting for one if block is True
+        """
+        if block and pending:
+            wait(pending, return_when = FIRST_COMPLETED)
+        for future in [f for f in pending if f.done()]:
+            group = pending.pop(future)
+            group_done = future.result()
+            done.extend(group_done)
+            self._track_urgent(zip(group, group_done))
+
+    def _track_urgent(self, finished):
+        """
+        count down the urgent samples as they finish, and collate the results of those typed
+        once all of them have finished, before the rest of the batch
+        """
+        for (seqid, contigs), ok in finished:
+            if self.priority.get(f"{seqid}", 0) > 0:
+                self._urgent_left -= 1
+                if ok:
+                    self._urgent_typed.append((seqid, contigs))
+        if self.urgent is not None and self._urgent_read and self._urgent_left == 0 and self._urgent_typed and not self._urgent_saved:
+            self._urgent_saved = True
+            # the stream is not appended to while it is read
+            with stage('urgent'), self.stream_lock:
+                self.urgent.record(self._urgent_typed)
+
+    def _run_batch(self):
+        """
+        run sistr on samples as they are read, dispatching the largest assemblies of each window
+        of samples first. Only a few groups are queued ahead of the running jobs, so reading and
+        scanning the next window overlaps with typing
+        """
+        LOGGER.info(f"Running sistr in call(s) of up to {self.batch_size} sample(s), with {self.jobs} job(s) of {self.threads} thread(s), largest assemblies first in windows of {self.window} samples.")
+        typed = []
+        done = []
+        pending = {}
+        skipped = 0
+        samples = iter(self.samples)
+        # urgent samples are read first, they have all been read once a routine sample is read
+        self._urgent_left, self._urgent_typed, self._urgent_read, self._urgent_saved = 0, [], False, False
+        with ThreadPoolExecutor(max_workers = self.jobs) as pool:
+            while True:
+                window = self._batch_order(list(itertools.islice(samples, self.window)))
+                if not window:
+                    break
+                typed.extend(window)
+                urgent = sum(self.priority.get(f"{seqid}", 0) > 0 for seqid, contigs in window)
+                self._urgent_left += urgent
+                self._urgent_read = self._urgent_read or urgent < len(window)
+                # samples typed by the interrupted run being resumed are not typed again
+                resumed = [sample for sample in window if self._resumed(*sample)]
+                if resumed:
+                    skipped += len(resumed)
+                    done.extend([True] * len(resumed))
+                    self._track_urgent([(sample, True) for sample in resumed])
+                    resumed = set(resumed)
+                    window = [sample for sample in window if sample not in resumed]
+                # consecutive samples are grouped, so groups are also dispatched largest first
+                for i in range(0, len(window), self.batch_size):
+                    while len(pending) >= 2 * self.jobs:
+                        self._collect_groups(pending, done, block = True)
+                    group = window[i:i + self.batch_size]
+                    METRICS.queue(len(group))
+                    future = pool.submit(self._run_group, group)
+                    future.add_done_callback(lambda f: METRICS.finished(f.result()))
+                    pending[future] = group
+                # record the groups that finished while this window was dispatched, before reading the next
+                self._collect_groups(pending, done)
+            self._urgent_read = True
+            self._track_urgent([])
+            # groups are collected as each finishes, so urgent results are saved while the rest of the batch is typed
+            while pending:
+                self._collect_groups(pending, done, block = True)
+        # the samples read from the manifest, to check and collate their results
+        self.samples = typed
+        if self.journal is not None and self.journal.resumed:
+            LOGGER.info(f"{skipped} samples typed by the interrupted run were not typed again.")
+            if self.journal.changed:
+                LOGGER.warning(f"The assemblies or results of {len(self.journal.changed)} samples ({', '.join(self.journal.changed[:10])}) had changed since the interrupted run, they were typed again.")
+        if all(done):
+            LOGGER.info(f"sistr completed successfully. Will now move on to collation.")
+            return True
+        else:
+            LOGGER.critical(f"sistr did not complete for {done.count(False)} of {len(done)} samples.")
+
     def _run_cmd(self, cmd):
         """
         Use subprocess to run the command for sisrs
         """
-
-        p = subprocess.run(cmd, shell = True, capture_output = True, encoding = "utf-8")
+        METRICS.queue(1)
+        METRICS.started(1)
+        start = time.perf_counter()
+        p = subprocess.run(cmd, shell = True, capture_output = True, encoding = "utf-8", cwd = self.outdir or None)
+        METRICS.observe_job(time.perf_counter() - start)
+        METRICS.finished([p.returncode == 0])
         if p.returncode == 0:
+            self.timings.append(timings.timing([(self.prefix, self.input)], self.threads, time.perf_counter() - start))
             LOGGER.info(f"sistr completed successfully. Will now move on to collation.")
             return True
         else:
@@ -234,29 +1103,246 @@ class RunTyping:
         else:
             return True
 
+    def _failed_samples(self, failed):
+        """
+        save the samples without sistr results as a manifest in the format of the input, so
+        that only they need to be typed again, and keep the others for collation
+        """
+        outfile = pathlib.Path(self.outdir, f"failed_samples{manifest.SUFFIXES[self.manifest_format]}")
+        manifest.write_manifest(failed, outfile, 'tsv' if self.manifest_format == 'glob' else self.manifest_format, priorities = self.priority)
+        failed_ids = {f"{seqid}" for seqid, contigs in failed}
+        self.samples = [(seqid, contigs) for seqid, contigs in self.samples if f"{seqid}" not in failed_ids]
+        LOGGER.warning(f"sistr results are missing for {len(failed)} samples, saved as {outfile}. The results of the other {len(self.samples)} samples will be collated. Type the failed samples again with stype run -c {outfile} --merge {self.outdir or '.'}")
+        if not self.samples:
+            LOGGER.critical(f"None of the samples have sistr results. Something has gone wrong with sistr. Please check all inputs and try again.")
+            raise SystemExit
+
     def _check_outputs(self):
         """
-        use inputs to check if files made
+        use inputs to check if files made. With partial, samples without results are
+        saved as a manifest instead of stopping the run
         """
         if self.run_type != 'batch':
-            self._check_output_file(f"{self.prefix}/sistr.csv")
+            self._check_output_file(pathlib.Path(self.outdir, self.prefix, 'sistr.csv'))
+        elif self.stream:
+            self._check_output_file(self.stream)
+            typed = set(read_stream(self.stream)['genome'].astype(str))
+            missing = [(seqid, contigs) for seqid, contigs in self.samples if f"{seqid}" not in typed]
+            if missing and self.partial:
+                self._failed_samples(missing)
+            elif missing:
+                LOGGER.critical(f"The sistr results of {len(missing)} samples ({', '.join(f'{seqid}' for seqid, contigs in missing[:10])}) are missing from {self.stream}. Something has gone wrong with sistr. Please check all inputs and try again.")
+                raise SystemExit
+        elif self.partial:
+            missing = [(seqid, contigs) for seqid, contigs in self.samples if not pathlib.Path(self.outdir, f"{seqid}", 'sistr.csv').exists()]
+            if missing:
+                self._failed_samples(missing)
         else:
-            tab = pandas.read_csv(self.input, sep = '\t', header = None)
-            for row in tab.iterrows():
-                self._check_output_file(f"{row[1][0]}/sistr.csv")
+            for seqid, contigs in self.samples:
+                self._check_output_file(pathlib.Path(self.outdir, f"{seqid}", 'sistr.csv'))
         return True
 
     def run(self):
         """
         run sistr
         """
-        cmd = self._generate_cmd()
-        LOGGER.info(f"You are running sistr in {self.run_type} mode. Now executing : {cmd}")
-        self._run_cmd(cmd)
-        self._check_outputs()
+        if self.cgmlst:
+            os.makedirs(pathlib.Path(self.outdir, CGMLST_DIR), exist_ok = True)
+        if self.run_type == 'batch':
+            LOGGER.info(f"You are running sistr in {self.run_type} mode.")
+            if self.stream:
+                LOGGER.info(f"sistr results will be appended to {self.stream} instead of a directory per sample.")
+                if self.journal is not None and self.journal.resumed:
+                    self._resume_stream()
+                else:
+                    # start a fresh stream for this run
+                    open(self.stream, 'w').close()
+            with stage('sistr'):
+                self._run_batch()
+        elif self._resumed(self.prefix, self.input):
+            LOGGER.info(f"{self.prefix} was typed by the interrupted run and has not changed, sistr will not be run again.")
+        else:
+            cmd = self._single_cmd()
+            LOGGER.info(f"You are running sistr in {self.run_type} mode. Now executing : {cmd}")
+            with stage('sistr'):
+                if self._run_cmd(cmd):
+                    self._record_sample(self.prefix, self.input)
+        timings.record(TIMINGS, self.timings)
+        with stage('check outputs'):
+            self._check_outputs()
+        if self.cgmlst:
+            with stage('cgmlst'):
+                self._store_profiles()
 
-        Data = collections.namedtuple('Data', ['run_type', 'input', 'prefix'])
-        sistr_data = Data(self.run_type, self.input, self.prefix)
+        Data = collections.namedtuple('Data', ['run_type', 'input', 'prefix', 'samples', 'stream', 'outdir', 'merge', 'runid', 'journal'])
+        sistr_data = Data(self.run_type, self.input, self.prefix, self.samples, self.stream, self.outdir, self.merge, self.runid, self.journal)
 
         return sistr_data
 
+
+
+class SetupWatch(SetupTyping):
+    """
+    Setup continuous typing of assemblies as they land in a directory
+    """
+    def __init__(self, args):
+
+        self.watch = args.dir
+        self.outfile = args.outfile
+        self.interval = args.interval
+        self.settle = args.settle
+        self.once = args.once
+        self.jobs = args.jobs
+        self.threads = args.threads
+        self.min_length = args.min_length
+        self.max_contigs = args.max_contigs
+        self.tmp_dir = args.tmp_dir
+
+    def setup(self):
+        """
+        Check the directory to watch and choose how many sistr jobs to keep running
+        """
+        LOGGER.info("Checking dependencies.")
+        self._check_deps()
+        if not pathlib.Path(self.watch).is_dir():
+            LOGGER.critical(f"{self.watch} is not a directory. Please check your input and try again.")
+            raise SystemExit
+        if self.tmp_dir and not pathlib.Path(self.tmp_dir).is_dir():
+            LOGGER.critical(f"{self.tmp_dir} is not a directory. Please check your input and try again.")
+            raise SystemExit
+        # the number of samples is not known in advance, so plan for a steady stream
+        jobs, threads = resources.plan_parallelism(
+            n_samples = resources.available_cores(),
+            jobs = self._parse_count(self.jobs),
+            threads = self._parse_count(self.threads)
+        )
+        LOGGER.info(f"Will keep up to {jobs} sistr job(s) with {threads} thread(s) each running on new assemblies in {self.watch}.")
+        Data = collections.namedtuple('Data', ['watch', 'outfile', 'interval', 'settle', 'once', 'jobs', 'threads', 'min_length', 'max_contigs', 'tmp_dir'])
+        return Data(self.watch, self.outfile, self.interval, self.settle, self.once, jobs, threads, self.min_length, self.max_contigs, self.tmp_dir)
+
+
+class WatchTyping(RunTyping):
+    """
+    Poll a directory for new assemblies and type each one as soon as it has finished
+    being written, with a bounded pool of sistr jobs. Results are handed to typer
+    (a styping.Parse.WatchSistr) which applies the rules and appends them to the rolling output.
+    """
+    def __init__(self, args, typer):
+
+        self.watch = args.watch
+        self.interval = args.interval
+        self.settle = args.settle
+        self.once = args.once
+        self.jobs = args.jobs
+        self.threads = args.threads
+        self.min_length = args.min_length
+        self.max_contigs = args.max_contigs
+        self.tmp_dir = args.tmp_dir
+        self.typer = typer
+        # results are read back from the directory of each sample by the typer
+        self.stream = ''
+        self.outdir = ''
+        # path -> (size, mtime) of every assembly already typed or rejected
+        self.seen = {}
+        # assemblies modified less than settle seconds ago at the last poll
+        self.unsettled = []
+        self.done = set(typer.typed())
+        self.timings = []
+        # the rolling output records what a restarted watch has already typed
+        self.journal = None
+        self.cgmlst = ''
+
+    def _scan(self, now = None):
+        """
+        assemblies that are new (or changed) and have not been modified for at least
+        settle seconds, so that files still being copied are left for the next poll
+        """
+        now = time.time() if now is None else now
+        ready = []
+        self.unsettled = []
+        for entry in sorted(os.scandir(self.watch), key = lambda e: e.name):
+            seqid = sample_id(entry.name)
+            if seqid is None or not entry.is_file():
+                continue
+            stat = entry.stat()
+            key = (stat.st_size, stat.st_mtime)
+            if self.seen.get(entry.path) == key:
+                continue
+            if now - stat.st_mtime < self.settle:
+                self.unsettled.append(entry.path)
+                continue
+            self.seen[entry.path] = key
+            if seqid in self.done:
+                LOGGER.debug("%s : already in the output, skipping %s", seqid, entry.path)
+                METRICS.lookup('watch', hits = 1)
+                continue
+            METRICS.lookup('watch', misses = 1)
+            ready.append((seqid, entry.path))
+        return ready
+
+    def _type_sample(self, seqid, contigs):
+        """
+        check, type and record a single assembly
+        """
+        stats, qc, reason = fasta.check(contigs, min_length = self.min_length, max_contigs = self.max_contigs)
+        if qc == 'REJECT':
+            LOGGER.warning(f"{seqid} ({contigs}) : {qc} - {reason}. It will not be typed.")
+            METRICS.reject(1, queued = True)
+            return False
+        if qc == 'FLAG':
+            LOGGER.warning(f"{seqid} ({contigs}) : {qc} - {reason}")
+        METRICS.started(1)
+        if not self._run_sample(seqid, contigs):
+            METRICS.finished([False])
+            return False
+        status = self.typer.record(seqid)
+        METRICS.finished([True])
+        self.done.add(seqid)
+        LOGGER.info(f"{seqid} typed : {status}")
+        return True
+
+    def _collect(self, pending, block = False):
+        """
+        drop finished jobs from pending, waiting for at least one if block is True
+        """
+        if block and pending:
+            wait(pending, return_when = FIRST_COMPLETED)
+        for future in [f for f in pending if f.done()]:
+            pending.remove(future)
+            if future.exception() is not None:
+                LOGGER.warning(f"A typing job failed : {future.exception()}")
+
+    def watch_dir(self):
+        """
+        type new assemblies until interrupted (or, with once, until the directory has been typed,
+        waiting for assemblies still being written to settle)
+        """
+        LOGGER.info(f"Watching {self.watch} for new assemblies every {self.interval} s. Results will be appended to {self.typer.outfile}.")
+        pending = set()
+        queue = collections.deque()
+        with ThreadPoolExecutor(max_workers = self.jobs) as pool:
+            try:
+                while True:
+                    ready = self._scan()
+                    METRICS.queue(len(ready))
+                    queue.extend(ready)
+                    # only hand the pool as many samples as it can start, so that the queue stays in order of arrival
+                    while queue and len(pending) < self.jobs:
+                        pending.add(pool.submit(self._type_sample, *queue.popleft()))
+                    if self.once and not queue:
+                        if not self.unsettled:
+                            break
+                        LOGGER.info(f"Waiting for {len(self.unsettled)} assemblies modified in the last {self.settle} s to settle : {', '.join(self.unsettled)}")
+                    if queue:
+                        self._collect(pending, block = True)
+                    else:
+                        time.sleep(self.interval)
+                        self._collect(pending)
+            except KeyboardInterrupt:
+                LOGGER.info(f"Stopping. Waiting for {len(pending)} running sistr job(s) to finish.")
+            self._collect(pending)
+            wait(pending)
+            self._collect(pending)
+        timings.record(TIMINGS, self.timings)
+        LOGGER.info(f"{len(self.done)} samples in {self.typer.outfile}.")
+        return self.done
@@ -1,29 +1,104 @@
-import pathlib, argparse, sys, os, logging
+import pathlib, argparse, sys, os, logging, datetime
 
-from styping.Typing import SetupTyping, RunTyping, SetupMDU
-from styping.Parse import ParseSistr, MduifySistr
+from styping.Typing import SetupTyping, RunTyping, SetupMDU, SetupVerify, SetupReplay, SetupWatch, WatchTyping, SetupPanel, SetupCgmlst, PANEL, CACHE, PRESCREEN_PANEL, CGMLST_STORE
+from styping.Parse import ParseSistr, MduifySistr, MduifyRuns, VerifySistr, ReplaySistr, WatchSistr, UrgentSistr, QueryCgmlst
 
+from styping.utils.fasta import MIN_TOTAL_LENGTH, MAX_CONTIGS
+from styping.utils.prescreen import SKETCH_SIZE, KMER_SIZE
+from styping.utils.files import run_directory
+from styping.utils.manifest import FORMATS
+from styping.utils.profile import PROFILER, stage
+from styping.utils.metrics import METRICS
+from styping.CustomLog import setup_logging, stop_logging
 from styping.version import __version__
 
+# handlers are set up per run by styping.CustomLog.setup_logging
+LOGGER = logging.getLogger(__name__)
+
 """
 abritamr is designed to implement AMRFinder and parse the results compatible for MDU use. It may also be used for other purposes where the format of output is compatible
 
 """
 
 def run_pipeline(args):
-    P = SetupTyping(args)
-    input_data = P.setup()
-    T = RunTyping(input_data)
-    sistr_data = T.run()
-    P = ParseSistr(sistr_data)
-    collated_data = P.parse()
+    if args.dry_run:
+        with stage('plan'):
+            SetupTyping(args).plan()
+        return
+    with stage('setup'):
+        P = SetupTyping(args)
+        input_data = P.setup()
+    with stage('run'):
+        # urgent samples are collated as soon as they have finished
+        T = RunTyping(input_data, UrgentSistr(input_data) if input_data.priority else None)
+        sistr_data = T.run()
+    journal = sistr_data.journal
+    with stage('parse'):
+        P = ParseSistr(sistr_data)
+        inputs, outputs = P.artifacts()
+        if journal.completed('parse', inputs, outputs):
+            LOGGER.info(f"The results were collated by the interrupted run and have not changed since, they will not be collated again.")
+            collated_data = None
+        else:
+            collated_data = P.parse()
+            journal.record_stage('parse', inputs, outputs)
+    if sistr_data.runid:
+        # the typed table goes straight to the spreadsheet
+        with stage('mdu'):
+            M = MduifySistr(sistr_data)
+            inputs, outputs = {'filtered': outputs['filtered']}, {'sheet': M.outfile(sistr_data.runid)}
+            if journal.completed(f"mdu {sistr_data.runid}", inputs, outputs):
+                LOGGER.info(f"The spreadsheet was made by the interrupted run and has not changed since, it will not be made again.")
+            else:
+                M.mduify(tab = P.read_filtered() if collated_data is None else collated_data)
+                journal.record_stage(f"mdu {sistr_data.runid}", inputs, outputs)
     
 
 def mdu(args):
-    M = SetupMDU(args)
-    input_data = M.setup()
-    P = MduifySistr(input_data)
-    collated_data = P.mduify()
+    with stage('mdu'):
+        M = SetupMDU(args)
+        input_data = M.setup()
+        P = MduifyRuns(input_data) if input_data.runs else MduifySistr(input_data)
+        collated_data = P.mduify()
+
+
+def verify(args):
+    with stage('verify'):
+        V = SetupVerify(args)
+        input_data = V.setup()
+        P = VerifySistr(input_data)
+        report = P.verify()
+
+
+def replay(args):
+    with stage('replay'):
+        R = SetupReplay(args)
+        input_data = R.setup()
+        P = ReplaySistr(input_data)
+        summary = P.replay()
+
+
+def watch(args):
+    with stage('watch'):
+        W = SetupWatch(args)
+        input_data = W.setup()
+        P = WatchSistr(input_data)
+        T = WatchTyping(input_data, P)
+        typed = T.watch_dir()
+
+
+def panel(args):
+    with stage('panel'):
+        P = SetupPanel(args)
+        panel = P.build()
+
+
+def neighbours(args):
+    with stage('cgmlst'):
+        C = SetupCgmlst(args)
+        input_data = C.setup()
+        Q = QueryCgmlst(input_data)
+        tab = Q.query()
 
 
 def set_parsers():
@@ -32,13 +107,57 @@ def set_parsers():
     )
     parser.add_argument('-v', '--version', action='version', version='%(prog)s ' + __version__)
     
+    logging_parser = argparse.ArgumentParser(add_help=False)
+    logging_parser.add_argument(
+        "--log",
+        default="",
+        help="Path to the log file for this run. Defaults to stype_<date>_<time>_<pid>.log so that concurrent runs do not share a log.",
+    )
+    logging_parser.add_argument(
+        "--debug",
+        action="store_true",
+        help="Log debug messages, including per-sample progress.",
+    )
+    logging_parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Record wall time, CPU time and peak memory of each stage and save them next to the log as <log>.profile.csv.",
+    )
+    logging_parser.add_argument(
+        "--flamegraph",
+        action="store_true",
+        help="With --profile, also save the wall time of each stage as folded stacks (<log>.folded) for flamegraph.pl, inferno or speedscope.",
+    )
+    logging_parser.add_argument(
+        "--metrics",
+        default="",
+        help="Write queue, job, stage, cache and STATUS metrics in the Prometheus text format to this file while stype runs (e.g. /var/lib/node_exporter/textfile/stype.prom, for node_exporter's textfile collector).",
+    )
+
     subparsers = parser.add_subparsers(help="Task to perform")
-    parser_sub_run = subparsers.add_parser('run', help='Run salmonella typing', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_sub_run = subparsers.add_parser('run', help='Run salmonella typing', formatter_class=argparse.ArgumentDefaultsHelpFormatter, parents=[logging_parser])
     parser_sub_run.add_argument(
         "--contigs",
         "-c",
         default="",
-        help="Tab-delimited file with sample ID as column 1 and path to assemblies as column 2 OR path to a contig file (used if only doing a single sample - should provide value for -pfx). ",
+        help="Manifest with sample ID as column 1 and path to assemblies as column 2 (tab-delimited, csv or parquet), a directory or quoted glob of assemblies, OR path to a contig file (used if only doing a single sample - should provide value for -pfx). Assemblies may be plain, gzip, bgzip or zstd compressed FASTA.",
+    )
+    parser_sub_run.add_argument(
+        "--manifest-format",
+        default="auto",
+        choices=FORMATS,
+        help="Format of the manifest given to --contigs. If 'auto', guessed from its name (a directory or glob, .parquet, .csv, anything else tab-delimited).",
+    )
+    parser_sub_run.add_argument(
+        "--id-pattern",
+        default="",
+        help="With a directory or glob of assemblies, regular expression giving the sample ID from the path of each file below the directory the glob starts from, e.g. S1/contigs.fa for runs/*/contigs.fa (its group 'id', else its first group, else the whole match). Files that do not match are ignored, and files whose ID is already taken are skipped. Defaults to the file name without its FASTA and compression suffixes.",
+    )
+    parser_sub_run.add_argument(
+        "--window",
+        default=1000,
+        type=int,
+        help="In batch mode, number of samples read from the manifest, scanned and ordered largest first at a time. Typing starts once the first window has been scanned.",
     )
     parser_sub_run.add_argument(
         "--prefix",
@@ -48,10 +167,87 @@ def set_parsers():
     )
     
     parser_sub_run.add_argument(
-        "--jobs", "-j", default=16, help="Number of AMR finder jobs to run in parallel."
+        "--outdir",
+        "-o",
+        default="",
+        help="Directory for the results and log of this run. Defaults to a new stype_<date>_<time>_<pid> directory, so that runs started from the same directory never overwrite each other. Use . for the current directory.",
     )
-    
-    parser_mdu = subparsers.add_parser('mdu', help='Finalise styping results for MDU service', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_sub_run.add_argument(
+        "--jobs", "-j", default="auto", help="Number of sistr jobs to run in parallel. If 'auto', chosen from the cores and memory available."
+    )
+    parser_sub_run.add_argument(
+        "--threads", "-t", default="auto", help="Number of threads for each sistr job. If 'auto', spare cores are shared between jobs."
+    )
+    parser_sub_run.add_argument(
+        "--min-length", default=MIN_TOTAL_LENGTH, type=int, help="Assemblies shorter than this (bp) are not typed."
+    )
+    parser_sub_run.add_argument(
+        "--max-contigs", default=MAX_CONTIGS, type=int, help="Assemblies with more contigs than this are not typed."
+    )
+    parser_sub_run.add_argument(
+        "--tmp-dir",
+        default="",
+        help="Directory for the temporary files of each sistr job, including decompressed assemblies (e.g. /dev/shm to keep them in memory). Defaults to the system temporary directory.",
+    )
+    parser_sub_run.add_argument(
+        "--stream",
+        default="",
+        help="In batch mode, append the sistr results of every sample to this JSON lines file instead of writing a directory per sample (e.g. sistr_results.jsonl).",
+    )
+    parser_sub_run.add_argument(
+        "--batch-size",
+        "-b",
+        default=1,
+        type=int,
+        help="In batch mode, number of samples typed by each sistr call, so that sistr loads its databases once per group rather than once per sample. Samples of a group that fails are retried one at a time.",
+    )
+    parser_sub_run.add_argument(
+        "--partial",
+        action="store_true",
+        help="In batch mode, collate the samples that sistr typed even if some failed, and save the failed samples as a manifest in the format of the input (failed_samples.txt, .csv or .parquet) to type them again.",
+    )
+    parser_sub_run.add_argument(
+        "--merge",
+        default="",
+        help="In batch mode, merge the results with those of an earlier run (its sistr_filtered.csv or its directory), e.g. when typing the failed samples of that run again. Results of this run replace those of the same samples.",
+    )
+    parser_sub_run.add_argument(
+        "--mdu",
+        action="store_true",
+        help="Also make the spreadsheet for the MDU LIMS (<RUNID>_sistr.xlsx in the run directory) from the typed results, as stype mdu would.",
+    )
+    parser_sub_run.add_argument(
+        "--runid",
+        "-r",
+        default="",
+        help="MDU RunID, used with --mdu",
+    )
+    parser_sub_run.add_argument(
+        "--cgmlst-store",
+        nargs="?",
+        default="",
+        const=f"{CGMLST_STORE}",
+        help=f"Keep the cgMLST allele profile of each sample typed (in cgmlst_profiles in the run directory) and add them to a profile store ({CGMLST_STORE} if no path is given), to find their nearest neighbours with stype neighbours.",
+    )
+    parser_sub_run.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume the interrupted run in --outdir from its journal (stype_journal.jsonl). Samples and stages completed by that run are not run again, unless their inputs or outputs have changed since.",
+    )
+    parser_sub_run.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Do not type anything. Predict the wall time, core-hours and peak memory of the run from the timings of earlier sistr calls on this host, and suggest the number of jobs with the shortest wall time once timings with different numbers of threads have been recorded (plans saved as dry_run.csv).",
+    )
+    parser_sub_run.add_argument(
+        "--prescreen",
+        nargs="?",
+        default="",
+        const=f"{PRESCREEN_PANEL}",
+        help=f"Compare k-mer sketches of the assemblies with a panel of reference sketches (built with stype panel, {PRESCREEN_PANEL} if no path is given) and save preliminary serovars in prescreen.csv before sistr starts. sistr is still run on every sample.",
+    )
+
+    parser_mdu = subparsers.add_parser('mdu', help='Finalise styping results for MDU service', formatter_class=argparse.ArgumentDefaultsHelpFormatter, parents=[logging_parser])
     
     parser_mdu.add_argument(
         "--runid",
@@ -62,14 +258,172 @@ def set_parsers():
     parser_mdu.add_argument(
         "--sistr",
         "-s",
-        default=f"sistr_concatenated.csv",
-        help="Path to concatentated output of sistr",
+        default="",
+        help="Typed results of the run: its directory (stype_<date>_<time>_<pid> by default), its sistr_filtered.csv or the sistr_filtered.csv files of several samples concatenated",
+    )
+    parser_mdu.add_argument(
+        "--runs",
+        default="",
+        help="Make the spreadsheets of many runs at once, from a tab separated file of run IDs and their results (sistr_filtered.csv or run directory), or from a results store (typed results of many runs with a runid column). --runid and --sistr are ignored.",
+    )
+    parser_mdu.add_argument(
+        "--jobs", "-j", default="auto", help="Number of worker processes writing spreadsheets with --runs. If 'auto', one per core."
+    )
+    parser_mdu.add_argument(
+        "--outdir", "-o", default=".", help="Directory to save the spreadsheets in"
     )
     
     
     
+    parser_verify = subparsers.add_parser('verify', help='Re-verify the current rules and filters against cached sistr results for the reference panel', formatter_class=argparse.ArgumentDefaultsHelpFormatter, parents=[logging_parser])
+    parser_verify.add_argument(
+        "--sistr",
+        "-s",
+        default="",
+        help="Concatenated sistr output, or directory of <sample>/sistr.csv, for the panel. If given, the cache is rebuilt from it.",
+    )
+    parser_verify.add_argument(
+        "--cache",
+        default=f"{CACHE}",
+        help="Directory where the panel sistr results are cached (or set STYPING_CACHE)",
+    )
+    parser_verify.add_argument(
+        "--panel",
+        "-p",
+        default=f"{PANEL}",
+        help="Panel of expected serovars",
+    )
+    parser_verify.add_argument(
+        "--outfile",
+        "-o",
+        default="verify_report.csv",
+        help="Concordance report",
+    )
+
+    parser_replay = subparsers.add_parser('replay', help='Replay stored sistr results through old and new rules and filters and report changed calls', formatter_class=argparse.ArgumentDefaultsHelpFormatter, parents=[logging_parser])
+    parser_replay.add_argument(
+        "--sistr",
+        "-s",
+        nargs="+",
+        required=True,
+        help="Stored sistr results (concatenated or filtered sistr csv files, globs allowed)",
+    )
+    parser_replay.add_argument(
+        "--old-rules", default="", help="Path to the old rules.py. Defaults to the installed rules."
+    )
+    parser_replay.add_argument(
+        "--old-filters", default="", help="Path to the old filters.py. Defaults to the installed filters."
+    )
+    parser_replay.add_argument(
+        "--new-rules", default="", help="Path to the new rules.py. Defaults to the installed rules."
+    )
+    parser_replay.add_argument(
+        "--new-filters", default="", help="Path to the new filters.py. Defaults to the installed filters."
+    )
+    parser_replay.add_argument(
+        "--jobs", "-j", default="auto", help="Number of worker processes. If 'auto', one per core."
+    )
+    parser_replay.add_argument(
+        "--chunksize", default=50000, type=int, help="Number of rows given to a worker at a time"
+    )
+    parser_replay.add_argument(
+        "--outfile", "-o", default="replay_changes.csv", help="Rows whose STATUS or serovar changed"
+    )
+    parser_replay.add_argument(
+        "--summary", default="replay_summary.csv", help="Number of samples for each old and new STATUS"
+    )
+
+    parser_watch = subparsers.add_parser('watch', help='Type assemblies as they are written to a directory and append the results to a rolling output', formatter_class=argparse.ArgumentDefaultsHelpFormatter, parents=[logging_parser])
+    parser_watch.add_argument(
+        "--dir",
+        "-d",
+        required=True,
+        help="Directory to watch for assemblies (.fa, .fasta, .fna, .fas or .contigs, optionally .gz, .bgz or .zst). The sample ID is the file name without these suffixes.",
+    )
+    parser_watch.add_argument(
+        "--outfile",
+        "-o",
+        default="sistr_watch.csv",
+        help="Rolling output, one row per sample appended as soon as it is typed. Samples already in it are not typed again.",
+    )
+    parser_watch.add_argument(
+        "--interval", default=30, type=float, help="Seconds between checks for new assemblies"
+    )
+    parser_watch.add_argument(
+        "--settle", default=10, type=float, help="Seconds an assembly must be left unchanged before it is typed, so that files still being written are not picked up"
+    )
+    parser_watch.add_argument(
+        "--once", action="store_true", help="Type the assemblies already in the directory and exit, instead of watching until interrupted"
+    )
+    parser_watch.add_argument(
+        "--jobs", "-j", default="auto", help="Maximum number of sistr jobs to run at once. If 'auto', chosen from the cores and memory available."
+    )
+    parser_watch.add_argument(
+        "--threads", "-t", default="auto", help="Number of threads for each sistr job. If 'auto', spare cores are shared between jobs."
+    )
+    parser_watch.add_argument(
+        "--min-length", default=MIN_TOTAL_LENGTH, type=int, help="Assemblies shorter than this (bp) are not typed."
+    )
+    parser_watch.add_argument(
+        "--max-contigs", default=MAX_CONTIGS, type=int, help="Assemblies with more contigs than this are not typed."
+    )
+    parser_watch.add_argument(
+        "--tmp-dir", default="", help="Directory for the temporary files of each sistr job. Defaults to the system temporary directory."
+    )
+
+    parser_panel = subparsers.add_parser('panel', help='Build the panel of reference sketches used by the k-mer pre-screen', formatter_class=argparse.ArgumentDefaultsHelpFormatter, parents=[logging_parser])
+    parser_panel.add_argument(
+        "--references",
+        "-r",
+        required=True,
+        help="Tab-delimited file with serovar as column 1 and path to a reference assembly as column 2. A serovar may have several references.",
+    )
+    parser_panel.add_argument(
+        "--panel", "-p", default=f"{PRESCREEN_PANEL}", help="Where to save the panel"
+    )
+    parser_panel.add_argument(
+        "--size", default=SKETCH_SIZE, type=int, help="Number of hashes kept in each sketch"
+    )
+    parser_panel.add_argument(
+        "--k", default=KMER_SIZE, type=int, help="k-mer size"
+    )
+    parser_panel.add_argument(
+        "--jobs", "-j", default="auto", help="Number of references sketched in parallel. If 'auto', one per core."
+    )
+
+    parser_neighbours = subparsers.add_parser('neighbours', help='Find the nearest neighbours of samples by their cgMLST profiles among the samples in a profile store', formatter_class=argparse.ArgumentDefaultsHelpFormatter, parents=[logging_parser])
+    parser_neighbours.add_argument(
+        "--store", default=f"{CGMLST_STORE}", help="Profile store made by stype run --cgmlst-store"
+    )
+    parser_neighbours.add_argument(
+        "--profiles", "-p", nargs="+", default=[], help="cgMLST profiles to query, as written by sistr --cgmlst-profiles, or run directories of stype run --cgmlst-store"
+    )
+    parser_neighbours.add_argument(
+        "--samples", "-s", nargs="+", default=[], help="IDs of samples in the store to query, if --profiles is not given"
+    )
+    parser_neighbours.add_argument(
+        "--k", "-k", default=10, type=int, help="Number of nearest neighbours of each sample"
+    )
+    parser_neighbours.add_argument(
+        "--max-distance", default=None, type=int, help="Only report neighbours whose alleles differ at no more than this many loci"
+    )
+    parser_neighbours.add_argument(
+        "--pairwise", default="", help="Also save the distances between every pair of samples queried to this file"
+    )
+    parser_neighbours.add_argument(
+        "--jobs", "-j", default="auto", help="Number of threads comparing profiles. If 'auto', one per core."
+    )
+    parser_neighbours.add_argument(
+        "--outfile", "-o", default="cgmlst_neighbours.csv", help="Nearest neighbours of each sample"
+    )
+
     parser_sub_run.set_defaults(func=run_pipeline)
     parser_mdu.set_defaults(func = mdu)
+    parser_verify.set_defaults(func = verify)
+    parser_replay.set_defaults(func = replay)
+    parser_watch.set_defaults(func = watch)
+    parser_panel.set_defaults(func = panel)
+    parser_neighbours.set_defaults(func = neighbours)
     args = parser.parse_args()
     return args
 
@@ -83,7 +437,33 @@ def main():
     if vars(args) == {}:
         parser.print_help(sys.stderr)
     else:
-        args.func(args)
+        logfile = args.log if args.log else f"stype_{datetime.datetime.now():%Y%m%d_%H%M%S}_{os.getpid()}.log"
+        if args.func == run_pipeline:
+            # each run gets its own directory, which also holds its log
+            args.outdir = f"{run_directory(args.outdir)}"
+            logfile = args.log if args.log else f"{pathlib.Path(args.outdir, 'stype.log')}"
+        setup_logging(logfile, debug = args.debug)
+        # stage times of the metrics come from the profiler
+        if args.profile or args.metrics:
+            PROFILER.start()
+        if args.metrics:
+            # each run is labelled, so runs sharing a node_exporter do not clash
+            run = pathlib.Path(args.outdir).resolve().name if args.func == run_pipeline else pathlib.Path(logfile).stem
+            METRICS.start(args.metrics, command = args.func.__name__, run = run)
+        try:
+            args.func(args)
+        finally:
+            if args.metrics:
+                METRICS.stop()
+                logging.getLogger('styping').info(f"Metrics of this run saved as {args.metrics}")
+            if args.profile or args.metrics:
+                PROFILER.stop()
+            if args.profile:
+                report = f"{pathlib.Path(logfile).with_suffix('')}.profile.csv"
+                folded = f"{pathlib.Path(logfile).with_suffix('')}.folded" if args.flamegraph else None
+                PROFILER.write(report, folded)
+                logging.getLogger('styping').info(f"Profile of this run saved as {report}" + (f" and {folded}" if folded else ""))
+            stop_logging()
     
 
 if __name__ == "__main__":
@@ -0,0 +1,234 @@
+'''
+A store of the cgMLST allele profiles of typed samples, and nearest-neighbour
+search over it.
+
+With --cgmlst-profiles, sistr writes the allele of each of the 330 cgMLST loci
+for every genome it types. stype run --cgmlst-store keeps these profiles in a
+store shared by the runs on the host, so that new isolates can be placed
+against every sample typed before (e.g. to find outbreak clusters) without
+rebuilding the profiles with separate tools. The store is a directory holding
+
+- loci.txt: the loci, in the order of the columns of the matrix
+- samples.csv: the sample ID, run and date of each row of the matrix
+- profiles.u32: the allele of each locus of each sample, a row-major matrix of uint32
+
+The matrix is read as a numpy memmap, so only the pages of the profiles being
+compared are read from disk, and it is appended to under a lock, so several
+runs can add to the store at once. Alleles are kept as integers (the allele
+names sistr reports), 0 standing for a missing allele.
+
+The distance between two profiles is the number of loci where both have an
+allele and the alleles differ. Distances are computed in tiles of queries and
+profiles of about TILE_BYTES, the tiles being shared between threads (numpy
+releases the GIL while it compares them).
+'''
+
+import concurrent.futures
+import datetime
+import os
+import pathlib
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from styping.utils.files import locked
+
+PROFILES = 'profiles.u32'
+SAMPLES = 'samples.csv'
+LOCI = 'loci.txt'
+SAMPLE_COLUMNS = ['ID', 'run', 'date']
+# allele of a locus without a call
+MISSING = 0
+# stands for a missing allele of a query, so that it never matches an allele of the store
+QUERY_MISSING = np.iinfo(np.uint32).max
+# approximate size of the comparisons made at once by each thread (bytes)
+TILE_BYTES = 32 * 1024 ** 2
+# queries compared with a tile of profiles at once
+QUERY_BLOCK = 256
+
+
+def read_profiles(paths):
+    '''
+    read the cgMLST profiles written by sistr (one row per genome, one column per locus) into one table indexed by sample ID
+    '''
+    tables = [pd.read_csv(path, index_col=0, dtype=str) for path in paths if os.path.getsize(path) > 0]
+    if not tables:
+        return pd.DataFrame()
+    tab = pd.concat(tables)
+    tab.index = tab.index.astype(str)
+    return tab
+
+
+def encode(tab, loci=None):
+    '''
+    alleles of a table of profiles as a uint32 matrix with columns in the order of loci. Alleles that are
+    not integers between 1 and 2^32 - 2 (e.g. novel alleles named by a hash) are given a checksum of their name
+
+    >>> encode(pd.DataFrame({'a': ['12', None], 'b': ['7', '-']})).tolist()
+    [[12, 7], [0, 0]]
+    '''
+    if loci is not None:
+        tab = tab.reindex(columns=loci)
+    values = tab.to_numpy(dtype=object).ravel()
+    codes, uniques = pd.factorize(values)
+    encoded = np.zeros(len(uniques), dtype=np.uint32)
+    for i, allele in enumerate(uniques):
+        name = f"{allele}".strip()
+        if name in ('', '-', '?', 'nan'):
+            continue
+        try:
+            number = int(float(name))
+        except ValueError:
+            number = -1
+        if not 0 < number < QUERY_MISSING:
+            number = zlib.crc32(name.encode()) % (QUERY_MISSING - 1) + 1
+        encoded[i] = number
+    matrix = np.where(codes >= 0, encoded[np.maximum(codes, 0)] if len(encoded) else MISSING, MISSING)
+    return matrix.astype(np.uint32).reshape(tab.shape)
+
+
+class ProfileStore:
+    '''
+    cgMLST allele profiles of the samples typed, in a directory shared by the runs on the host
+    '''
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self._load()
+
+    def _load(self):
+        loci = self.path / LOCI
+        samples = self.path / SAMPLES
+        self.loci = loci.read_text().split() if loci.exists() else []
+        if samples.exists() and samples.stat().st_size > 0:
+            self.samples = pd.read_csv(samples, dtype={'ID': str, 'run': str})
+        else:
+            self.samples = pd.DataFrame(columns=SAMPLE_COLUMNS)
+
+    def add(self, tab, run=''):
+        '''
+        append the profiles of a table (indexed by sample ID, one column per locus) to the store, return the number added
+        '''
+        if tab.empty:
+            return 0
+        self.path.mkdir(parents=True, exist_ok=True)
+        with locked(self.path / PROFILES):
+            self._load()
+            if not self.loci:
+                self.loci = sorted(tab.columns)
+                (self.path / LOCI).write_text('\n'.join(self.loci) + '\n')
+            extra = set(tab.columns) - set(self.loci)
+            if extra:
+                raise ValueError(f"{len(extra)} loci of the profiles (e.g. {sorted(extra)[0]}) are not in the store {self.path}")
+            matrix = encode(tab, self.loci)
+            profiles = self.path / PROFILES
+            with open(profiles, 'ab') as f:
+                # drop any rows of a run that stopped between writing its profiles and its samples
+                f.truncate(len(self.samples) * len(self.loci) * 4)
+                f.write(matrix.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            samples = pd.DataFrame({'ID': tab.index.astype(str), 'run': run, 'date': datetime.datetime.now().isoformat(timespec='seconds')})
+            samples.to_csv(self.path / SAMPLES, mode='a', header=len(self.samples) == 0, index=False)
+            self.samples = pd.concat([self.samples, samples], ignore_index=True)
+        return len(tab)
+
+    def matrix(self):
+        '''
+        the profiles of the store as a read-only memmap (samples x loci)
+        '''
+        if len(self.samples) == 0:
+            return np.zeros((0, len(self.loci)), dtype=np.uint32)
+        return np.memmap(self.path / PROFILES, dtype=np.uint32, mode='r', shape=(len(self.samples), len(self.loci)))
+
+    def latest(self):
+        '''
+        rows of the store holding the latest profile of each sample, as samples typed again are added again
+        '''
+        return np.flatnonzero(~self.samples['ID'].duplicated(keep='last').to_numpy())
+
+
+def _tile(queries, present, profiles):
+    '''
+    distances and loci shared between a block of queries (missing alleles as QUERY_MISSING) and a tile of profiles
+    '''
+    shared = present @ (profiles != MISSING).T.astype(np.float32)
+    equal = (queries[:, None, :] == profiles[None, :, :]).sum(axis=2, dtype=np.int32)
+    shared = shared.astype(np.int32)
+    return shared - equal, shared
+
+
+def _blocks(queries, profiles, tile_bytes):
+    q = np.where(queries == MISSING, QUERY_MISSING, queries).astype(np.uint32)
+    present = (queries != MISSING).astype(np.float32)
+    block = max(1, tile_bytes // max(1, min(len(q), QUERY_BLOCK) * max(1, q.shape[1])))
+    return q, present, [(start, min(start + block, len(profiles))) for start in range(0, len(profiles), block)]
+
+
+def _compare(q, present, profiles, start, stop):
+    tile = np.asarray(profiles[start:stop])
+    if len(q) == 0:
+        return np.zeros((0, stop - start), dtype=np.int32), np.zeros((0, stop - start), dtype=np.int32)
+    distances, shared = [], []
+    for i in range(0, len(q), QUERY_BLOCK):
+        d, s = _tile(q[i:i + QUERY_BLOCK], present[i:i + QUERY_BLOCK], tile)
+        distances.append(d)
+        shared.append(s)
+    return np.vstack(distances), np.vstack(shared)
+
+
+def hamming(queries, profiles, jobs=1, tile_bytes=TILE_BYTES):
+    '''
+    distance (loci where both have an allele and they differ) between each query and each profile
+
+    >>> hamming(np.array([[1, 2, 0]], dtype=np.uint32), np.array([[1, 2, 3], [1, 5, 0], [0, 0, 0]], dtype=np.uint32)).tolist()
+    [[0, 1, 0]]
+    '''
+    q, present, blocks = _blocks(queries, profiles, tile_bytes)
+    distances = np.zeros((len(q), len(profiles)), dtype=np.int32)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        for (start, stop), (d, s) in zip(blocks, pool.map(lambda b: _compare(q, present, profiles, *b), blocks)):
+            distances[:, start:stop] = d
+    return distances
+
+
+def nearest(queries, profiles, k=10, jobs=1, exclude=None, tile_bytes=TILE_BYTES):
+    '''
+    the k profiles closest to each query: (rows, distances, shared loci), each queries x k, closest first and
+    fewest shared loci breaking ties last. Rows are -1 where there are fewer than k profiles. exclude holds,
+    for each query, a row of profiles it is not compared with (e.g. itself), or -1
+
+    >>> rows, distances, shared = nearest(np.array([[1, 2, 3]], dtype=np.uint32), np.array([[1, 2, 3], [1, 5, 3], [1, 2, 0]], dtype=np.uint32), k=2)
+    >>> rows.tolist(), distances.tolist(), shared.tolist()
+    ([[0, 2]], [[0, 0]], [[3, 2]])
+    '''
+    q, present, blocks = _blocks(queries, profiles, tile_bytes)
+    exclude = np.full(len(q), -1) if exclude is None else np.asarray(exclude)
+    worst = np.iinfo(np.int32).max
+
+    def candidates(block):
+        start, stop = block
+        d, s = _compare(q, present, profiles, start, stop)
+        rows = np.arange(start, stop)
+        d[rows[None, :] == exclude[:, None]] = worst
+        keep = min(k, stop - start)
+        # order by distance, then by most loci shared
+        score = d.astype(np.int64) * 1024 - s
+        top = np.argpartition(score, keep - 1, axis=1)[:, :keep] if keep < stop - start else np.broadcast_to(np.arange(stop - start), (len(q), stop - start))
+        return rows[top], np.take_along_axis(d, top, axis=1), np.take_along_axis(s, top, axis=1)
+
+    found = [np.zeros((len(q), 0), dtype=np.int64), np.zeros((len(q), 0), dtype=np.int32), np.zeros((len(q), 0), dtype=np.int32)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        for result in pool.map(candidates, blocks):
+            found = [np.hstack([f, r]) for f, r in zip(found, result)]
+    rows, distances, shared = found
+    order = np.lexsort((-shared, distances), axis=1)[:, :k] if rows.shape[1] else np.zeros((len(q), 0), dtype=np.int64)
+    rows, distances, shared = (np.take_along_axis(a, order, axis=1) for a in (rows, distances, shared))
+    rows = np.where(distances == worst, -1, rows)
+    if rows.shape[1] < k:
+        pad = k - rows.shape[1]
+        rows = np.hstack([rows, np.full((len(q), pad), -1)])
+        distances = np.hstack([distances, np.full((len(q), pad), worst, dtype=np.int32)])
+        shared = np.hstack([shared, np.zeros((len(q), pad), dtype=np.int32)])
+    return rows, distances, shared
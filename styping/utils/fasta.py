@@ -0,0 +1,305 @@
+'''
+A fast pre-flight scanner for assemblies.
+
+Each assembly is memory-mapped and split into records on the "\n>" that
+starts every header, so sequence lines are never handled one by one in
+Python. For every assembly we report the number of contigs, total length,
+N50 and the number of characters that are not IUPAC nucleotide codes, and
+decide if the assembly should be typed (PASS), typed with a warning (FLAG)
+or not typed at all (REJECT).
+
+Assemblies compressed with gzip, bgzip or zstd are recognised by their magic
+bytes and scanned as a stream, without writing the decompressed data to disk.
+'''
+
+import collections
+import contextlib
+import gzip
+import mmap
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# errors raised reading a truncated or corrupt assembly, which is rejected rather than stopping the run
+READ_ERRORS = (OSError, EOFError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+# gzip and bgzip share the same magic bytes
+MAGIC = {
+    b'\x1f\x8b': 'gzip',
+    b'\x28\xb5\x2f\xfd': 'zstd'
+}
+# shell commands to decompress to stdout
+DECOMPRESS = {
+    'gzip': 'gzip -dc',
+    'zstd': 'zstd -dc'
+}
+# bytes read at a time when scanning a compressed assembly
+CHUNK_SIZE = 16 * 1024 ** 2
+
+# IUPAC nucleotide codes, gaps and line endings are allowed in a sequence
+VALID = b'ACGTURYSWKMBDHVNacgturyswkmbdhvn-\n\r'
+# characters counted as gaps by seqkit stats
+GAPS = b'-. '
+
+# assemblies outside these bounds are not worth sending to sistr
+MIN_TOTAL_LENGTH = 100000
+MAX_CONTIGS = 5000
+# assemblies outside these bounds are typed, but flagged for review
+EXPECTED_LENGTH = (4000000, 6000000)
+EXPECTED_CONTIGS = 500
+
+AssemblyStats = collections.namedtuple('AssemblyStats', ['contigs', 'total_length', 'min_length', 'max_length', 'n50', 'invalid_characters', 'empty_contigs'])
+
+COLUMNS = ['ID', 'path'] + list(AssemblyStats._fields) + ['QC', 'QC_REASON']
+
+
+def n50(lengths):
+    '''
+    N50 of a list of contig lengths
+
+    >>> n50([10, 20, 30, 40])
+    30
+    >>> n50([])
+    0
+    '''
+    total = sum(lengths)
+    running = 0
+    for length in sorted(lengths, reverse=True):
+        running += length
+        if 2 * running >= total:
+            return length
+    return 0
+
+
+def compression(path):
+    '''
+    Return the compression of a file (gzip or zstd), None if not compressed
+    '''
+    with open(path, 'rb') as f:
+        head = f.read(4)
+    for magic, name in MAGIC.items():
+        if head.startswith(magic):
+            return name
+    return None
+
+
+@contextlib.contextmanager
+def open_compressed(path, method):
+    '''
+    Open a compressed file as a binary stream of its decompressed content.
+    zstd uses the zstandard package if installed, otherwise the zstd command
+    '''
+    if method == 'gzip':
+        with gzip.open(path, 'rb') as f:
+            yield f
+    elif zstandard is not None:
+        with open(path, 'rb') as raw, zstandard.ZstdDecompressor().stream_reader(raw) as f:
+            yield f
+    else:
+        p = subprocess.Popen(['zstd', '-dc', path], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            yield p.stdout
+        finally:
+            p.stdout.close()
+            p.wait()
+        if p.returncode != 0:
+            raise OSError(f"zstd could not decompress {path}")
+
+
+def _record_lengths(data):
+    '''
+    Yield the sequence length, number of invalid characters and number of gaps
+    of every record in a FASTA held in a bytes-like object that starts with ">"
+    '''
+    start = 0
+    end = len(data)
+    while start < end:
+        header_end = data.find(b'\n', start)
+        if header_end == -1:
+            # header with no sequence at the end of the file
+            yield 0, 0, 0
+            return
+        next_header = data.find(b'\n>', header_end)
+        seq_end = end if next_header == -1 else next_header + 1
+        seq = data[header_end + 1:seq_end]
+        length = len(seq) - seq.count(b'\n') - seq.count(b'\r')
+        gaps = sum(seq.count(bytes([g])) for g in GAPS)
+        yield length, len(seq.translate(None, VALID)), gaps
+        start = seq_end
+
+
+def _scan_stream(stream):
+    '''
+    Scan a binary stream of FASTA in chunks. Only complete records are scanned,
+    the incomplete record at the end of a chunk is carried over to the next.
+    '''
+    leftover = stream.read(CHUNK_SIZE)
+    if leftover[:1] != b'>':
+        return None
+    lengths = []
+    invalid = 0
+    gaps = 0
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        data = leftover + chunk
+        if not chunk:
+            break
+        last = data.rfind(b'\n>')
+        if last == -1:
+            leftover = data
+            continue
+        for length, bad, gap in _record_lengths(data[:last + 1]):
+            lengths.append(length)
+            invalid += bad
+            gaps += gap
+        leftover = data[last + 1:]
+    for length, bad, gap in _record_lengths(data):
+        lengths.append(length)
+        invalid += bad
+        gaps += gap
+    return lengths, invalid, gaps
+
+
+def scan_lengths(path):
+    '''
+    Return the list of contig lengths, the number of invalid characters and
+    the number of gaps of a FASTA file, None if the file is empty or not a FASTA
+    '''
+    method = compression(path)
+    if method is not None:
+        with open_compressed(path, method) as stream:
+            return _scan_stream(stream)
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files can not be mapped
+            return None
+    with data:
+        if data[:1] != b'>':
+            return None
+        lengths = []
+        invalid = 0
+        gaps = 0
+        for length, bad, gap in _record_lengths(data):
+            lengths.append(length)
+            invalid += bad
+            gaps += gap
+    return lengths, invalid, gaps
+
+
+def sequence_batches(path, batch_bases=CHUNK_SIZE):
+    '''
+    Yield the sequence of a FASTA file (compressed or not) in batches of whole
+    records, with headers replaced by a newline so that nothing spans two contigs
+    '''
+    method = compression(path)
+    with (open_compressed(path, method) if method is not None else open(path, 'rb')) as f:
+        batch = []
+        size = 0
+        for line in f:
+            if line.startswith(b'>'):
+                if size >= batch_bases:
+                    yield b''.join(batch)
+                    batch = []
+                    size = 0
+                batch.append(b'\n')
+                continue
+            batch.append(line)
+            size += len(line)
+        if batch:
+            yield b''.join(batch)
+
+
+def scan_fasta(path):
+    '''
+    Collect AssemblyStats for a FASTA file, None if the file is empty or not a FASTA
+    '''
+    scanned = scan_lengths(path)
+    if scanned is None:
+        return None
+    lengths, invalid, gaps = scanned
+    return AssemblyStats(
+        contigs=len(lengths),
+        total_length=sum(lengths),
+        min_length=min(lengths),
+        max_length=max(lengths),
+        n50=n50(lengths),
+        invalid_characters=invalid,
+        empty_contigs=lengths.count(0)
+    )
+
+
+def assess(stats, min_length=MIN_TOTAL_LENGTH, max_contigs=MAX_CONTIGS):
+    '''
+    Decide if an assembly should be typed.
+
+    Output:
+    -------
+    (qc, reason): tuple of str, qc is one of PASS, FLAG or REJECT
+    '''
+    if stats is None:
+        return 'REJECT', 'empty or not a FASTA file'
+    reject = []
+    if stats.invalid_characters > 0:
+        reject.append(f"{stats.invalid_characters} non-nucleotide characters")
+    if stats.total_length < min_length:
+        reject.append(f"total length {stats.total_length} below {min_length}")
+    if stats.contigs > max_contigs:
+        reject.append(f"{stats.contigs} contigs above {max_contigs}")
+    if reject:
+        return 'REJECT', '; '.join(reject)
+    flag = []
+    if not EXPECTED_LENGTH[0] <= stats.total_length <= EXPECTED_LENGTH[1]:
+        flag.append(f"total length {stats.total_length} outside expected range {EXPECTED_LENGTH[0]}-{EXPECTED_LENGTH[1]}")
+    if stats.contigs > EXPECTED_CONTIGS:
+        flag.append(f"{stats.contigs} contigs")
+    if stats.empty_contigs > 0:
+        flag.append(f"{stats.empty_contigs} empty contigs")
+    if flag:
+        return 'FLAG', '; '.join(flag)
+    return 'PASS', ''
+
+
+def check(path, min_length=MIN_TOTAL_LENGTH, max_contigs=MAX_CONTIGS):
+    '''
+    Scan and assess an assembly, rejecting it if it is truncated or can not be read
+
+    Output:
+    -------
+    (stats, qc, reason): AssemblyStats (None if not scanned) and the outcome of assess
+    '''
+    try:
+        stats = scan_fasta(path)
+    except READ_ERRORS as e:
+        return None, 'REJECT', f"could not be read ({type(e).__name__}: {e})"
+    return (stats,) + assess(stats, min_length=min_length, max_contigs=max_contigs)
+
+
+def _preflight_row(sample, min_length, max_contigs):
+    seqid, path = sample
+    stats, qc, reason = check(path, min_length=min_length, max_contigs=max_contigs)
+    values = list(stats) if stats is not None else [None] * len(AssemblyStats._fields)
+    return [seqid, path] + values + [qc, reason]
+
+
+def preflight(samples, jobs=1, min_length=MIN_TOTAL_LENGTH, max_contigs=MAX_CONTIGS):
+    '''
+    Scan the assemblies of a list of (sample ID, path) in parallel
+
+    Output:
+    -------
+    rows: list of lists, one per sample, with values for COLUMNS
+    '''
+    samples = list(samples)
+    if jobs <= 1 or len(samples) <= 1:
+        return [_preflight_row(s, min_length, max_contigs) for s in samples]
+    n = len(samples)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        rows = pool.map(_preflight_row, samples, [min_length] * n, [max_contigs] * n, chunksize=max(1, n // (jobs * 4)))
+        return list(rows)
+
@@ -0,0 +1,105 @@
+'''
+Helpers so that several stype runs can share a node, a working directory and
+a cache without overwriting each other's outputs.
+
+Outputs are written to a temporary file next to their destination and renamed
+over it once complete, so a reader (or another run) never sees a partial file.
+Files shared between runs, such as the cache, are guarded by an advisory lock.
+'''
+
+import contextlib
+import datetime
+import fcntl
+import os
+import pathlib
+import tempfile
+
+
+def _umask():
+    # the umask can only be read by setting it, which is done once at import rather than while threads write
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+UMASK = _umask()
+
+
+def run_directory(outdir=''):
+    '''
+    Create the directory of a run. If outdir is empty, a new directory named
+    after the time and process ID is made, so concurrent runs never share one.
+
+    Output:
+    -------
+    pathlib.Path
+    '''
+    if outdir:
+        path = pathlib.Path(outdir)
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+    stamp = f"stype_{datetime.datetime.now():%Y%m%d_%H%M%S}_{os.getpid()}"
+    path = pathlib.Path(stamp)
+    suffix = 1
+    while True:
+        try:
+            path.mkdir()
+            return path
+        except FileExistsError:
+            path = pathlib.Path(f"{stamp}_{suffix}")
+            suffix += 1
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w'):
+    '''
+    Open a temporary file in the directory of path for writing, and rename it to
+    path once the block completes. The temporary file is removed on error.
+
+    >>> import tempfile, os
+    >>> d = tempfile.mkdtemp()
+    >>> with atomic_write(os.path.join(d, 'a.txt')) as f:
+    ...     _ = f.write('done')
+    >>> open(os.path.join(d, 'a.txt')).read()
+    'done'
+    >>> os.listdir(d)
+    ['a.txt']
+    '''
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix='.tmp')
+    try:
+        # mkstemp makes the file readable by its owner only, outputs get the permissions of any new file
+        os.fchmod(fd, 0o666 & ~UMASK)
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
+
+
+def atomic_path(path):
+    '''
+    A unique temporary path next to path, for writers that need a file name
+    (e.g. pandas.ExcelWriter). Rename it over path with os.replace when done.
+    '''
+    path = pathlib.Path(path)
+    return path.with_name(f".{path.name}.{os.getpid()}.tmp")
+
+
+@contextlib.contextmanager
+def locked(path):
+    '''
+    Hold an exclusive advisory lock on path.lock for the duration of the block,
+    waiting for any other process holding it
+    '''
+    lock = pathlib.Path(f"{path}.lock")
+    lock.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -13,6 +13,7 @@ The function will accept as input a pandas.DataFrame, and return a Series with
 the correct serovar call in the appropriate rows, and Nan otherwise.
 '''
 
+import os
 import sys
 
 import numpy as np
@@ -24,7 +25,8 @@ if 'pytest' in sys.modules:
     ###     PYTHONPATH=. pytest --doctest-modules filters.py
 
     test_data = "rule_test/sistr_test_rules.csv"
-    test_tab = pd.read_csv(test_data)
+    if os.path.exists(test_data):
+        test_tab = pd.read_csv(test_data)
 
 ### FILTERS ###
 
@@ -35,14 +37,14 @@ def filter_edge_case_sophia(tab):
     >>> pd.testing.assert_series_equal(res, test_tab.filter_edge_case_sophia)
     '''
     true_serovar = 'Sophia'
-    new_serovar = tab.apply(lambda x: true_serovar if x.rule_edge_case_sophia else np.nan, axis=1)
+    new_serovar = pd.Series(true_serovar, index=tab.index, dtype=object).where(tab.rule_edge_case_sophia.astype(bool))
     new_serovar.name = "filter_edge_case_sophia"
     return new_serovar
 
 def filter_edge_case_tm_abony(tab):
 
     true_serovar = 'Typhimurium|Lagos'
-    new_serovar = tab.apply(lambda x: true_serovar if x.rule_edge_case_tm_abony else np.nan, axis=1)
+    new_serovar = pd.Series(true_serovar, index=tab.index, dtype=object).where(tab.rule_edge_case_tm_abony.astype(bool))
     new_serovar.name = "filter_edge_case_tm_abony"
     return new_serovar
 
@@ -50,14 +52,14 @@ def filter_edge_case_tm_abony(tab):
 def filter_edge_case_sbg_wshmptn(tab):
 
     true_serovar = 'Senftenberg'
-    new_serovar = tab.apply(lambda x: true_serovar if x.rule_edge_case_sbg_wshmptn else np.nan, axis=1)
+    new_serovar = pd.Series(true_serovar, index=tab.index, dtype=object).where(tab.rule_edge_case_sbg_wshmptn.astype(bool))
     new_serovar.name = "filter_edge_case_sbg_wshmptn"
     return new_serovar
 
 def filter_edge_case_paratyphiB(tab):
 
     true_serovar = 'Paratyphi B'
-    new_serovar = tab.apply(lambda x: true_serovar if x.rule_edge_case_paratyphiB else np.nan, axis=1)
+    new_serovar = pd.Series(true_serovar, index=tab.index, dtype=object).where(tab.rule_edge_case_paratyphiB.astype(bool))
     new_serovar.name = "filter_edge_case_paratyphiB"
     return new_serovar
 
@@ -65,7 +67,7 @@ def filter_edge_case_paratyphiB(tab):
 def filter_edge_case_paratyphiBvJava(tab):
 
     true_serovar = 'Paratyphi B var. Java'
-    new_serovar = tab.apply(lambda x: true_serovar if x.rule_edge_case_paratyphiBvJava else np.nan, axis=1)
+    new_serovar = pd.Series(true_serovar, index=tab.index, dtype=object).where(tab.rule_edge_case_paratyphiBvJava.astype(bool))
     new_serovar.name = "filter_edge_case_paratyphiBvJava"
     return new_serovar
 
@@ -0,0 +1,155 @@
+'''
+Journal of a stype run, so that an interrupted run can be resumed.
+
+The journal (stype_journal.jsonl in the run directory) is a JSON lines file
+appended to as the run makes progress: a record when the run starts, one for
+each sample as soon as its sistr results are saved, and one for each stage
+(parse, mdu) once it has completed. Each record holds fingerprints (size and
+modification time) of the files it depends on and of those it wrote, so that
+stype run --resume only skips work whose inputs and outputs are unchanged:
+
+    {"event": "start", "input": "/data/batch.tab", "run_type": "batch", ...}
+    {"event": "sample", "id": "2020-12345", "input": "5012345:1697...", "output": "2345:1697..."}
+    {"event": "stage", "stage": "parse", "inputs": {...}, "outputs": {...}}
+
+Each record is written with a single call and flushed to disk, so a run that
+is killed loses at most the record being written, which is ignored on resume.
+'''
+
+import hashlib
+import json
+import os
+import pathlib
+import threading
+
+JOURNAL = 'stype_journal.jsonl'
+# settings of a run that must not change when it is resumed
+RESUME_SETTINGS = ['input', 'run_type', 'prefix', 'stream']
+
+
+def fingerprint(path):
+    '''
+    size and modification time (ns) of a file, None if it does not exist. A list of files is
+    reduced to a digest of their fingerprints
+
+    >>> fingerprint('/does/not/exist') is None
+    True
+    '''
+    if isinstance(path, (list, tuple)):
+        digest = hashlib.sha1()
+        for p in path:
+            digest.update(f"{p}={fingerprint(p)}\n".encode())
+        return digest.hexdigest()
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def fingerprints(paths):
+    '''
+    fingerprint of each of a dict of name -> path (or list of paths)
+    '''
+    return {name: fingerprint(path) for name, path in paths.items()}
+
+
+class Journal:
+    '''
+    Records the progress of a run, read back from the journal of an interrupted run if resume is True
+    '''
+
+    def __init__(self, path, resume=False):
+        self.path = pathlib.Path(path)
+        self.resumed = resume
+        self.lock = threading.Lock()
+        self.settings = {}
+        self.samples = {}
+        self.stages = {}
+        # samples recorded by the interrupted run whose assembly or results have changed since
+        self.changed = []
+        if resume:
+            self._load()
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            open(self.path, 'w').close()
+
+    def _load(self):
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # the run was stopped while writing this record
+                    continue
+                event = record.pop('event', None)
+                if event == 'start':
+                    self.settings = record
+                elif event == 'sample':
+                    self.samples[record['id']] = record
+                elif event == 'stage':
+                    self.stages[record['stage']] = record
+
+    def _append(self, record):
+        line = json.dumps(record, default=str) + '\n'
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def differences(self, **settings):
+        '''
+        names of the RESUME_SETTINGS that differ from those of the interrupted run
+        '''
+        if not self.resumed:
+            return []
+        return [key for key in RESUME_SETTINGS if key in settings and self.settings.get(key) != settings[key]]
+
+    def start(self, **settings):
+        '''
+        record the settings of the run
+        '''
+        self._append({'event': 'start', 'resume': self.resumed, **settings})
+        self.settings = settings
+
+    def record_sample(self, seqid, contigs, results=None):
+        '''
+        record that the sistr results of a sample have been saved (in results, or in the stream if None)
+        '''
+        record = {'id': f"{seqid}", 'input': fingerprint(contigs), 'output': fingerprint(results) if results else None}
+        self._append({'event': 'sample', **record})
+        with self.lock:
+            self.samples[record['id']] = record
+
+    def typed(self, seqid, contigs, results=None):
+        '''
+        True if the sample was typed by the interrupted run and neither its assembly nor its results have changed since
+        '''
+        if not self.resumed:
+            return False
+        record = self.samples.get(f"{seqid}")
+        if record is None:
+            return False
+        if record['input'] != fingerprint(contigs) or (results and record['output'] != fingerprint(results)):
+            with self.lock:
+                self.changed.append(f"{seqid}")
+            return False
+        return True
+
+    def record_stage(self, name, inputs, outputs):
+        '''
+        record that a stage has completed, with fingerprints of the files (name -> path) it read and wrote
+        '''
+        record = {'stage': name, 'inputs': fingerprints(inputs), 'outputs': fingerprints(outputs)}
+        self._append({'event': 'stage', **record})
+        self.stages[name] = record
+
+    def completed(self, name, inputs, outputs):
+        '''
+        True if the stage was completed by the interrupted run and the files it read and wrote have not changed since
+        '''
+        if not self.resumed:
+            return False
+        record = self.stages.get(name)
+        return record is not None and record['inputs'] == fingerprints(inputs) and record['outputs'] == fingerprints(outputs) and None not in record['outputs'].values()
@@ -0,0 +1,146 @@
+'''
+Vectorised k-mer hashing and bottom-s (MinHash) sketches.
+
+Sequences are encoded two bits per base with numpy, so a batch of reads or
+contigs is hashed with a handful of array operations instead of a Python loop
+per k-mer. Sequences in a batch are joined by any character that is not
+A, C, G or T (e.g. the newline at the end of each line), and k-mers that span
+such a character are skipped.
+
+A bottom-s sketch keeps the s smallest canonical k-mer hashes. The largest
+of these gives an estimate of the number of distinct k-mers in the input,
+which for reads (counting only k-mers seen at least a few times, to ignore
+sequencing errors) is an estimate of the genome size, as in `mash sketch -r`.
+'''
+
+import numpy as np
+
+# 2-bit code of each base, 4 for anything else
+CODES = np.full(256, 4, dtype=np.uint8)
+for _i, _b in enumerate(b'ACGT'):
+    CODES[_b] = _i
+    CODES[ord(chr(_b).lower())] = _i
+MAX_HASH = float(2 ** 64)
+
+
+def _mix(x):
+    '''
+    splitmix64 finaliser, applied to an array of uint64
+    '''
+    with np.errstate(over='ignore'):
+        x = x ^ (x >> np.uint64(30))
+        x = x * np.uint64(0xbf58476d1ce4e5b9)
+        x = x ^ (x >> np.uint64(27))
+        x = x * np.uint64(0x94d049bb133111eb)
+        x = x ^ (x >> np.uint64(31))
+    return x
+
+
+def kmer_hashes(seq, k=21):
+    '''
+    Hash every canonical k-mer (k <= 32) of a bytes sequence.
+
+    Output:
+    -------
+    hashes: numpy.ndarray of uint64 (one per valid k-mer, in sequence order)
+
+    >>> a = kmer_hashes(b'ACGTTGCA', k=4)
+    >>> b = kmer_hashes(b'TGCAACGT', k=4)
+    >>> sorted(a.tolist()) == sorted(b.tolist())
+    True
+    >>> len(kmer_hashes(b'ACGNACGT', k=4))
+    1
+    '''
+    codes = CODES[np.frombuffer(seq, dtype=np.uint8)]
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.uint64)
+    bad = np.concatenate(([0], np.cumsum(codes == 4)))
+    valid = (bad[k:] - bad[:n]) == 0
+    codes = np.where(codes == 4, 0, codes).astype(np.uint64)
+    # values of the 1, 2, 4, ... -mers starting at each position, built by doubling
+    fwd_blocks = {1: codes}
+    rev_blocks = {1: np.uint64(3) - codes}
+    p = 1
+    while 2 * p <= k:
+        f, r = fwd_blocks[p], rev_blocks[p]
+        fwd_blocks[2 * p] = (f[:-p] << np.uint64(2 * p)) | f[p:]
+        rev_blocks[2 * p] = (r[p:] << np.uint64(2 * p)) | r[:-p]
+        p *= 2
+    # combine the blocks that make up k, largest first
+    fwd = np.zeros(n, dtype=np.uint64)
+    rev = np.zeros(n, dtype=np.uint64)
+    offset = 0
+    while p >= 1:
+        if k - offset >= p:
+            fwd = (fwd << np.uint64(2 * p)) | fwd_blocks[p][offset:offset + n]
+            rev |= rev_blocks[p][offset:offset + n] << np.uint64(2 * offset)
+            offset += p
+        p //= 2
+    return _mix(np.minimum(fwd, rev)[valid])
+
+
+class BottomSketch:
+    '''
+    A bottom-s sketch of canonical k-mer hashes that only admits hashes seen
+    at least min_copies times.
+
+    Counts are only kept for the smallest candidate hashes. The cut-off for
+    candidates never increases, so a hash that is dropped could never have
+    made it to the final sketch, and counts of the hashes that remain are exact.
+    '''
+
+    def __init__(self, size=1000, k=21, min_copies=1, max_candidates=None):
+        self.size = size
+        self.k = k
+        self.min_copies = min_copies
+        self.max_candidates = max_candidates if max_candidates else size * 200
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self.counts = np.empty(0, dtype=np.int64)
+
+    def _cutoff(self):
+        if len(self.hashes) < self.max_candidates:
+            return None
+        return self.hashes[self.max_candidates - 1]
+
+    def add_hashes(self, hashes):
+        '''
+        add an array of hashes to the sketch
+        '''
+        cutoff = self._cutoff()
+        if cutoff is not None:
+            hashes = hashes[hashes <= cutoff]
+        if len(hashes) == 0:
+            return
+        new, new_counts = np.unique(hashes, return_counts=True)
+        merged = np.concatenate((self.hashes, new))
+        merged_counts = np.concatenate((self.counts, new_counts))
+        uniq, inverse = np.unique(merged, return_inverse=True)
+        counts = np.bincount(inverse.ravel(), weights=merged_counts, minlength=len(uniq)).astype(np.int64)
+        self.hashes = uniq[:self.max_candidates]
+        self.counts = counts[:self.max_candidates]
+
+    def add(self, seq):
+        '''
+        add the k-mers of a bytes sequence (or several joined by newlines)
+        '''
+        self.add_hashes(kmer_hashes(seq, k=self.k))
+
+    def sketch(self):
+        '''
+        the s smallest hashes seen at least min_copies times
+        '''
+        return self.hashes[self.counts >= self.min_copies][:self.size]
+
+    def cardinality(self):
+        '''
+        estimated number of distinct k-mers seen at least min_copies times
+        '''
+        sketch = self.sketch()
+        if len(sketch) >= self.size:
+            return (self.size - 1) / (float(sketch[-1]) / MAX_HASH)
+        cutoff = self._cutoff()
+        if cutoff is None:
+            # every distinct k-mer seen is a candidate
+            return float(len(sketch))
+        return len(sketch) / (float(cutoff) / MAX_HASH)
@@ -0,0 +1,294 @@
+'''
+Lazy readers for the manifest of samples to type.
+
+A manifest is read one row at a time, so a run can start typing the first
+samples of a manifest of hundreds of thousands of rows straight away, and the
+rows never need to be held in memory all at once. Supported sources are:
+
+- a tab-delimited file with the sample ID and path to the assembly in its first two columns (the original format)
+- a CSV file with the sample ID and path in its first two columns
+- a Parquet file with the sample ID and path in its first two columns (needs pyarrow)
+- a directory or a glob of assemblies, the sample ID being taken from each file name, or
+  from its path below the directory the glob starts from
+
+A header row naming the ID column (e.g. ID, sample or seqid) is skipped, and
+may name a priority column to fast-track urgent samples. Rows
+that can not be read, and files of a glob that would repeat the ID of an
+earlier file, are skipped and kept in Manifest.skipped, so that one bad row
+does not stop a long run. write_manifest writes samples back in these
+formats, e.g. to type again the samples of a run that failed.
+'''
+
+import csv
+import glob
+import itertools
+import os
+import re
+
+from styping.utils.files import atomic_path, atomic_write
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+FORMATS = ['auto', 'tsv', 'csv', 'parquet', 'glob']
+# rows read to check the layout of a manifest before typing starts
+SNIFF_ROWS = 100
+# names of the ID column in a header row
+ID_COLUMNS = {'id', 'sample', 'sample_id', 'sampleid', 'seqid', 'isolate', 'name'}
+# name of the optional priority column
+PRIORITY_COLUMN = 'priority'
+# Parquet rows read at a time
+PARQUET_BATCH = 10000
+
+# suffix of a manifest written in each format, a glob being written as the original tab-delimited format
+SUFFIXES = {'tsv': '.txt', 'csv': '.csv', 'parquet': '.parquet', 'glob': '.txt'}
+
+# suffixes of assemblies found by a glob, removed (with any compression suffix) to give the sample ID
+FASTA_SUFFIXES = ['.fa', '.fasta', '.fna', '.fas', '.contigs']
+COMPRESSED_SUFFIXES = ['.gz', '.bgz', '.zst']
+
+
+def sample_id(path):
+    '''
+    sample ID of an assembly, the file name without its FASTA and compression
+    suffixes, None if the file is not an assembly
+
+    >>> sample_id('/data/2021-12345.fna.gz')
+    '2021-12345'
+    '''
+    name = os.path.basename(path)
+    for suffix in COMPRESSED_SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    for suffix in FASTA_SUFFIXES:
+        if name.endswith(suffix) and len(name) > len(suffix):
+            return name[:-len(suffix)]
+    return None
+
+
+def manifest_format(source):
+    '''
+    guess the format of a manifest from its name
+
+    >>> manifest_format('runs/*.fa.gz')
+    'glob'
+    >>> manifest_format('samples.parquet')
+    'parquet'
+    >>> manifest_format('input.txt')
+    'tsv'
+    '''
+    if glob.has_magic(str(source)) or os.path.isdir(source):
+        return 'glob'
+    suffix = os.path.splitext(str(source))[1].lower()
+    if suffix in ('.parquet', '.pq'):
+        return 'parquet'
+    if suffix == '.csv':
+        return 'csv'
+    return 'tsv'
+
+
+def write_manifest(samples, path, fmt='tsv', priorities=None):
+    '''
+    write (sample ID, path) rows as a manifest that Manifest reads back, e.g. to
+    re-run the samples that failed. A glob is written as a tab-delimited file.
+    If any of the samples has a priority in priorities, a priority column is added
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'failed.txt')
+    >>> write_manifest([('A', '/data/a.fa'), ('B', '/data/b.fa')], path, priorities={'B': 5})
+    >>> list(Manifest(path))
+    [('B', '/data/b.fa'), ('A', '/data/a.fa')]
+    '''
+    priorities = priorities or {}
+    columns = ['ID', 'path']
+    rows = [list(sample) for sample in samples]
+    if any(f"{seqid}" in priorities for seqid, contigs in samples):
+        columns.append(PRIORITY_COLUMN)
+        for row in rows:
+            row.append(priorities.get(f"{row[0]}", 0))
+    if fmt == 'parquet':
+        if pq is None:
+            raise ImportError("Writing Parquet manifests needs pyarrow (pip install pyarrow)")
+        import pyarrow as pa
+        values = list(zip(*rows)) if rows else [()] * len(columns)
+        table = {column: list(value) for column, value in zip(columns, values)}
+        table['ID'] = [f"{seqid}" for seqid in table['ID']]
+        tmp = atomic_path(path)
+        pq.write_table(pa.table(table), tmp)
+        os.replace(tmp, path)
+        return
+    with atomic_write(path) as f:
+        if fmt == 'csv':
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(columns)
+            writer.writerows(rows)
+        else:
+            if len(columns) > 2:
+                # the original format has no header, one is only needed to name the priority column
+                f.write('\t'.join(columns) + '\n')
+            f.writelines('\t'.join(f"{value}" for value in row) + '\n' for row in rows)
+
+
+class Manifest:
+    '''
+    A lazily read, re-iterable manifest of (sample ID, absolute path to assembly).
+
+    A manifest with a header may have a priority column (a whole number, 0 if
+    empty). Samples with a priority above 0 are urgent and are yielded first,
+    highest priority first, then the other samples in the order of the manifest
+    '''
+
+    def __init__(self, source, fmt='auto', id_pattern=None):
+        self.source = str(source)
+        self.format = manifest_format(self.source) if fmt in (None, '', 'auto') else fmt
+        self.id_pattern = re.compile(id_pattern) if id_pattern else None
+        # (row, reason) of rows that could not be read
+        self.skipped = []
+        # index of the priority column, found in the header
+        self._priority_column = None
+        self._urgent = None
+        # {sample ID: priority} of the urgent samples, filled by urgent()
+        self.priorities = {}
+
+    def __iter__(self):
+        self.skipped = []
+        urgent = self.urgent()
+        yield from urgent
+        for row, sample, priority in self._rows():
+            if isinstance(sample, str):
+                self.skipped.append((row, sample))
+                continue
+            if priority > 0:
+                # already yielded
+                continue
+            yield sample
+
+    def urgent(self):
+        '''
+        (sample ID, path) of the samples with a priority above 0, highest priority
+        first. Only a manifest with a priority column is read in full to find them
+        '''
+        if self._urgent is None:
+            rows = self._rows()
+            first = list(itertools.islice(rows, 1))
+            urgent = []
+            if self._priority_column is not None:
+                urgent = [(priority, row, sample) for row, sample, priority in itertools.chain(first, rows) if priority > 0 and not isinstance(sample, str)]
+                urgent.sort(key=lambda u: (-u[0], u[1]))
+            self._urgent = [sample for priority, row, sample in urgent]
+            self.priorities = {sample[0]: priority for priority, row, sample in urgent}
+        return self._urgent
+
+    def sniff(self, n=SNIFF_ROWS):
+        '''
+        read the first n rows, raising ValueError at the first one that can not be read
+
+        Output:
+        -------
+        list of (sample ID, path)
+        '''
+        samples = []
+        for row, sample, priority in itertools.islice(self._rows(), n):
+            if isinstance(sample, str):
+                raise ValueError(f"row {row} of {self.source} : {sample}")
+            samples.append(sample)
+        return samples
+
+    def _rows(self):
+        '''
+        yield (row number, (sample ID, path), priority) or (row number, reason it could not be read, 0)
+        '''
+        if self.format == 'glob':
+            return self._glob_rows()
+        if self.format == 'parquet':
+            return self._parquet_rows()
+        return self._text_rows()
+
+    def _header(self, values):
+        # a header names the ID column, and may name a priority column
+        if not values or values[0].strip().lower() not in ID_COLUMNS:
+            return False
+        names = [value.strip().lower() for value in values]
+        self._priority_column = names.index(PRIORITY_COLUMN) if PRIORITY_COLUMN in names else None
+        return True
+
+    def _sample(self, row, values):
+        # columns after the ID and path are ignored, apart from the priority
+        if len(values) < 2 or not values[0].strip() or not values[1].strip():
+            return row, f"expected a sample ID and a path, found {values}", 0
+        priority = 0
+        if self._priority_column is not None and len(values) > self._priority_column and values[self._priority_column].strip():
+            try:
+                priority = int(float(values[self._priority_column]))
+            except ValueError:
+                return row, f"priority {values[self._priority_column]} is not a whole number", 0
+        return row, (values[0].strip(), os.path.abspath(values[1].strip())), priority
+
+    def _text_rows(self):
+        self._priority_column = None
+        with open(self.source, 'r', newline='') as f:
+            if self.format == 'csv':
+                rows = csv.reader(f)
+            else:
+                rows = (line.rstrip('\r\n').split('\t') for line in f)
+            for n, values in enumerate(rows, start=1):
+                if values == [] or values == ['']:
+                    continue
+                if n == 1 and self._header(values):
+                    continue
+                yield self._sample(n, values)
+
+    def _parquet_rows(self):
+        if pq is None:
+            raise ImportError("Reading Parquet manifests needs pyarrow (pip install pyarrow)")
+        parquet = pq.ParquetFile(self.source)
+        names = parquet.schema_arrow.names
+        columns = names[:2]
+        self._priority_column = None
+        if PRIORITY_COLUMN in [name.lower() for name in names[2:]]:
+            columns.append(names[2:][[name.lower() for name in names[2:]].index(PRIORITY_COLUMN)])
+            self._priority_column = 2
+        n = 0
+        for batch in parquet.iter_batches(batch_size=PARQUET_BATCH, columns=columns):
+            values = [batch.column(i).to_pylist() for i in range(len(columns))]
+            for row in zip(*values):
+                n += 1
+                yield self._sample(n, [f"{value}" if value is not None else '' for value in row])
+
+    def _glob_root(self):
+        # the directory a glob starts from, e.g. runs for runs/*/contigs.fa
+        if os.path.isdir(self.source):
+            return self.source
+        parts = self.source.split(os.sep)
+        for i, part in enumerate(parts):
+            if glob.has_magic(part):
+                return os.sep.join(parts[:i]) or os.curdir
+        return os.path.dirname(self.source) or os.curdir
+
+    def _glob_rows(self):
+        pattern = os.path.join(self.source, '*') if os.path.isdir(self.source) else self.source
+        root = self._glob_root()
+        seen = {}
+        for n, path in enumerate(glob.iglob(pattern, recursive=True), start=1):
+            if not os.path.isfile(path):
+                continue
+            name = os.path.basename(path)
+            if self.id_pattern is not None:
+                # matched against the path below the root, so that the ID can be a directory name
+                m = self.id_pattern.search(os.path.relpath(path, root))
+                if m is None:
+                    continue
+                seqid = m.group('id') if 'id' in self.id_pattern.groupindex else (m.group(1) if self.id_pattern.groups else m.group(0))
+            else:
+                seqid = sample_id(name)
+                if seqid is None:
+                    continue
+            # the results of files with the same ID would overwrite each other
+            if seqid in seen:
+                yield n, f"sample ID {seqid} of {path} is already used by {seen[seqid]}, use an ID pattern to take the ID from elsewhere in the path", 0
+                continue
+            seen[seqid] = path
+            yield n, (seqid, os.path.abspath(path)), 0
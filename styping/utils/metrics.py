@@ -0,0 +1,213 @@
+'''
+Metrics of a stype run in the Prometheus text exposition format.
+
+The metrics are written to a textfile (e.g. /var/lib/node_exporter/stype.prom)
+every few seconds while stype is running and once more when it stops, so that
+node_exporter's textfile collector can expose them and throughput drops or
+capacity problems can be alerted on while a batch or a watch is running. The
+file is replaced atomically, so node_exporter never reads a partial file.
+
+Metrics (every sample is labelled with the command and the run):
+
+- stype_samples_queued, stype_samples_running: samples waiting for a sistr job, and being typed
+- stype_samples_done_total, stype_samples_failed_total, stype_samples_rejected_total: samples typed,
+  failed by sistr, and not typed because of the pre-flight scan
+- stype_sistr_job_seconds: histogram of the wall time of each sistr call
+- stype_stage_seconds_total: wall time spent in each stage (see styping.utils.profile)
+- stype_cache_lookups_total: lookups of cached results, by cache and result (hit or miss)
+- stype_samples_status_total: typed samples by STATUS
+- stype_last_update_timestamp_seconds: when the file was last written
+
+Recording costs nothing when metrics are off.
+'''
+
+import collections
+import threading
+import time
+
+from styping.utils.files import atomic_write
+from styping.utils.profile import PROFILER
+
+# seconds between writes of the textfile
+INTERVAL = 15
+# upper bounds (s) of the buckets of the sistr job histogram
+SISTR_BUCKETS = (15, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+
+
+def _escape(value):
+    return f"{value}".replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    '''
+    >>> _labels(stage='parse;rules', le='+Inf')
+    '{stage="parse;rules",le="+Inf"}'
+    '''
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + '}'
+
+
+class Metrics:
+    '''
+    Counts samples through the queue, sistr jobs and typing, and writes them as a textfile
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.labels = {}
+        self.lock = threading.Lock()
+        self.writer = None
+        self.stopped = threading.Event()
+        self._reset()
+
+    def _reset(self):
+        self.queued = 0
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+        self.rejected = 0
+        self.buckets = [0] * len(SISTR_BUCKETS)
+        self.job_count = 0
+        self.job_sum = 0.0
+        self.lookups = collections.Counter()
+        self.statuses = collections.Counter()
+
+    def start(self, path, command='', run=''):
+        '''
+        start recording and writing the textfile every INTERVAL seconds
+        '''
+        self._reset()
+        self.path = path
+        self.labels = {'command': command, 'run': run}
+        self.enabled = True
+        self.stopped.clear()
+        self.writer = threading.Thread(target=self._write_every, name='stype-metrics', daemon=True)
+        self.writer.start()
+
+    def stop(self):
+        '''
+        stop recording and write the textfile a last time
+        '''
+        self.enabled = False
+        self.stopped.set()
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+        if self.path:
+            self.write()
+
+    def _write_every(self):
+        while not self.stopped.wait(INTERVAL):
+            self.write()
+
+    def queue(self, n):
+        '''
+        n samples are waiting for a sistr job
+        '''
+        if self.enabled:
+            with self.lock:
+                self.queued += n
+
+    def started(self, n):
+        '''
+        n queued samples are being typed
+        '''
+        if self.enabled:
+            with self.lock:
+                self.queued -= n
+                self.running += n
+
+    def finished(self, done):
+        '''
+        samples being typed have finished, done holding True for each sample typed and False for each that failed
+        '''
+        if self.enabled:
+            with self.lock:
+                self.running -= len(done)
+                self.done += sum(bool(d) for d in done)
+                self.failed += sum(not d for d in done)
+
+    def reject(self, n, queued=False):
+        '''
+        n samples will not be typed because of the pre-flight scan (and leave the queue if queued)
+        '''
+        if self.enabled:
+            with self.lock:
+                self.rejected += n
+                if queued:
+                    self.queued -= n
+
+    def observe_job(self, seconds):
+        '''
+        record the wall time of a sistr call
+        '''
+        if self.enabled:
+            with self.lock:
+                self.job_count += 1
+                self.job_sum += seconds
+                for i, bound in enumerate(SISTR_BUCKETS):
+                    if seconds <= bound:
+                        self.buckets[i] += 1
+
+    def lookup(self, cache, hits=0, misses=0):
+        '''
+        record hits and misses of a cache
+        '''
+        if self.enabled:
+            with self.lock:
+                self.lookups[(cache, 'hit')] += hits
+                self.lookups[(cache, 'miss')] += misses
+
+    def count_status(self, statuses):
+        '''
+        record the STATUS of typed samples
+        '''
+        if self.enabled:
+            with self.lock:
+                self.statuses.update(f"{status}" for status in statuses)
+
+    def render(self):
+        '''
+        the metrics in the Prometheus text exposition format
+        '''
+        lines = []
+
+        def family(name, kind, text, samples):
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_labels(**self.labels, **labels)} {value}")
+
+        with self.lock:
+            family('stype_samples_queued', 'gauge', 'Samples waiting for a sistr job.', [({}, self.queued)])
+            family('stype_samples_running', 'gauge', 'Samples being typed.', [({}, self.running)])
+            family('stype_samples_done_total', 'counter', 'Samples typed by sistr.', [({}, self.done)])
+            family('stype_samples_failed_total', 'counter', 'Samples sistr failed to type.', [({}, self.failed)])
+            family('stype_samples_rejected_total', 'counter', 'Samples not typed because of the pre-flight scan.', [({}, self.rejected)])
+            cumulative = [({'le': f"{bound}"}, n) for bound, n in zip(SISTR_BUCKETS, self.buckets)] + [({'le': '+Inf'}, self.job_count)]
+            lines.append("# HELP stype_sistr_job_seconds Wall time of each sistr call.")
+            lines.append("# TYPE stype_sistr_job_seconds histogram")
+            for labels, value in cumulative:
+                lines.append(f"stype_sistr_job_seconds_bucket{_labels(**self.labels, **labels)} {value}")
+            lines.append(f"stype_sistr_job_seconds_sum{_labels(**self.labels)} {round(self.job_sum, 3)}")
+            lines.append(f"stype_sistr_job_seconds_count{_labels(**self.labels)} {self.job_count}")
+            family('stype_cache_lookups_total', 'counter', 'Lookups of cached results.', [({'cache': cache, 'result': result}, n) for (cache, result), n in sorted(self.lookups.items())])
+            family('stype_samples_status_total', 'counter', 'Typed samples by STATUS.', [({'status': status}, n) for status, n in sorted(self.statuses.items())])
+        with PROFILER.lock:
+            stages = [({'stage': path}, round(PROFILER.totals[path]['wall'], 3)) for path in PROFILER.order]
+        family('stype_stage_seconds_total', 'counter', 'Wall time spent in each stage of stype.', stages)
+        family('stype_last_update_timestamp_seconds', 'gauge', 'When these metrics were written.', [({}, round(time.time(), 3))])
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        '''
+        replace the textfile with the current metrics
+        '''
+        with atomic_write(self.path) as f:
+            f.write(self.render())
+
+
+# the metrics of this process, used by every module
+METRICS = Metrics()
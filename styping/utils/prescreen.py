@@ -0,0 +1,160 @@
+'''
+A fast k-mer pre-screen of assemblies against a panel of reference sketches.
+
+Each assembly is reduced to a bottom-s sketch of its canonical k-mers, and the
+Jaccard index with every reference is estimated from the sketches as Mash
+does (the shared hashes among the s smallest of the union). The serovar of the
+closest reference is reported together with the margin to the next closest
+serovar, as a preliminary call that is available long before sistr finishes.
+It is a triage aid only: the serovar and STATUS used for reporting still come
+from sistr and the rules.
+
+A panel is built from a tab-delimited file of serovar and path to a reference
+assembly (several references per serovar are allowed) and saved as a numpy
+.npz file.
+'''
+
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from styping.utils.fasta import sequence_batches
+from styping.utils.files import atomic_write
+from styping.utils.kmers import BottomSketch
+
+SKETCH_SIZE = 1000
+KMER_SIZE = 21
+# bases of sequence hashed at a time
+BATCH_BASES = 1024 ** 2
+# below this Jaccard index no serovar is suggested
+MIN_SCORE = 0.5
+
+Panel = collections.namedtuple('Panel', ['serovars', 'references', 'sketches', 'k', 'size'])
+
+COLUMNS = ['ID', 'path', 'PRESCREEN_SEROVAR', 'PRESCREEN_SCORE', 'PRESCREEN_NEXT', 'PRESCREEN_NEXT_SCORE', 'PRESCREEN_MARGIN', 'PRESCREEN_REFERENCE']
+
+
+def sketch_fasta(path, size=SKETCH_SIZE, k=KMER_SIZE):
+    '''
+    bottom-s sketch (sorted uint64 array) of the canonical k-mers of an assembly
+    '''
+    # every k-mer of an assembly counts, so only the s smallest hashes need to be kept
+    sketch = BottomSketch(size=size, k=k, min_copies=1, max_candidates=size)
+    for batch in sequence_batches(path, batch_bases=BATCH_BASES):
+        sketch.add(batch)
+    return sketch.sketch()
+
+
+def jaccard(a, b, size):
+    '''
+    Estimate the Jaccard index of two sets of k-mers from their bottom-s sketches
+
+    >>> a = np.arange(10, dtype=np.uint64)
+    >>> jaccard(a, a, 10)
+    1.0
+    >>> jaccard(a, a + np.uint64(5), 10)
+    0.5
+    '''
+    union = np.union1d(a, b)[:size]
+    if len(union) == 0:
+        return 0.0
+    shared = np.isin(union, a, assume_unique=True) & np.isin(union, b, assume_unique=True)
+    return float(shared.sum()) / len(union)
+
+
+def build_panel(references, size=SKETCH_SIZE, k=KMER_SIZE, jobs=1):
+    '''
+    Sketch reference assemblies in parallel
+
+    Input:
+    ------
+    references: list of (serovar, path to assembly)
+
+    Output:
+    -------
+    Panel
+    '''
+    references = list(references)
+    paths = [path for serovar, path in references]
+    if jobs <= 1 or len(paths) <= 1:
+        sketches = [sketch_fasta(p, size, k) for p in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            sketches = list(pool.map(sketch_fasta, paths, [size] * len(paths), [k] * len(paths)))
+    return Panel([serovar for serovar, path in references], paths, sketches, k, size)
+
+
+def save_panel(panel, path):
+    '''
+    Save a panel as a .npz file. Sketches are padded with the largest hash to a matrix
+    '''
+    matrix = np.full((len(panel.sketches), panel.size), np.iinfo(np.uint64).max, dtype=np.uint64)
+    lengths = np.array([len(s) for s in panel.sketches], dtype=np.int64)
+    for i, sketch in enumerate(panel.sketches):
+        matrix[i, :len(sketch)] = sketch
+    # panels are shared between runs, so a panel is only replaced once completely written
+    with atomic_write(path, 'wb') as f:
+        np.savez_compressed(
+            f,
+            serovars=np.array(panel.serovars, dtype=str),
+            references=np.array(panel.references, dtype=str),
+            sketches=matrix,
+            lengths=lengths,
+            k=panel.k,
+            size=panel.size
+        )
+
+
+def load_panel(path):
+    '''
+    Load a panel saved by save_panel
+    '''
+    with np.load(path) as data:
+        sketches = [row[:n] for row, n in zip(data['sketches'], data['lengths'])]
+        return Panel(data['serovars'].tolist(), data['references'].tolist(), sketches, int(data['k']), int(data['size']))
+
+
+def screen(sketch, panel):
+    '''
+    Compare the sketch of an assembly with a panel
+
+    Output:
+    -------
+    list of values for COLUMNS after ID and path
+    '''
+    best = {}
+    for serovar, reference, ref in zip(panel.serovars, panel.references, panel.sketches):
+        score = jaccard(sketch, ref, panel.size)
+        if serovar not in best or score > best[serovar][0]:
+            best[serovar] = (score, reference)
+    ranked = sorted(best.items(), key=lambda item: item[1][0], reverse=True)
+    if not ranked:
+        return ['', 0.0, '', 0.0, 0.0, '']
+    serovar, (score, reference) = ranked[0]
+    next_serovar, (next_score, _) = ranked[1] if len(ranked) > 1 else ('', (0.0, ''))
+    if score < MIN_SCORE:
+        # too far from every reference to suggest a serovar
+        serovar, reference = '', ''
+    return [serovar, round(score, 4), next_serovar, round(next_score, 4), round(score - next_score, 4), reference]
+
+
+def _screen_row(sample, panel):
+    seqid, path = sample
+    return [seqid, path] + screen(sketch_fasta(path, panel.size, panel.k), panel)
+
+
+def screen_samples(samples, panel, jobs=1):
+    '''
+    Screen the assemblies of a list of (sample ID, path) in parallel
+
+    Output:
+    -------
+    rows: list of lists, one per sample, with values for COLUMNS
+    '''
+    samples = list(samples)
+    if jobs <= 1 or len(samples) <= 1:
+        return [_screen_row(s, panel) for s in samples]
+    n = len(samples)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(_screen_row, samples, [panel] * n, chunksize=max(1, n // (jobs * 4))))
@@ -0,0 +1,184 @@
+'''
+A lightweight profiler for the stages of a stype run.
+
+Stages are marked with `with profile.stage('name'):` and may be nested. For
+each stage the wall time, CPU time of stype itself, CPU time of the programs
+it ran (sistr, csvtk) and the peak resident memory of stype while the stage
+was running are recorded. Peak memory is sampled by a background thread, so
+profiling adds almost no overhead, and stages cost nothing when profiling is
+off. The peak memory of the programs run is recorded separately, for the
+stages that ran any: the kernel only keeps the largest peak of all programs
+run so far, so it is exact for the stage that reached it and an upper bound
+for the others.
+
+The report has one row per stage, named by its path (e.g. parse;rules). The
+folded output has the exclusive wall time of each stage in milliseconds, one
+line per path, as read by flamegraph.pl, inferno or speedscope.
+'''
+
+import contextlib
+import os
+import resource
+import threading
+import time
+
+# seconds between samples of the resident memory
+INTERVAL = 0.05
+
+COLUMNS = ['stage', 'calls', 'wall_s', 'cpu_s', 'children_cpu_s', 'peak_rss_mb', 'children_peak_rss_mb']
+
+
+def rss():
+    '''
+    current resident memory of this process (bytes)
+    '''
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # peak so far (in kB on linux) where /proc is not available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _children():
+    '''
+    CPU time (s) and largest peak resident memory (bytes) of the programs run so far
+    '''
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss * 1024
+
+
+class _Peak:
+    '''
+    peak resident memory seen while a stage is running
+    '''
+    __slots__ = ['peak']
+
+    def __init__(self, peak):
+        self.peak = peak
+
+
+class Profiler:
+    '''
+    Collects the cost of each stage
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.totals = {}
+        self.order = []
+        self.active = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.sampler = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        '''
+        start profiling, clearing anything recorded before
+        '''
+        self.totals = {}
+        self.order = []
+        self.active = []
+        self.enabled = True
+        self.stopped.clear()
+        self.sampler = threading.Thread(target=self._sample, name='stype-profiler', daemon=True)
+        self.sampler.start()
+
+    def stop(self):
+        '''
+        stop profiling, keeping what has been recorded
+        '''
+        self.enabled = False
+        self.stopped.set()
+        if self.sampler is not None:
+            self.sampler.join()
+            self.sampler = None
+
+    def _sample(self):
+        while not self.stopped.wait(INTERVAL):
+            current = rss()
+            with self.lock:
+                for record in self.active:
+                    record.peak = max(record.peak, current)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+        record the cost of the block as a stage, nested in any stage already running in this thread
+        '''
+        if not self.enabled:
+            yield
+            return
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        path = ';'.join(stack + [name])
+        stack.append(name)
+        record = _Peak(rss())
+        with self.lock:
+            self.active.append(record)
+            if path not in self.totals:
+                self.totals[path] = {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'children': 0.0, 'peak': 0, 'children_peak': 0}
+                self.order.append(path)
+        wall, cpu = time.perf_counter(), time.process_time()
+        children, children_peak = _children()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            children_end, children_peak_end = _children()
+            children = children_end - children
+            # only stages that ran programs are given their peak
+            children_peak = children_peak_end if children > 0 or children_peak_end > children_peak else 0
+            stack.pop()
+            with self.lock:
+                self.active.remove(record)
+                record.peak = max(record.peak, rss())
+                total = self.totals[path]
+                total['calls'] += 1
+                total['wall'] += wall
+                total['cpu'] += cpu
+                total['children'] += children
+                total['peak'] = max(total['peak'], record.peak)
+                total['children_peak'] = max(total['children_peak'], children_peak)
+
+    def rows(self):
+        '''
+        one row per stage with values for COLUMNS, in the order stages were first entered
+        '''
+        return [
+            [path, t['calls'], round(t['wall'], 3), round(t['cpu'], 3), round(t['children'], 3), round(t['peak'] / 1024 ** 2, 1), round(t['children_peak'] / 1024 ** 2, 1)]
+            for path, t in ((path, self.totals[path]) for path in self.order)
+        ]
+
+    def folded(self):
+        '''
+        lines of "stage;sub-stage milliseconds" with the wall time spent in each stage
+        outside of its sub-stages, for flame graphs
+        '''
+        exclusive = {path: t['wall'] for path, t in self.totals.items()}
+        for path, t in self.totals.items():
+            parent = path.rpartition(';')[0]
+            if parent in exclusive:
+                exclusive[parent] -= t['wall']
+        return [f"{path} {max(0, round(exclusive[path] * 1000))}" for path in self.order]
+
+    def write(self, report, folded=None):
+        '''
+        save the report as csv (and the folded stacks if a path is given)
+        '''
+        from styping.utils.files import atomic_write
+        with atomic_write(report) as f:
+            f.write(','.join(COLUMNS) + '\n')
+            for row in self.rows():
+                f.write(','.join(f"{v}" for v in row) + '\n')
+        if folded:
+            with atomic_write(folded) as f:
+                f.write('\n'.join(self.folded()) + '\n')
+
+
+# the profiler of this process, used by every module
+PROFILER = Profiler()
+stage = PROFILER.stage
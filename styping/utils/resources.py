@@ -0,0 +1,101 @@
+'''
+Helpers to inspect the resources of the host and decide how to split them
+between sistr jobs.
+
+sistr spends most of its time in BLAST and loading its cgMLST database, so
+each job needs a fixed chunk of memory regardless of the assembly size, and
+the threads given to a single job stop paying off after a handful of cores.
+Jobs are therefore limited by both the number of cores and the memory
+available, and any spare cores are handed out as threads per job.
+'''
+
+import os
+
+# approximate resident memory of a single sistr job (bytes)
+SISTR_MEMORY = 2 * 1024 ** 3
+# sistr does not scale well beyond this many threads per job
+MAX_SISTR_THREADS = 8
+
+
+def available_cores():
+    '''
+    Number of cores this process is allowed to run on.
+
+    >>> available_cores() >= 1
+    True
+    '''
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def available_memory():
+    '''
+    Memory available to new processes (bytes). Uses MemAvailable from
+    /proc/meminfo where present, otherwise the physical memory of the host.
+    '''
+    try:
+        with open('/proc/meminfo', 'r') as m:
+            for line in m:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return SISTR_MEMORY
+
+
+def file_size(path):
+    '''
+    Size of path in bytes, 0 if it can not be read.
+    '''
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def max_jobs(cores=None, memory=None):
+    '''
+    Most sistr jobs the cores and memory can run at once.
+
+    >>> max_jobs(cores=16, memory=8 * 1024 ** 3)
+    4
+    '''
+    cores = cores if cores else available_cores()
+    memory = memory if memory else available_memory()
+    return max(1, min(cores, memory // SISTR_MEMORY))
+
+
+def plan_parallelism(n_samples, jobs=None, threads=None, cores=None, memory=None):
+    '''
+    Decide how many sistr jobs to run at once and how many threads to give each.
+
+    Input:
+    ------
+    n_samples: int (number of assemblies to type)
+    jobs: int (number of concurrent jobs, None to choose automatically)
+    threads: int (threads per job, None to choose automatically)
+    cores: int (cores available, detected if None)
+    memory: int (bytes of memory available, detected if None)
+
+    Output:
+    -------
+    (jobs, threads): tuple of int
+
+    >>> plan_parallelism(100, cores=16, memory=64 * 1024 ** 3)
+    (16, 1)
+    >>> plan_parallelism(100, cores=16, memory=8 * 1024 ** 3)
+    (4, 4)
+    >>> plan_parallelism(1, cores=16, memory=64 * 1024 ** 3)
+    (1, 8)
+    '''
+    cores = cores if cores else available_cores()
+    if not jobs:
+        jobs = max(1, min(n_samples, max_jobs(cores, memory)))
+    if not threads:
+        threads = max(1, min(MAX_SISTR_THREADS, cores // jobs))
+    return jobs, threads
@@ -0,0 +1,96 @@
+'''
+Index of serovar names, so that rules comparing the serovar calls of a sample
+work on integer IDs rather than strings.
+
+sistr reports the same few hundred serovar names (and '|' separated lists of
+names in serovar_antigen) over and over. The index gives each distinct name an
+integer ID the first time it is seen, so that equality of two calls is an
+integer comparison, and remembers whether one name is contained in another for
+each pair of IDs, so that containment is worked out once per distinct pair
+rather than once per row. The index grows with the names seen by the process
+and is shared by every table typed (e.g. each chunk of a replay, or each sample
+of a watch).
+
+Containment keeps the meaning the rules have always had: a serovar is
+contained in serovar_antigen if it is a substring of it (so 'Paratyphi B' is in
+'Paratyphi B var. Java|Limete'), not only if it is one of its '|' separated names.
+'''
+
+import threading
+
+import numpy as np
+import pandas as pd
+
+# ID of a missing name (NaN), never equal to or contained in another name
+MISSING = -1
+
+
+class SerovarIndex:
+    '''
+    Integer IDs of serovar names, and containment of one name in another by pair of IDs
+    '''
+
+    def __init__(self, names=()):
+        self.lock = threading.Lock()
+        self.names = []
+        self.vocabulary = {}
+        self.contained = {}
+        self.add(names)
+
+    def add(self, names):
+        '''
+        IDs of names (as a numpy array), adding those not seen before to the index
+        '''
+        with self.lock:
+            ids = []
+            for name in names:
+                if name not in self.vocabulary:
+                    self.vocabulary[name] = len(self.names)
+                    self.names.append(name)
+                ids.append(self.vocabulary[name])
+        return np.array(ids, dtype=np.int64)
+
+    def ids(self, values):
+        '''
+        ID of the name in each row of a column, MISSING where there is none. Each distinct
+        name is only looked up once, however many rows it is in
+
+        >>> index = SerovarIndex()
+        >>> index.ids(pd.Series(['Typhimurium', 'Dublin', 'Typhimurium', None])).tolist()
+        [0, 1, 0, -1]
+        '''
+        codes, uniques = pd.factorize(values)
+        ids = self.add(uniques)
+        if len(ids) == 0:
+            return np.full(len(codes), MISSING, dtype=np.int64)
+        return np.where(codes >= 0, ids[np.maximum(codes, 0)], MISSING)
+
+    def contains(self, needles, haystacks):
+        '''
+        True for each row where the name of needles is contained in the name of haystacks
+        (both arrays of IDs). Each distinct pair of names is only compared once
+
+        >>> index = SerovarIndex(['Paratyphi B', 'Paratyphi B var. Java|Limete', 'Limete'])
+        >>> index.contains(np.array([0, 2, 0, -1]), np.array([1, 1, 2, 1])).tolist()
+        [True, True, False, False]
+        '''
+        needles = np.asarray(needles, dtype=np.int64)
+        haystacks = np.asarray(haystacks, dtype=np.int64)
+        if len(needles) == 0:
+            return np.zeros(0, dtype=bool)
+        pairs, inverse = np.unique(np.stack([needles, haystacks], axis=1), axis=0, return_inverse=True)
+        found = np.zeros(len(pairs), dtype=bool)
+        with self.lock:
+            for i, (needle, haystack) in enumerate(pairs.tolist()):
+                if needle == MISSING or haystack == MISSING:
+                    continue
+                key = (needle, haystack)
+                if key not in self.contained:
+                    needle_name, haystack_name = self.names[needle], self.names[haystack]
+                    self.contained[key] = isinstance(needle_name, str) and isinstance(haystack_name, str) and needle_name in haystack_name
+                found[i] = self.contained[key]
+        return found[inverse.reshape(-1)]
+
+
+# the index of this process, used by the rules
+SEROVARS = SerovarIndex()
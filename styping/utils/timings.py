@@ -0,0 +1,177 @@
+'''
+Timings of past sistr calls, and a cost model fitted to them to plan a batch
+before it runs.
+
+Every successful sistr call appends its number of samples, size, threads and
+wall time to a history shared by the runs on the host. The wall time of a call
+is modelled as a fixed overhead (sistr loading its databases) plus a time per
+byte of assembly, part of which is shared between the threads of the call:
+
+    seconds = overhead + rate * bytes + parallel_rate * bytes / threads
+
+The time shared between threads can only be told apart once calls with
+different numbers of threads have been recorded. Until then all of the time
+per byte is taken to be the same whatever the threads.
+
+Compressed assemblies are counted as COMPRESSION_RATIO times their size on
+disk, so that the size can be taken from the file system without reading
+them. A batch is then planned by replaying the dispatch order of stype run
+(windows of samples, largest first, grouped by --batch-size) onto the jobs.
+'''
+
+import collections
+import datetime
+import heapq
+import itertools
+import os
+
+import numpy as np
+import pandas
+
+from styping.utils.fasta import compression
+from styping.utils.files import locked
+from styping.utils.resources import SISTR_MEMORY, file_size
+
+COLUMNS = ['date', 'samples', 'bytes', 'threads', 'seconds']
+# approximate ratio of the size of a FASTA file to its compressed size
+COMPRESSION_RATIO = 3.5
+# only the most recent timings are used, so the model follows changes to the host
+HISTORY_ROWS = 10000
+# rough cost of a call until timings have been recorded: 30 s to start and 1 min per 5 Mb
+DEFAULT_OVERHEAD = 30.0
+DEFAULT_RATE = 60.0 / 5e6
+
+CostModel = collections.namedtuple('CostModel', ['overhead', 'rate', 'parallel_rate', 'points'])
+Plan = collections.namedtuple('Plan', ['jobs', 'threads', 'calls', 'wall_h', 'core_h', 'peak_memory_gb'])
+
+
+def assembly_bytes(path):
+    '''
+    size of an assembly in bytes, compressed assemblies counted as COMPRESSION_RATIO times their size
+    '''
+    size = file_size(path)
+    try:
+        method = compression(path)
+    except OSError:
+        method = None
+    return int(size * COMPRESSION_RATIO) if method else size
+
+
+def timing(group, threads, seconds):
+    '''
+    row of the history for a sistr call on a group of (sample ID, path)
+    '''
+    return [datetime.datetime.now().isoformat(timespec='seconds'), len(group), sum(assembly_bytes(contigs) for seqid, contigs in group), threads, round(seconds, 3)]
+
+
+def record(path, rows):
+    '''
+    append timings to the history, which is shared by the runs on the host
+    '''
+    if not rows:
+        return
+    path = f"{path}"
+    with locked(path):
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        pandas.DataFrame(rows, columns=COLUMNS).to_csv(path, mode='a', header=not exists, index=False)
+
+
+def load(path):
+    '''
+    the most recent HISTORY_ROWS timings, empty if none have been recorded
+    '''
+    path = f"{path}"
+    if not os.path.exists(path):
+        return pandas.DataFrame(columns=COLUMNS)
+    with locked(path):
+        return pandas.read_csv(path).tail(HISTORY_ROWS)
+
+
+def _fit_terms(terms, y):
+    '''
+    least squares fit of y to every subset of the terms, keeping the closest fit without a
+    negative coefficient (the first found, i.e. with fewest terms, when fits are as close)
+    '''
+    best, best_residual = {}, float(np.sum(y ** 2))
+    names = list(terms)
+    for k in range(1, len(names) + 1):
+        for subset in itertools.combinations(names, k):
+            a = np.column_stack([terms[name] for name in subset])
+            if np.linalg.matrix_rank(a) < k:
+                continue
+            coef = np.linalg.lstsq(a, y, rcond=None)[0]
+            if (coef < 0).any():
+                continue
+            residual = float(np.sum((a @ coef - y) ** 2))
+            if residual < best_residual - 1e-9 * max(best_residual, 1):
+                best, best_residual = dict(zip(subset, coef.tolist())), residual
+    return best
+
+
+def scales_with_threads(history):
+    '''
+    True if calls with different numbers of threads have been recorded, so the model can tell
+    how the time of a call changes with its threads
+    '''
+    return history['threads'].nunique() > 1
+
+
+def fit(history):
+    '''
+    fit the cost model to the history
+
+    >>> history = pandas.DataFrame({'bytes': [1e6, 2e6, 3e6, 4e6, 5e6], 'seconds': [30, 40, 50, 60, 70], 'threads': 1})
+    >>> model = fit(history)
+    >>> round(model.overhead), round(model.rate * 1e6), model.parallel_rate
+    (20, 10, 0.0)
+    '''
+    if len(history) == 0:
+        return CostModel(DEFAULT_OVERHEAD, DEFAULT_RATE, 0.0, 0)
+    x = history['bytes'].to_numpy(dtype=float)
+    y = history['seconds'].to_numpy(dtype=float)
+    terms = {'rate': x}
+    if scales_with_threads(history):
+        terms['parallel_rate'] = x / history['threads'].to_numpy(dtype=float)
+    terms['overhead'] = np.ones_like(x)
+    coef = _fit_terms(terms, y)
+    return CostModel(coef.get('overhead', 0.0), coef.get('rate', 0.0), coef.get('parallel_rate', 0.0), len(history))
+
+
+def cost(model, size, threads):
+    '''
+    predicted wall time (s) of a sistr call on size bytes of assemblies with threads threads
+
+    >>> cost(CostModel(30, 1e-5, 4e-5, 10), 1e6, 4)
+    50.0
+    '''
+    return model.overhead + size * (model.rate + model.parallel_rate / max(1, threads))
+
+
+def makespan(durations, jobs):
+    '''
+    wall time of running calls in the order given on jobs workers, each call starting on the first worker free
+
+    >>> makespan([4, 3, 2, 1], 2)
+    5.0
+    '''
+    workers = [0.0] * max(1, jobs)
+    for duration in durations:
+        heapq.heappush(workers, heapq.heappop(workers) + duration)
+    return max(workers)
+
+
+def plan(sizes, jobs, threads, batch_size, window, model):
+    '''
+    predict wall time, core-hours and peak memory of typing assemblies of the sizes given (bytes, in
+    the order of the manifest) with jobs sistr jobs of threads threads, dispatched as by stype run
+
+    >>> plan([5e6] * 4, 2, 1, 1, 1000, CostModel(30, 1e-5, 0.0, 10))
+    Plan(jobs=2, threads=1, calls=4, wall_h=0.044, core_h=0.089, peak_memory_gb=4.0)
+    '''
+    durations = []
+    for start in range(0, len(sizes), window):
+        ordered = sorted(sizes[start:start + window], reverse=True)
+        for i in range(0, len(ordered), batch_size):
+            durations.append(cost(model, sum(ordered[i:i + batch_size]), threads))
+    wall = makespan(durations, jobs)
+    return Plan(jobs, threads, len(durations), round(wall / 3600, 3), round(sum(durations) * threads / 3600, 3), round(min(jobs, len(durations)) * SISTR_MEMORY / 1024 ** 3, 1))
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+'''
+Streaming statistics on paired-end reads for the limit of detection workflow.
+
+Both mates are read once, and from the same pass we get the exact number of
+bases and an estimate of the genome size from the number of distinct k-mers
+seen at least a few times (the estimate reported by `mash sketch -r -m 5`).
+
+Pairs are subsampled by reading both mates together, so a single random draw
+decides if a pair is kept and the outputs stay in sync. Outputs are gzip
+compressed in independent blocks on several threads (zlib releases the GIL),
+and the blocks are written in order as concatenated gzip members, which any
+gzip reader handles as a single file.
+
+The statistics `seqkit stats --all` reports for the assemblies are computed
+in-process from the scan in styping.utils.fasta, for many assemblies at once.
+'''
+
+import collections
+import gzip
+import itertools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from styping.utils.fasta import n50, scan_lengths
+from styping.utils.kmers import BottomSketch
+
+# bases of sequence handed to numpy at a time
+BATCH_BASES = 4 * 1024 ** 2
+# pairs read at a time when subsampling
+BATCH_PAIRS = 100000
+# uncompressed bytes in each gzip block
+BLOCK_SIZE = 4 * 1024 ** 2
+
+ReadStats = collections.namedtuple('ReadStats', ['reads', 'total_length', 'genome_size'])
+
+# columns of `seqkit stats --all -T`
+SEQKIT_COLUMNS = ['file', 'format', 'type', 'num_seqs', 'sum_len', 'min_len', 'avg_len', 'max_len', 'Q1', 'Q2', 'Q3', 'sum_gap', 'N50', 'Q20(%)', 'Q30(%)']
+
+
+def open_fastq(filename):
+    '''
+    Open a FASTQ file, gzip compressed or not, as a binary stream
+    '''
+    with open(filename, 'rb') as f:
+        magic = f.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def sequence_batches(filename, batch_bases=BATCH_BASES):
+    '''
+    Yield batches of sequence lines from a FASTQ file, joined as a single bytes
+    object with the newline at the end of each read kept as a separator,
+    together with the number of reads in the batch
+    '''
+    with open_fastq(filename) as f:
+        batch = []
+        size = 0
+        for seq in itertools.islice(f, 1, None, 4):
+            batch.append(seq)
+            size += len(seq)
+            if size >= batch_bases:
+                yield b''.join(batch), len(batch)
+                batch = []
+                size = 0
+        if batch:
+            yield b''.join(batch), len(batch)
+
+
+def read_stats(*filenames, k=32, min_copies=5, sketch_size=1000):
+    '''
+    Count the reads and bases of one or more FASTQ files and estimate the
+    genome size, reading each file only once.
+
+    Input:
+    ------
+    filenames: str (paths to FASTQ files, e.g. R1 and R2)
+    k: int (k-mer size used to estimate the genome size)
+    min_copies: int (minimum copies of a k-mer for it to count towards the genome size)
+    sketch_size: int (number of hashes kept in the sketch)
+
+    Output:
+    -------
+    ReadStats(reads, total_length, genome_size)
+    '''
+    sketch = BottomSketch(size=sketch_size, k=k, min_copies=min_copies)
+    reads = 0
+    total_length = 0
+    for filename in filenames:
+        for batch, n in sequence_batches(filename):
+            reads += n
+            total_length += len(batch) - batch.count(b'\n') - batch.count(b'\r')
+            sketch.add(batch)
+    return ReadStats(reads, total_length, sketch.cardinality())
+
+
+class ParallelGzipWriter:
+    '''
+    A binary file-like writer that compresses blocks of data in parallel and
+    writes them, in order, as gzip members
+    '''
+
+    def __init__(self, filename, threads=1, compresslevel=6, block_size=BLOCK_SIZE):
+        self.out = open(filename, 'wb')
+        self.threads = max(1, int(threads))
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.pool = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = collections.deque()
+        self.buffer = []
+        self.size = 0
+
+    def _submit(self):
+        if not self.buffer:
+            return
+        block = b''.join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        self.pending.append(self.pool.submit(gzip.compress, block, self.compresslevel))
+        # bound the memory held by blocks waiting to be written
+        while len(self.pending) > 2 * self.threads:
+            self.out.write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.block_size:
+            self._submit()
+
+    def close(self):
+        self._submit()
+        while self.pending:
+            self.out.write(self.pending.popleft().result())
+        self.pool.shutdown()
+        self.out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_output(filename, threads=1):
+    '''
+    Open an output FASTQ, compressed in parallel if the name ends in .gz
+    '''
+    if str(filename).endswith('.gz'):
+        return ParallelGzipWriter(filename, threads=threads)
+    return open(filename, 'wb')
+
+
+def subsample_pairs(r1, r2, out1, out2, proportion, seed, threads=1):
+    '''
+    Keep a random proportion of read pairs, reading both mates together so
+    that the same pairs are kept in both outputs.
+
+    Input:
+    ------
+    r1, r2: str (paths to the FASTQ of each mate)
+    out1, out2: str (paths to the subsampled FASTQ, compressed if they end in .gz)
+    proportion: float (proportion of pairs to keep)
+    seed: int (seed for the random draws)
+    threads: int (threads used to compress each output)
+
+    Output:
+    -------
+    kept: int (number of pairs kept)
+    '''
+    rng = np.random.default_rng(seed)
+    kept = 0
+    with open_fastq(r1) as f1, open_fastq(r2) as f2, open_output(out1, threads) as s1, open_output(out2, threads) as s2:
+        while True:
+            lines1 = list(itertools.islice(f1, 4 * BATCH_PAIRS))
+            lines2 = list(itertools.islice(f2, 4 * BATCH_PAIRS))
+            if len(lines1) != len(lines2) or len(lines1) % 4 != 0:
+                raise ValueError(f"{r1} and {r2} do not have the same number of complete reads")
+            if not lines1:
+                break
+            keep = rng.random(len(lines1) // 4) < proportion
+            kept += int(keep.sum())
+            keep = np.repeat(keep, 4).tolist()
+            s1.write(b''.join(itertools.compress(lines1, keep)))
+            s2.write(b''.join(itertools.compress(lines2, keep)))
+    return kept
+
+
+def _median(lengths):
+    n = len(lengths)
+    if n == 0:
+        return 0.0
+    if n % 2 == 0:
+        return (lengths[n // 2 - 1] + lengths[n // 2]) / 2
+    return float(lengths[n // 2])
+
+
+def quartiles(lengths):
+    '''
+    Quartiles of contig lengths, computed as seqkit does (medians of each half)
+
+    >>> quartiles([1, 2, 3, 4, 5])
+    (1.5, 3.0, 4.5)
+    '''
+    lengths = sorted(lengths)
+    n = len(lengths)
+    if n == 0:
+        return 0.0, 0.0, 0.0
+    lower, upper = (n // 2, n // 2) if n % 2 == 0 else ((n - 1) // 2, (n + 1) // 2)
+    return _median(lengths[:lower]), _median(lengths), _median(lengths[upper:])
+
+
+def seqkit_stats(path):
+    '''
+    The row `seqkit stats --all -T` reports for a FASTA file, as a dict
+    '''
+    lengths, invalid, gaps = scan_lengths(path) or ([], 0, 0)
+    q1, q2, q3 = quartiles(lengths)
+    return {
+        'file': str(path),
+        'format': 'FASTA',
+        'type': 'DNA',
+        'num_seqs': len(lengths),
+        'sum_len': sum(lengths),
+        'min_len': min(lengths, default=0),
+        'avg_len': round(sum(lengths) / len(lengths), 1) if lengths else 0.0,
+        'max_len': max(lengths, default=0),
+        'Q1': q1,
+        'Q2': q2,
+        'Q3': q3,
+        'sum_gap': gaps,
+        'N50': n50(lengths),
+        'Q20(%)': 0.0,
+        'Q30(%)': 0.0
+    }
+
+
+def seqkit_stats_table(paths, jobs=1):
+    '''
+    seqkit stats --all rows for many FASTA files, computed in parallel, in the order given
+    '''
+    paths = list(paths)
+    if jobs <= 1 or len(paths) <= 1:
+        return [seqkit_stats(p) for p in paths]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(seqkit_stats, paths, chunksize=max(1, len(paths) // (jobs * 4))))
@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+
+from styping.utils import cgmlst
+
+
+def profiles(rows, loci = 6):
+    return pd.DataFrame([[f"{a}" if a else '' for a in row] for row in rows.values()], index = list(rows), columns = [f"locus_{i}" for i in range(loci)])
+
+
+def test_profile_store(tmp_path):
+    """
+    assert profiles are appended to the store, read back as a memmap and a stopped append is dropped
+    """
+    store = cgmlst.ProfileStore(tmp_path / "store")
+    assert store.add(profiles({'a': [1, 2, 3, 4, 5, 6], 'b': [1, 2, 3, 4, 5, 0]}), run = 'run1') == 2
+    # the run adding these was stopped before it recorded its samples
+    with open(tmp_path / "store" / cgmlst.PROFILES, 'ab') as f:
+        f.write(b'\x01' * 10)
+    store = cgmlst.ProfileStore(tmp_path / "store")
+    store.add(profiles({'a': [9, 2, 3, 4, 5, 6]}), run = 'run2')
+    store = cgmlst.ProfileStore(tmp_path / "store")
+    assert store.matrix().tolist() == [[1, 2, 3, 4, 5, 6], [1, 2, 3, 4, 5, 0], [9, 2, 3, 4, 5, 6]]
+    assert store.latest().tolist() == [1, 2]
+    assert list(store.samples['run']) == ['run1', 'run1', 'run2']
+
+
+def test_nearest_blocks():
+    """
+    assert blocked and threaded nearest neighbours match distances computed in one go
+    """
+    rng = np.random.default_rng(0)
+    refs = rng.integers(1, 4, (500, 40)).astype(np.uint32)
+    refs[rng.random(refs.shape) < 0.05] = cgmlst.MISSING
+    queries = refs[:7]
+    expected = ((queries[:, None, :] != refs[None, :, :]) & (queries[:, None, :] != 0) & (refs[None, :, :] != 0)).sum(axis = 2)
+    assert np.array_equal(cgmlst.hamming(queries, refs, jobs = 3, tile_bytes = 5000), expected)
+    rows, distances, shared = cgmlst.nearest(queries, refs, k = 5, jobs = 3, exclude = range(7), tile_bytes = 5000)
+    for i in range(7):
+        assert i not in rows[i]
+        assert sorted(distances[i]) == sorted(np.delete(expected[i], i))[:5]
+        assert np.array_equal(expected[i][rows[i]], distances[i])
+    rows, distances, shared = cgmlst.nearest(queries[:1], refs[:2], k = 3)
+    assert rows[0].tolist()[2] == -1
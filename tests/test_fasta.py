@@ -0,0 +1,101 @@
+import gzip, pathlib, shutil, subprocess
+
+from styping.utils import fasta
+
+test_folder = pathlib.Path(__file__).parent
+
+
+def test_scan_contigs():
+    """
+    assert statistics are collected for a valid assembly
+    """
+    stats = fasta.scan_fasta(test_folder / "contigs.fa")
+    assert stats.contigs == 1
+    assert stats.total_length == 420
+    assert stats.n50 == 420
+    assert stats.invalid_characters == 0
+
+
+def test_scan_multiple_contigs(tmp_path):
+    """
+    assert contigs are split on headers and invalid characters counted
+    """
+    p = tmp_path / "asm.fa"
+    p.write_text(">c1\nACGT\nACGT\n>c2\nAC!!\n>c3\n")
+    stats = fasta.scan_fasta(p)
+    assert stats.contigs == 3
+    assert stats.total_length == 12
+    assert stats.max_length == 8
+    assert stats.n50 == 8
+    assert stats.invalid_characters == 2
+    assert stats.empty_contigs == 1
+
+
+def test_scan_not_fasta(tmp_path):
+    """
+    assert empty and non FASTA files are rejected
+    """
+    empty = tmp_path / "empty.fa"
+    empty.write_text("")
+    other = tmp_path / "other.fa"
+    other.write_text("sample\tpath\n")
+    assert fasta.scan_fasta(empty) is None
+    assert fasta.scan_fasta(other) is None
+    assert fasta.assess(None)[0] == 'REJECT'
+
+
+def test_preflight(tmp_path):
+    """
+    assert a too short assembly is rejected and a valid one is flagged
+    """
+    p = tmp_path / "asm.fa"
+    p.write_text(">c1\n" + "ACGT" * 50 + "\n")
+    rows = fasta.preflight([('short', p), ('ok', p)], jobs = 2, min_length = 100)
+    assert [r[0] for r in rows] == ['short', 'ok']
+    assert rows[0][-2] == 'FLAG'
+    rows = fasta.preflight([('short', p)], min_length = 1000)
+    assert rows[0][-2] == 'REJECT'
+
+
+def test_preflight_truncated(tmp_path):
+    """
+    assert a truncated compressed assembly is rejected instead of stopping the pre-flight check
+    """
+    p = tmp_path / "asm.fa"
+    p.write_text(">c1\n" + "ACGT" * 50 + "\n")
+    gz = tmp_path / "truncated.fa.gz"
+    gz.write_bytes(gzip.compress(p.read_bytes())[:-12])
+    rows = fasta.preflight([('truncated', gz), ('ok', p)], jobs = 2, min_length = 100)
+    assert rows[0][-2] == 'REJECT'
+    assert 'could not be read' in rows[0][-1]
+    assert rows[1][-2] == 'FLAG'
+
+
+def test_scan_compressed(tmp_path):
+    """
+    assert gzip and zstd assemblies give the same statistics as plain FASTA
+    """
+    p = tmp_path / "asm.fa"
+    p.write_text(">c1\nACGT\nACGT\n>c2\nACGTN\n")
+    gz = tmp_path / "asm.fa.gz"
+    gz.write_bytes(gzip.compress(p.read_bytes()))
+    assert fasta.compression(gz) == 'gzip'
+    assert fasta.compression(p) is None
+    assert fasta.scan_fasta(gz) == fasta.scan_fasta(p)
+    if shutil.which('zstd'):
+        zst = tmp_path / "asm.fa.zst"
+        subprocess.run(['zstd', '-q', str(p), '-o', str(zst)], check = True)
+        assert fasta.compression(zst) == 'zstd'
+        assert fasta.scan_fasta(zst) == fasta.scan_fasta(p)
+
+
+def test_scan_stream_chunks(tmp_path, monkeypatch):
+    """
+    assert records split across chunks are counted once
+    """
+    monkeypatch.setattr(fasta, 'CHUNK_SIZE', 7)
+    p = tmp_path / "asm.fa"
+    p.write_text(">c1\nACGTACGTACGT\n>c2\nAC\nGT\n>c3\nA\n")
+    gz = tmp_path / "asm.fa.gz"
+    gz.write_bytes(gzip.compress(p.read_bytes()))
+    assert fasta.scan_lengths(gz) == ([12, 4, 1], 0, 0)
@@ -0,0 +1,63 @@
+import os, threading, time
+
+import pytest
+
+from styping.utils.files import run_directory, atomic_write, locked
+
+
+def test_run_directory_unique(tmp_path, monkeypatch):
+    """
+    assert runs started at the same time from the same directory get different directories
+    """
+    monkeypatch.chdir(tmp_path)
+    first = run_directory()
+    second = run_directory()
+    assert first != second
+    assert first.is_dir() and second.is_dir()
+    assert run_directory('given/run') == tmp_path.joinpath('given/run').relative_to(tmp_path)
+    assert (tmp_path / 'given' / 'run').is_dir()
+
+
+def test_atomic_write_keeps_old_file_on_error(tmp_path):
+    """
+    assert a failed write leaves the previous file untouched and no temporary file behind
+    """
+    out = tmp_path / "results.csv"
+    out.write_text("old")
+    with pytest.raises(RuntimeError):
+        with atomic_write(out) as f:
+            f.write("partial")
+            raise RuntimeError
+    assert out.read_text() == "old"
+    assert os.listdir(tmp_path) == ["results.csv"]
+
+
+def test_atomic_write_permissions(tmp_path):
+    """
+    assert outputs get the permissions of any new file rather than those of a private temporary file
+    """
+    from styping.utils.files import UMASK
+    out = tmp_path / "results.csv"
+    with atomic_write(out) as f:
+        f.write("done")
+    assert os.stat(out).st_mode & 0o777 == 0o666 & ~UMASK
+
+
+def test_locked_is_exclusive(tmp_path):
+    """
+    assert a second holder waits for the lock to be released
+    """
+    cache = tmp_path / "cache.csv"
+    events = []
+    def hold():
+        with locked(cache):
+            events.append('first in')
+            time.sleep(0.2)
+            events.append('first out')
+    t = threading.Thread(target = hold)
+    t.start()
+    time.sleep(0.05)
+    with locked(cache):
+        events.append('second in')
+    t.join()
+    assert events == ['first in', 'first out', 'second in']
@@ -0,0 +1,37 @@
+import os
+
+from styping.utils.journal import Journal, fingerprint
+
+
+def test_journal_resume(tmp_path):
+    """
+    assert samples and stages recorded by an interrupted run are read back, and changed ones are not skipped
+    """
+    path = tmp_path / "stype_journal.jsonl"
+    a, b = tmp_path / "a.fa", tmp_path / "b.fa"
+    a.write_text(">a\nACGT\n")
+    b.write_text(">b\nACGT\n")
+    results = tmp_path / "a.csv"
+    results.write_text("genome\na\n")
+    journal = Journal(path)
+    journal.start(input = 'batch.tab', run_type = 'batch')
+    journal.record_sample('a', a, results)
+    journal.record_sample('b', b)
+    journal.record_stage('parse', {'results': [results]}, {'filtered': results})
+    # the run is stopped while writing a record
+    with open(path, 'a') as f:
+        f.write('{"event": "sample", "id": "c"')
+    resumed = Journal(path, resume = True)
+    assert resumed.differences(input = 'batch.tab', run_type = 'assembly') == ['run_type']
+    assert resumed.typed('a', a, results) and resumed.typed('b', b)
+    assert not resumed.typed('c', a)
+    assert resumed.completed('parse', {'results': [results]}, {'filtered': results})
+    b.write_text(">b\nACGTACGT\n")
+    assert not resumed.typed('b', b)
+    assert resumed.changed == ['b']
+    os.utime(results, ns = (0, 0))
+    assert not resumed.typed('a', a, results)
+    assert not resumed.completed('parse', {'results': [results]}, {'filtered': results})
+    # a new run starts a new journal
+    assert not Journal(path).typed('a', a, results)
+    assert fingerprint(results) == f"{results.stat().st_size}:0"
@@ -0,0 +1,125 @@
+import gzip, random
+
+from styping.utils import kmers
+from styping.validation.limitOfDetection.reads import read_stats
+
+
+def random_genome(length, seed = 42):
+    rng = random.Random(seed)
+    return ''.join(rng.choice('ACGT') for _ in range(length))
+
+
+def test_kmer_hashes_canonical():
+    """
+    assert a sequence and its reverse complement have the same k-mers
+    """
+    seq = random_genome(500)
+    rc = seq[::-1].translate(str.maketrans('ACGT', 'TGCA'))
+    a = kmers.kmer_hashes(seq.encode(), k = 21)
+    b = kmers.kmer_hashes(rc.encode(), k = 21)
+    assert len(a) == 480
+    assert sorted(a.tolist()) == sorted(b.tolist())
+
+
+def test_kmer_hashes_skip_separators():
+    """
+    assert k-mers spanning a newline or N are skipped
+    """
+    assert len(kmers.kmer_hashes(b'ACGTA\nACGTA\n', k = 5)) == 2
+    assert len(kmers.kmer_hashes(b'ACGTNACGT', k = 5)) == 0
+
+
+def test_sketch_min_copies():
+    """
+    assert only k-mers seen at least min_copies times are counted
+    """
+    seq = random_genome(1000).encode()
+    sketch = kmers.BottomSketch(size = 5000, k = 21, min_copies = 2)
+    sketch.add(seq)
+    assert sketch.cardinality() == 0
+    sketch.add(seq)
+    assert sketch.cardinality() == 980
+
+
+def test_sketch_estimate():
+    """
+    assert the estimate of distinct k-mers is close when the sketch is full
+    """
+    seq = random_genome(100000).encode()
+    sketch = kmers.BottomSketch(size = 1000, k = 21)
+    sketch.add(seq)
+    assert abs(sketch.cardinality() - 99980) / 99980 < 0.1
+
+
+def test_read_stats(tmp_path):
+    """
+    assert bases are counted exactly over both mates and the genome size estimated
+    """
+    genome = random_genome(50000)
+    rng = random.Random(1)
+    r1 = tmp_path / "R1.fastq.gz"
+    r2 = tmp_path / "R2.fastq.gz"
+    with gzip.open(r1, 'wt') as f1, gzip.open(r2, 'wt') as f2:
+        for i in range(2000):
+            p = rng.randint(0, len(genome) - 300)
+            f1.write(f"@r{i}\n{genome[p:p + 150]}\n+\n{'I' * 150}\n")
+            f2.write(f"@r{i}\n{genome[p + 150:p + 300]}\n+\n{'I' * 150}\n")
+    stats = read_stats(r1, r2, k = 21, min_copies = 2)
+    assert stats.reads == 4000
+    assert stats.total_length == 600000
+    assert abs(stats.genome_size - 50000) / 50000 < 0.15
+
+
+def test_subsample_pairs(tmp_path):
+    """
+    assert pairs are kept in sync, reproducibly, and written as valid gzip
+    """
+    from styping.validation.limitOfDetection import reads
+    r1 = tmp_path / "R1.fastq.gz"
+    r2 = tmp_path / "R2.fastq.gz"
+    with gzip.open(r1, 'wt') as f1, gzip.open(r2, 'wt') as f2:
+        for i in range(1000):
+            f1.write(f"@r{i}/1\nACGT\n+\nIIII\n")
+            f2.write(f"@r{i}/2\nTGCA\n+\nIIII\n")
+    s1 = tmp_path / "S1.fastq.gz"
+    s2 = tmp_path / "S2.fastq.gz"
+    kept = reads.subsample_pairs(r1, r2, s1, s2, 0.3, 7, threads = 2)
+    names1 = gzip.open(s1, 'rt').read().split('\n')[0::4][:-1]
+    names2 = gzip.open(s2, 'rt').read().split('\n')[0::4][:-1]
+    assert 200 < kept < 400
+    assert len(names1) == kept
+    assert [n[:-2] for n in names1] == [n[:-2] for n in names2]
+    again = tmp_path / "A1.fastq.gz"
+    reads.subsample_pairs(r1, r2, again, tmp_path / "A2.fastq.gz", 0.3, 7)
+    assert gzip.open(again, 'rt').read() == gzip.open(s1, 'rt').read()
+
+
+def test_parallel_gzip_blocks(tmp_path):
+    """
+    assert data split in several blocks decompresses to the original
+    """
+    from styping.validation.limitOfDetection import reads
+    out = tmp_path / "out.gz"
+    data = [f"line {i}\n".encode() for i in range(10000)]
+    with reads.ParallelGzipWriter(out, threads = 3, block_size = 1000) as w:
+        for d in data:
+            w.write(d)
+    assert gzip.open(out).read() == b''.join(data)
+
+
+def test_seqkit_stats(tmp_path):
+    """
+    assert the seqkit stats --all columns are reproduced
+    """
+    from styping.validation.limitOfDetection import reads
+    p = tmp_path / "asm.fa"
+    p.write_text(">c1\nACGT-A\n>c2\nAC\n>c3\nACGTACGTAC\n>c4\nA\n>c5\nACG\n")
+    rows = reads.seqkit_stats_table([p, p], jobs = 2)
+    assert list(rows[0]) == reads.SEQKIT_COLUMNS
+    assert rows[0] == rows[1]
+    assert rows[0]['num_seqs'] == 5
+    assert rows[0]['sum_len'] == 22
+    assert rows[0]['avg_len'] == 4.4
+    assert (rows[0]['Q1'], rows[0]['Q2'], rows[0]['Q3']) == (1.5, 3.0, 8.0)
+    assert rows[0]['sum_gap'] == 1
+    assert rows[0]['N50'] == 6
@@ -0,0 +1,74 @@
+import pytest
+
+from styping.utils.manifest import Manifest, manifest_format
+
+
+def assemblies(tmp_path, names):
+    for name in names:
+        (tmp_path / name).write_text(">c\nACGT\n")
+    return [f"{tmp_path / name}" for name in names]
+
+
+def test_manifest_format(tmp_path):
+    assert manifest_format(f"{tmp_path}") == 'glob'
+    assert manifest_format('runs/*.fa') == 'glob'
+    assert manifest_format('samples.CSV') == 'csv'
+    assert manifest_format('samples.pq') == 'parquet'
+    assert manifest_format('samples.txt') == 'tsv'
+
+
+def test_tsv_manifest(tmp_path):
+    """
+    assert a header is skipped, extra columns are ignored and bad rows are kept aside
+    """
+    a, b = assemblies(tmp_path, ['a.fa', 'b.fa'])
+    source = tmp_path / 'input.txt'
+    source.write_text(f"ID\tpath\nA\t{a}\textra\n\nbroken\nB\t{b}\n")
+    m = Manifest(source)
+    assert list(m) == [('A', a), ('B', b)]
+    assert [row for row, reason in m.skipped] == [4]
+    with pytest.raises(ValueError):
+        m.sniff()
+    assert m.sniff(1) == [('A', a)]
+
+
+def test_csv_manifest(tmp_path):
+    a, b = assemblies(tmp_path, ['a.fa', 'b.fa'])
+    source = tmp_path / 'input.csv'
+    source.write_text(f"sample,contigs\nA,{a}\n\"B,1\",{b}\n")
+    assert list(Manifest(source)) == [('A', a), ('B,1', b)]
+
+
+def test_glob_manifest(tmp_path):
+    """
+    assert sample IDs are taken from file names, with or without a pattern
+    """
+    a, b, c = assemblies(tmp_path, ['2021-001_S1.fa.gz', '2021-002_S2.fasta', 'notes.txt'])
+    assert sorted(Manifest(f"{tmp_path}")) == [('2021-001_S1', a), ('2021-002_S2', b)]
+    assert sorted(Manifest(f"{tmp_path}/*.fa*", id_pattern = r'(?P<id>\d{4}-\d{3})_S')) == [('2021-001', a), ('2021-002', b)]
+
+
+def test_glob_manifest_directory_id(tmp_path):
+    """
+    assert the pattern is matched against the path below the glob root, and repeated IDs are skipped
+    """
+    paths = []
+    for run in ['S1', 'S2']:
+        (tmp_path / 'runs' / run).mkdir(parents = True)
+        paths += assemblies(tmp_path / 'runs' / run, ['contigs.fa'])
+    m = Manifest(f"{tmp_path}/runs/*/contigs.fa", id_pattern = r'(?P<id>[^/]+)')
+    assert sorted(m) == [('S1', paths[0]), ('S2', paths[1])]
+    m = Manifest(f"{tmp_path}/runs/*/contigs.fa")
+    assert [seqid for seqid, path in m] == ['contigs']
+    assert len(m.skipped) == 1
+    with pytest.raises(ValueError):
+        m.sniff()
+
+
+def test_parquet_manifest(tmp_path):
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.parquet as pq
+    a, b = assemblies(tmp_path, ['a.fa', 'b.fa'])
+    source = tmp_path / 'input.parquet'
+    pq.write_table(pa.table({'ID': ['A', 'B'], 'path': [a, b], 'priority': [1, 2]}), source)
+    assert list(Manifest(source)) == [('A', a), ('B', b)]
@@ -0,0 +1,47 @@
+from styping.utils.metrics import Metrics
+
+
+def metric(text, name):
+    return {line.rsplit(' ', 1)[0]: float(line.rsplit(' ', 1)[1]) for line in text.splitlines() if line.startswith(name)}
+
+
+def test_metrics_textfile(tmp_path):
+    """
+    assert samples are counted through the queue and written in the Prometheus text format
+    """
+    textfile = tmp_path / "stype.prom"
+    metrics = Metrics()
+    metrics.start(textfile, command = 'run_pipeline', run = 'batch1')
+    metrics.queue(3)
+    metrics.started(2)
+    metrics.finished([True, False])
+    metrics.reject(1, queued = True)
+    metrics.observe_job(45)
+    metrics.observe_job(4000)
+    metrics.lookup('verify', hits = 3, misses = 1)
+    metrics.count_status(['PASS', 'PASS', 'FAIL'])
+    metrics.stop()
+    text = textfile.read_text()
+    labels = 'command="run_pipeline",run="batch1"'
+    assert metric(text, 'stype_samples_queued')[f'stype_samples_queued{{{labels}}}'] == 0
+    assert metric(text, 'stype_samples_done_total')[f'stype_samples_done_total{{{labels}}}'] == 1
+    assert metric(text, 'stype_samples_failed_total')[f'stype_samples_failed_total{{{labels}}}'] == 1
+    assert metric(text, 'stype_samples_rejected_total')[f'stype_samples_rejected_total{{{labels}}}'] == 1
+    buckets = metric(text, 'stype_sistr_job_seconds_bucket')
+    assert buckets[f'stype_sistr_job_seconds_bucket{{{labels},le="30"}}'] == 0
+    assert buckets[f'stype_sistr_job_seconds_bucket{{{labels},le="60"}}'] == 1
+    assert buckets[f'stype_sistr_job_seconds_bucket{{{labels},le="+Inf"}}'] == 2
+    assert metric(text, 'stype_sistr_job_seconds_sum')[f'stype_sistr_job_seconds_sum{{{labels}}}'] == 4045
+    assert metric(text, 'stype_cache_lookups_total')[f'stype_cache_lookups_total{{{labels},cache="verify",result="miss"}}'] == 1
+    assert metric(text, 'stype_samples_status_total')[f'stype_samples_status_total{{{labels},status="PASS"}}'] == 2
+    assert '# TYPE stype_sistr_job_seconds histogram' in text
+
+
+def test_metrics_off():
+    """
+    assert nothing is recorded unless metrics were started
+    """
+    metrics = Metrics()
+    metrics.queue(3)
+    metrics.finished([True])
+    assert metrics.queued == 0 and metrics.done == 0
@@ -0,0 +1,80 @@
+import gzip, random
+
+import numpy as np
+
+from styping.utils import prescreen
+from styping.utils.fasta import sequence_batches
+
+
+def random_genome(length, seed = 42):
+    rng = random.Random(seed)
+    return ''.join(rng.choice('ACGT') for _ in range(length))
+
+
+def mutate(genome, rate, seed = 1):
+    rng = random.Random(seed)
+    return ''.join(rng.choice('ACGT'.replace(b, '')) if rng.random() < rate else b for b in genome)
+
+
+def write_fasta(path, genome, contig = 10000):
+    with open(path, 'w') as f:
+        for i in range(0, len(genome), contig):
+            f.write(f">contig_{i}\n{genome[i:i + contig]}\n")
+
+
+def test_sequence_batches_skip_headers(tmp_path):
+    """
+    assert headers are not part of the sequence and contigs are kept apart
+    """
+    fa = tmp_path / "a.fa"
+    fa.write_text(">ACGTACGT\nAAAA\nCCCC\n>GGGG\nTTTT\n")
+    assert b''.join(sequence_batches(fa)).split() == [b'AAAA', b'CCCC', b'TTTT']
+
+
+def test_sketch_compressed(tmp_path):
+    """
+    assert a compressed assembly gives the same sketch
+    """
+    genome = random_genome(30000)
+    fa = tmp_path / "a.fa"
+    write_fasta(fa, genome)
+    with gzip.open(tmp_path / "a.fa.gz", 'wt') as f:
+        f.write(fa.read_text())
+    plain = prescreen.sketch_fasta(fa, size = 200)
+    assert len(plain) == 200
+    assert np.array_equal(plain, prescreen.sketch_fasta(tmp_path / "a.fa.gz", size = 200))
+
+
+def test_screen_closest_serovar(tmp_path):
+    """
+    assert the serovar of the closest reference is reported with the margin to the next one
+    """
+    typhimurium = random_genome(50000, seed = 1)
+    enteritidis = random_genome(50000, seed = 2)
+    write_fasta(tmp_path / "typhimurium.fa", typhimurium)
+    write_fasta(tmp_path / "enteritidis.fa", enteritidis)
+    write_fasta(tmp_path / "query.fa", mutate(enteritidis, 0.001))
+    panel = prescreen.build_panel([('Typhimurium', f"{tmp_path / 'typhimurium.fa'}"), ('Enteritidis', f"{tmp_path / 'enteritidis.fa'}")], size = 500)
+    prescreen.save_panel(panel, tmp_path / "panel.npz")
+    panel = prescreen.load_panel(tmp_path / "panel.npz")
+    assert panel.serovars == ['Typhimurium', 'Enteritidis']
+    rows = prescreen.screen_samples([('query', f"{tmp_path / 'query.fa'}"), ('other', f"{tmp_path / 'typhimurium.fa'}")], panel)
+    query = dict(zip(prescreen.COLUMNS, rows[0]))
+    assert query['PRESCREEN_SEROVAR'] == 'Enteritidis'
+    assert query['PRESCREEN_NEXT'] == 'Typhimurium'
+    assert query['PRESCREEN_SCORE'] > 0.9
+    assert query['PRESCREEN_MARGIN'] > 0.9
+    assert rows[1][2] == 'Typhimurium'
+    assert rows[1][3] == 1.0
+
+
+def test_screen_no_close_reference(tmp_path):
+    """
+    assert no serovar is suggested when every reference is far away
+    """
+    write_fasta(tmp_path / "ref.fa", random_genome(20000, seed = 1))
+    write_fasta(tmp_path / "query.fa", random_genome(20000, seed = 2))
+    panel = prescreen.build_panel([('Typhimurium', f"{tmp_path / 'ref.fa'}")], size = 200)
+    row = prescreen.screen_samples([('query', f"{tmp_path / 'query.fa'}")], panel)[0]
+    assert row[2] == ''
+    assert row[3] < prescreen.MIN_SCORE
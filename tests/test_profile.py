@@ -0,0 +1,55 @@
+import subprocess, sys, time
+
+import pandas
+
+from styping.utils.profile import Profiler, COLUMNS
+
+
+def test_stages_nested(tmp_path):
+    """
+    assert nested stages are reported by path and the folded stacks hold exclusive time
+    """
+    profiler = Profiler()
+    profiler.start()
+    with profiler.stage('parse'):
+        for _ in range(2):
+            with profiler.stage('rules'):
+                time.sleep(0.05)
+    profiler.stop()
+    rows = {row[0]: dict(zip(COLUMNS, row)) for row in profiler.rows()}
+    assert list(rows) == ['parse', 'parse;rules']
+    assert rows['parse;rules']['calls'] == 2
+    assert rows['parse']['wall_s'] >= rows['parse;rules']['wall_s'] >= 0.1
+    assert rows['parse']['peak_rss_mb'] > 0
+    folded = dict(line.rsplit(' ', 1) for line in profiler.folded())
+    assert int(folded['parse;rules']) >= 100
+    assert int(folded['parse']) < 50
+    profiler.write(tmp_path / "run.profile.csv", tmp_path / "run.folded")
+    assert pandas.read_csv(tmp_path / "run.profile.csv").columns.tolist() == COLUMNS
+    assert (tmp_path / "run.folded").read_text().startswith("parse ")
+
+
+def test_stages_children_peak():
+    """
+    assert the peak memory of the programs run is reported for the stages that ran them
+    """
+    profiler = Profiler()
+    profiler.start()
+    with profiler.stage('sistr'):
+        subprocess.run([sys.executable, '-c', 'x = bytearray(64 * 1024 ** 2)'], check = True)
+    with profiler.stage('parse'):
+        pass
+    profiler.stop()
+    rows = {row[0]: dict(zip(COLUMNS, row)) for row in profiler.rows()}
+    assert rows['sistr']['children_peak_rss_mb'] >= 64
+    assert rows['parse']['children_peak_rss_mb'] == 0
+
+
+def test_stages_off():
+    """
+    assert nothing is recorded unless profiling was started
+    """
+    profiler = Profiler()
+    with profiler.stage('setup'):
+        pass
+    assert profiler.rows() == []
@@ -0,0 +1,32 @@
+import numpy as np
+import pandas as pd
+
+from styping.utils.serovars import SerovarIndex, MISSING
+from styping.utils.rules import rule_all_serovar_calls_must_match
+
+
+def test_serovar_index():
+    """
+    assert names get the same ID across columns and containment is worked out once per pair of names
+    """
+    index = SerovarIndex()
+    serovar = index.ids(pd.Series(['Paratyphi B', 'Typhimurium', 'Paratyphi B', np.nan]))
+    antigen = index.ids(pd.Series(['Paratyphi B var. Java|Limete', 'Typhimurium|Lagos', 'Limete', 'Limete']))
+    assert serovar[0] == serovar[2] and serovar[3] == MISSING
+    assert index.contains(serovar, antigen).tolist() == [True, True, False, False]
+    assert len(index.contained) == 3
+    assert index.contains(np.array([], dtype = int), np.array([], dtype = int)).tolist() == []
+
+
+def test_rule_all_serovar_calls_must_match():
+    """
+    assert serovar must equal serovar_cgmlst and be a substring of serovar_antigen
+    """
+    tab = pd.DataFrame({
+        'serovar': ['Typhimurium', 'Typhimurium', 'Paratyphi B', 'Dublin', np.nan],
+        'serovar_cgmlst': ['Typhimurium', 'Enteritidis', 'Paratyphi B', 'Dublin', np.nan],
+        'serovar_antigen': ['Typhimurium|Lagos', 'Typhimurium|Lagos', 'Paratyphi B var. Java|Limete', 'Enteritidis', 'Dublin']
+    })
+    mask = rule_all_serovar_calls_must_match(tab)
+    assert mask.tolist() == [True, False, True, False, False]
+    assert mask.name == 'rule_all_serovar_calls_must_match'
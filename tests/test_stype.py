@@ -1,8 +1,10 @@
-import sys, pathlib, pandas, pytest, numpy, logging, collections
+import sys, pathlib, pandas, pytest, numpy, logging, collections, gzip, os, subprocess
 
 from unittest.mock import patch, PropertyMock
 
-from styping.Typing import SetupTyping,RunTyping
+from styping.Typing import SetupTyping,RunTyping,PANEL
+from styping.Parse import VerifySistr, ReplaySistr
+import styping.utils.resources as resources
 
 test_folder = pathlib.Path(__file__).parent
 
@@ -26,6 +28,8 @@ def test_check_run_type_batch():
         stype_obj = SetupTyping()
         stype_obj.contigs = f"{test_folder / 'batch.txt'}"
         stype_obj.prefix = ''
+        stype_obj.manifest_format = 'auto'
+        stype_obj.id_pattern = ''
         stype_obj.logger = logging.getLogger(__name__)
         assert stype_obj._get_input_shape() == 'batch'
 
@@ -37,6 +41,8 @@ def test_check_run_type_single():
         stype_obj = SetupTyping()
         stype_obj.contigs = f"{test_folder / 'contigs.fa'}"
         stype_obj.prefix = 'somename'
+        stype_obj.manifest_format = 'auto'
+        stype_obj.id_pattern = ''
         stype_obj.logger = logging.getLogger(__name__)
         assert stype_obj._get_input_shape() == 'assembly'
 
@@ -48,6 +54,8 @@ def test_check_run_type_wrong_data():
         stype_obj = SetupTyping()
         stype_obj.contigs = f"{test_folder / 'batch_fail.txt'}"
         stype_obj.prefix = ''
+        stype_obj.manifest_format = 'auto'
+        stype_obj.id_pattern = ''
         stype_obj.logger = logging.getLogger(__name__)
         with pytest.raises(SystemExit):
             stype_obj._get_input_shape()
@@ -74,16 +82,36 @@ def test_prefix_empty():
             stype_obj._check_prefix()
        
 
-def test_setup_contigs():
+def test_setup_contigs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
     with patch.object(SetupTyping, "__init__", lambda x: None):
         stype_obj = SetupTyping()
         stype_obj.contigs = f"{test_folder / 'contigs.fa'}"
         stype_obj.prefix = 'somename'
+        stype_obj.manifest_format = 'auto'
+        stype_obj.id_pattern = ''
         stype_obj.jobs  = 16
+        stype_obj.threads = 4
+        stype_obj.min_length = 0
+        stype_obj.max_contigs = 5000
+        stype_obj.tmp_dir = ''
+        stype_obj.stream = ''
+        stype_obj.prescreen = ''
+        stype_obj.batch_size = 1
+        stype_obj.window = 1000
+        stype_obj.partial = False
+        stype_obj.merge = ''
+        stype_obj.mdu = False
+        stype_obj.runid = ''
+        stype_obj.resume = False
+        stype_obj.cgmlst_store = ''
+        stype_obj.outdir = ''
         stype_obj.logger = logging.getLogger(__name__)
-        T = collections.namedtuple('T', ['run_type', 'input', 'prefix', 'jobs'])
-        input_data = T('assembly', stype_obj.contigs, stype_obj.prefix, stype_obj.jobs)
-        assert stype_obj.setup() == input_data
+        T = collections.namedtuple('T', ['run_type', 'input', 'prefix', 'jobs', 'threads', 'samples', 'tmp_dir', 'stream', 'batch_size', 'outdir', 'window', 'manifest_format', 'partial', 'merge', 'priority', 'runid', 'journal', 'cgmlst'])
+        input_data = T('assembly', stype_obj.contigs, stype_obj.prefix, 1, stype_obj.threads, [(stype_obj.prefix, stype_obj.contigs)], '', '', 1, '', 1000, '', False, '', {}, '', None, '')
+        # the journal of the run is tested in test_journal_resume
+        with patch.object(SetupTyping, "_journal", lambda x, running_type: None):
+            assert stype_obj.setup() == input_data
 
 
 def test_setup_fail():
@@ -91,21 +119,57 @@ def test_setup_fail():
         stype_obj = SetupTyping()
         stype_obj.contigs = f"{test_folder / 'batch.txt'}"
         stype_obj.prefix = ''
+        stype_obj.manifest_format = 'auto'
+        stype_obj.id_pattern = ''
         stype_obj.jobs  = 16
+        stype_obj.threads = 1
+        stype_obj.min_length = 0
+        stype_obj.max_contigs = 5000
+        stype_obj.tmp_dir = ''
+        stype_obj.stream = ''
+        stype_obj.prescreen = ''
+        stype_obj.batch_size = 1
+        stype_obj.window = 1000
+        stype_obj.partial = False
+        stype_obj.merge = ''
+        stype_obj.mdu = False
+        stype_obj.runid = ''
+        stype_obj.resume = False
+        stype_obj.cgmlst_store = ''
+        stype_obj.outdir = ''
         stype_obj.logger = logging.getLogger(__name__)
-        T = collections.namedtuple('T', ['run_type', 'input', 'prefix', 'jobs'])
-        input_data = T('batch', stype_obj.contigs, stype_obj.prefix, stype_obj.jobs)
-        assert stype_obj.setup() == input_data
+        T = collections.namedtuple('T', ['run_type', 'input', 'prefix', 'jobs', 'threads', 'samples', 'tmp_dir', 'stream', 'batch_size', 'outdir', 'window', 'manifest_format', 'partial', 'merge', 'priority', 'runid', 'journal', 'cgmlst'])
+        input_data = T('batch', stype_obj.contigs, stype_obj.prefix, stype_obj.jobs, stype_obj.threads, [], '', '', 1, '', 1000, 'tsv', False, '', {}, '', None, '')
+        # the journal of the run is tested in test_journal_resume
+        with patch.object(SetupTyping, "_journal", lambda x, running_type: None):
+            assert stype_obj.setup() == input_data
  
 def test_setup_fail():
     with patch.object(SetupTyping, "__init__", lambda x: None):
         stype_obj = SetupTyping()
         stype_obj.contigs = f"{test_folder / 'batch_fail.txt'}"
         stype_obj.prefix = ''
+        stype_obj.manifest_format = 'auto'
+        stype_obj.id_pattern = ''
         stype_obj.jobs  = 16
+        stype_obj.threads = 1
+        stype_obj.min_length = 0
+        stype_obj.max_contigs = 5000
+        stype_obj.tmp_dir = ''
+        stype_obj.stream = ''
+        stype_obj.prescreen = ''
+        stype_obj.batch_size = 1
+        stype_obj.window = 1000
+        stype_obj.partial = False
+        stype_obj.merge = ''
+        stype_obj.mdu = False
+        stype_obj.runid = ''
+        stype_obj.resume = False
+        stype_obj.cgmlst_store = ''
+        stype_obj.outdir = ''
         stype_obj.logger = logging.getLogger(__name__)
-        T = collections.namedtuple('T', ['run_type', 'input', 'prefix', 'jobs'])
-        input_data = T('batch', stype_obj.contigs, stype_obj.prefix, stype_obj.jobs)
+        T = collections.namedtuple('T', ['run_type', 'input', 'prefix', 'jobs', 'threads', 'samples', 'tmp_dir', 'stream', 'batch_size', 'outdir', 'window', 'manifest_format', 'partial', 'merge', 'priority', 'runid', 'journal', 'cgmlst'])
+        input_data = T('batch', stype_obj.contigs, stype_obj.prefix, stype_obj.jobs, stype_obj.threads, [], '', '', 1, '', 1000, 'tsv', False, '', {}, '', None, '')
         with pytest.raises(SystemExit):
             stype_obj.setup()
 
@@ -150,35 +214,749 @@ def test_setup_fail():
 
 # test RunTyping
 
-Data = collections.namedtuple('Data', ['run_type', 'input', 'prefix', 'jobs'])
-def test_batch_cmd():
+Data = collections.namedtuple('Data', ['run_type', 'input', 'prefix', 'jobs', 'threads', 'samples', 'tmp_dir', 'stream', 'batch_size', 'outdir', 'window', 'manifest_format', 'partial', 'merge', 'priority', 'runid', 'journal', 'cgmlst'])
+def test_batch_order(tmp_path):
     """
-    assert True when non-empty string is given
+    assert largest assemblies are dispatched first
     """
     with patch.object(RunTyping, "__init__", lambda x: None):
-        
-        args = Data("batch", 'tests/batch.txt', '', 9)
+        small = tmp_path / "small.fa"
+        small.write_text(">small\nACGT\n")
+        large = tmp_path / "large.fa"
+        large.write_text(">large\n" + "ACGT" * 100 + "\n")
+        batch = tmp_path / "batch.txt"
+        batch.write_text(f"small\t{small}\nlarge\t{large}\n")
+        args = Data("batch", f"{batch}", '', 2, 1, [('small', f"{small}"), ('large', f"{large}")], '', '', 1, '', 1000, 'tsv', False, '', {}, '', None, '')
         stype_obj = RunTyping()
         stype_obj.run_type = args.run_type
         stype_obj.prefix = args.prefix
         stype_obj.jobs = args.jobs
+        stype_obj.threads = args.threads
         stype_obj.input = args.input
-        cmd = f"parallel -j {args.jobs} --colsep '\\t' 'tmp_dir=$(mktemp -d -t sistr-XXXXXXXXXX) && mkdir -p {{1}} && sistr -i {{2}} {{1}} -f csv -o {{1}}/sistr.csv --tmp-dir $tmp_dir --threads 1 -m && rm -r $tmp_dir' :::: {args.input}"
-        stype_obj.logger = logging.getLogger(__name__)
-        assert stype_obj._batch_cmd() == cmd
+        stype_obj.samples = args.samples
+        stype_obj.priority = args.priority
+        assert stype_obj._batch_order() == [('large', f"{large}"), ('small', f"{small}")]
+
+def test_sample_cmd():
+    """
+    assert the threads per job are passed to sistr
+    """
+    with patch.object(RunTyping, "__init__", lambda x: None):
+        args = Data("batch", 'tests/batch.txt', '', 9, 2, [], '', '', 1, '', 1000, 'tsv', False, '', {}, '', None, '')
+        stype_obj = RunTyping()
+        stype_obj.jobs = args.jobs
+        stype_obj.threads = args.threads
+        stype_obj.tmp_dir = args.tmp_dir
+        stype_obj.cgmlst = ''
+        cmd = f"tmp_dir=$(mktemp -d -t sistr-XXXXXXXXXX) && trap 'rm -rf \"$tmp_dir\"' EXIT && mkdir -p tests && sistr -i tests/contigs.fa tests -f csv -o tests/.sistr.csv.tmp --threads {args.threads} --tmp-dir \"$tmp_dir\" -m && mv tests/.sistr.csv.tmp tests/sistr.csv"
+        assert stype_obj._sample_cmd('tests', 'tests/contigs.fa') == cmd
 
 def test_single_cmd():
     """
     assert True when non-empty string is given
     """
     with patch.object(RunTyping, "__init__", lambda x: None):
-        args = Data("batch", 'tests/contigs.fa', 'somename', 9)
+        args = Data("batch", 'tests/contigs.fa', 'somename', 1, 9, [], '', '', 1, '', 1000, 'tsv', False, '', {}, '', None, '')
         stype_obj = RunTyping()
         stype_obj.run_type = args.run_type
         stype_obj.prefix = args.prefix
         stype_obj.jobs = args.jobs
+        stype_obj.threads = args.threads
         stype_obj.input = args.input
-        cmd = f"tmp_dir=$(mktemp -d -t sistr-XXXXXXXXXX) && mkdir -p {args.prefix} && sistr -i {args.input} {args.prefix} -f csv -o {args.prefix}/sistr.csv --threads {args.jobs} --tmp-dir $tmp_dir -m && rm -r $tmp_dir"
+        stype_obj.tmp_dir = args.tmp_dir
+        stype_obj.cgmlst = ''
+        cmd = f"tmp_dir=$(mktemp -d -t sistr-XXXXXXXXXX) && trap 'rm -rf \"$tmp_dir\"' EXIT && mkdir -p {args.prefix} && sistr -i {args.input} {args.prefix} -f csv -o {args.prefix}/.sistr.csv.tmp --threads {args.threads} --tmp-dir \"$tmp_dir\" -m && mv {args.prefix}/.sistr.csv.tmp {args.prefix}/sistr.csv"
         stype_obj.logger = logging.getLogger()
         assert stype_obj._single_cmd() == cmd
 
+def test_sample_cmd_compressed(tmp_path):
+    """
+    assert a compressed assembly is streamed into the job temporary directory
+    """
+    with patch.object(RunTyping, "__init__", lambda x: None):
+        contigs = tmp_path / "contigs.fa.gz"
+        with gzip.open(contigs, 'wt') as f:
+            f.write((test_folder / "contigs.fa").read_text())
+        stype_obj = RunTyping()
+        stype_obj.threads = 1
+        stype_obj.tmp_dir = '/dev/shm'
+        stype_obj.cgmlst = ''
+        cmd = f"tmp_dir=$(mktemp -d -p /dev/shm sistr-XXXXXXXXXX) && trap 'rm -rf \"$tmp_dir\"' EXIT && mkdir -p tests && gzip -dc {contigs} > \"$tmp_dir\"/contigs.fa && sistr -i \"$tmp_dir\"/contigs.fa tests -f csv -o tests/.sistr.csv.tmp --threads 1 --tmp-dir \"$tmp_dir\" -m && mv tests/.sistr.csv.tmp tests/sistr.csv"
+        assert stype_obj._sample_cmd('tests', contigs) == cmd
+
+def test_sample_cmd_failure_cleanup(tmp_path):
+    """
+    assert the job temporary directory is removed when sistr fails
+    """
+    with patch.object(RunTyping, "__init__", lambda x: None):
+        bin_dir = tmp_path / "bin"
+        bin_dir.mkdir()
+        (bin_dir / "sistr").write_text("#!/bin/sh\nexit 3\n")
+        (bin_dir / "sistr").chmod(0o755)
+        tmp_dir = tmp_path / "tmp"
+        tmp_dir.mkdir()
+        stype_obj = RunTyping()
+        stype_obj.threads = 1
+        stype_obj.tmp_dir = f"{tmp_dir}"
+        stype_obj.cgmlst = ''
+        cmd = stype_obj._sample_cmd('s1', test_folder / "contigs.fa", stream = True)
+        env = dict(os.environ, PATH = f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+        p = subprocess.run(cmd, shell = True, capture_output = True, encoding = "utf-8", env = env)
+        assert p.returncode == 3
+        assert list(tmp_dir.iterdir()) == []
+
+def test_sample_cmd_quoted(tmp_path):
+    """
+    assert sample IDs and paths with spaces or shell characters reach sistr unchanged
+    """
+    with patch.object(RunTyping, "__init__", lambda x: None):
+        bin_dir = tmp_path / "bin"
+        bin_dir.mkdir()
+        (bin_dir / "sistr").write_text(f"#!{sys.executable}\nimport sys, pathlib\nargs = sys.argv[1:]\npathlib.Path(args[args.index('-o') + 1]).write_text('\\n'.join(args))\n")
+        (bin_dir / "sistr").chmod(0o755)
+        asm_dir = tmp_path / "asm dir"
+        asm_dir.mkdir()
+        contigs = asm_dir / "a b.fa.gz"
+        with gzip.open(contigs, 'wt') as f:
+            f.write(">c\nACGT\n")
+        stype_obj = RunTyping()
+        stype_obj.threads = 1
+        stype_obj.tmp_dir = f"{tmp_path / 'tmp dir'}"
+        (tmp_path / 'tmp dir').mkdir()
+        stype_obj.cgmlst = ''
+        seqid = "s 1; touch pwned"
+        env = dict(os.environ, PATH = f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+        for cmd in [stype_obj._sample_cmd(seqid, asm_dir / "a b.fa.gz"), stype_obj._sample_cmd(seqid, test_folder / "contigs.fa")]:
+            p = subprocess.run(cmd, shell = True, capture_output = True, encoding = "utf-8", env = env, cwd = tmp_path)
+            assert p.returncode == 0, p.stderr
+            args = (tmp_path / seqid / "sistr.csv").read_text().split('\n')
+            assert args[args.index('-i') + 2] == seqid
+        assert args[args.index('-i') + 1] == f"{test_folder / 'contigs.fa'}"
+        assert not (tmp_path / "pwned").exists()
+        assert list((tmp_path / 'tmp dir').iterdir()) == []
+
+def test_check_run_type_compressed(tmp_path):
+    """
+    assert a compressed contigs file is recorded as assembly
+    """
+    with patch.object(SetupTyping, "__init__", lambda x: None):
+        contigs = tmp_path / "contigs.fa.gz"
+        with gzip.open(contigs, 'wt') as f:
+            f.write((test_folder / "contigs.fa").read_text())
+        stype_obj = SetupTyping()
+        stype_obj.contigs = f"{contigs}"
+        stype_obj.prefix = 'somename'
+        stype_obj.manifest_format = 'auto'
+        stype_obj.id_pattern = ''
+        assert stype_obj._get_input_shape() == 'assembly'
+
+def test_plan_parallelism_memory_bound():
+    """
+    assert jobs are limited by memory and spare cores become threads
+    """
+    assert resources.plan_parallelism(100, cores = 16, memory = 8 * resources.SISTR_MEMORY) == (8, 2)
+
+def test_plan_parallelism_few_samples():
+    """
+    assert a small batch gets more threads per job
+    """
+    assert resources.plan_parallelism(2, cores = 16, memory = 64 * resources.SISTR_MEMORY) == (2, 8)
+
+def test_plan_parallelism_user_jobs():
+    """
+    assert user supplied values are respected
+    """
+    assert resources.plan_parallelism(100, jobs = 3, threads = 5, cores = 16, memory = 64 * resources.SISTR_MEMORY) == (3, 5)
+
+# test verify
+
+def test_verify_concordant(tmp_path):
+    """
+    assert panel samples typed from cached sistr results are concordant
+    """
+    with patch.object(VerifySistr, "__init__", lambda x: None):
+        panel = pandas.read_csv(PANEL, dtype = str)
+        panel = panel[panel['DummyID'].isin(['2999-99918', '2999-99902', '2999-99928', '2999-99936'])]
+        panel_file = tmp_path / "panel.csv"
+        panel.to_csv(panel_file, index = False)
+        stype_obj = VerifySistr()
+        stype_obj.cache = f"{test_folder / 'verify_sistr.csv'}"
+        stype_obj.panel = f"{panel_file}"
+        stype_obj.outfile = f"{tmp_path / 'report.csv'}"
+        stype_obj._load_rules()
+        report = stype_obj.verify()
+        assert report['CONCORDANT'].all()
+        assert report.set_index('DummyID').loc['2999-99928', 'serovar'] == 'Sophia'
+
+def test_verify_discordant(tmp_path):
+    """
+    assert a missing or wrong call is reported as discordant
+    """
+    with patch.object(VerifySistr, "__init__", lambda x: None):
+        panel_file = tmp_path / "panel.csv"
+        panel_file.write_text("DummyID,Genoserotype,PTP_source,phenoserotype,subspecies,EdgeCases\n2999-99918,Enteritidis,,Enteritidis,,\n2999-99901,Mississippi,,Mississippi,,\n")
+        stype_obj = VerifySistr()
+        stype_obj.cache = f"{test_folder / 'verify_sistr.csv'}"
+        stype_obj.panel = f"{panel_file}"
+        stype_obj.outfile = f"{tmp_path / 'report.csv'}"
+        stype_obj._load_rules()
+        with pytest.raises(SystemExit):
+            stype_obj.verify()
+        report = pandas.read_csv(tmp_path / 'report.csv')
+        assert not report['CONCORDANT'].any()
+
+# test replay
+
+def test_replay_changed_rows(tmp_path):
+    """
+    assert only rows whose call changes between rule sets are reported
+    """
+    new_rules = tmp_path / "rules.py"
+    new_rules.write_text((test_folder.parent / 'styping' / 'utils' / 'rules.py').read_text().replace('cgmlst_matching_alleles >= 300', 'cgmlst_matching_alleles >= 331'))
+    R = collections.namedtuple('R', ['sistr', 'old_rules', 'old_filters', 'new_rules', 'new_filters', 'jobs', 'chunksize', 'outfile', 'summary'])
+    args = R([f"{test_folder / 'verify_sistr.csv'}"], '', '', f"{new_rules}", '', 2, 2, f"{tmp_path / 'changes.csv'}", f"{tmp_path / 'summary.csv'}")
+    summary = ReplaySistr(args).replay()
+    changes = pandas.read_csv(args.outfile)
+    assert changes['genome'].tolist() == ['2999-99918', '2999-99902']
+    assert changes['STATUS_OLD'].tolist() == ['PASS', 'REVIEW, INCONSISTENT']
+    assert summary['samples'].sum() == 4
+
+def test_replay_same_rules(tmp_path):
+    """
+    assert no rows are reported when the rule sets are the same
+    """
+    R = collections.namedtuple('R', ['sistr', 'old_rules', 'old_filters', 'new_rules', 'new_filters', 'jobs', 'chunksize', 'outfile', 'summary'])
+    args = R([f"{test_folder / 'verify_sistr.csv'}"], '', '', '', '', 1, 3, f"{tmp_path / 'changes.csv'}", f"{tmp_path / 'summary.csv'}")
+    ReplaySistr(args).replay()
+    assert pandas.read_csv(args.outfile).empty
+
+# test logging
+
+def test_setup_logging(tmp_path):
+    """
+    assert records reach the run log through the queue and debug is off by default
+    """
+    from styping.CustomLog import setup_logging, stop_logging
+    logfile = tmp_path / "run.log"
+    setup_logging(f"{logfile}")
+    logger = logging.getLogger('styping.Typing')
+    logger.info("typing started")
+    logger.debug("sample1 : running sistr")
+    stop_logging()
+    text = logfile.read_text()
+    assert "typing started" in text
+    assert "sample1" not in text
+
+def test_setup_logging_debug(tmp_path):
+    """
+    assert per-sample debug records are written when asked for
+    """
+    from styping.CustomLog import setup_logging, stop_logging
+    logfile = tmp_path / "run.log"
+    setup_logging(f"{logfile}", debug = True)
+    logging.getLogger('styping.Typing').debug("sample1 : running sistr")
+    stop_logging()
+    assert "sample1" in logfile.read_text()
+
+def test_replay_worker_logging(tmp_path):
+    """
+    assert the records of replay worker processes reach the run log when debug is on
+    """
+    from styping.CustomLog import setup_logging, stop_logging
+    logfile = tmp_path / "run.log"
+    setup_logging(f"{logfile}", debug = True)
+    R = collections.namedtuple('R', ['sistr', 'old_rules', 'old_filters', 'new_rules', 'new_filters', 'jobs', 'chunksize', 'outfile', 'summary'])
+    args = R([f"{test_folder / 'verify_sistr.csv'}"], '', '', '', '', 2, 2, f"{tmp_path / 'changes.csv'}", f"{tmp_path / 'summary.csv'}")
+    ReplaySistr(args).replay()
+    stop_logging()
+    assert "Applying rules" in logfile.read_text()
+
+# test watch
+
+def test_sample_id():
+    """
+    assert the sample ID is the file name without FASTA and compression suffixes
+    """
+    from styping.Typing import sample_id
+    assert sample_id("/x/2021-12345.fa") == "2021-12345"
+    assert sample_id("2021-12345.contigs.fasta.gz") == "2021-12345.contigs"
+    assert sample_id("2021-12345.fna.zst") == "2021-12345"
+    assert sample_id("2021-12345.txt") is None
+
+def _watcher(tmp_path, outfile, settle = 0, interval = 0):
+    from styping.Typing import WatchTyping
+    from styping.Parse import WatchSistr
+    Data = collections.namedtuple('Data', ['watch', 'outfile', 'interval', 'settle', 'once', 'jobs', 'threads', 'min_length', 'max_contigs', 'tmp_dir'])
+    data = Data(f"{tmp_path / 'incoming'}", f"{outfile}", interval, settle, True, 2, 1, 1, 5000, '')
+    return WatchTyping(data, WatchSistr(data))
+
+def test_watch_scan_settle(tmp_path):
+    """
+    assert only assemblies left unchanged for settle seconds are picked up, and only once
+    """
+    import os
+    incoming = tmp_path / "incoming"
+    incoming.mkdir()
+    (incoming / "s1.fa").write_text(">c1\nACGT\n")
+    (incoming / "notes.txt").write_text("not an assembly")
+    w = _watcher(tmp_path, tmp_path / "out.csv", settle = 60)
+    mtime = os.stat(incoming / "s1.fa").st_mtime
+    assert w._scan(now = mtime + 1) == []
+    assert w._scan(now = mtime + 61) == [("s1", f"{incoming / 's1.fa'}")]
+    assert w._scan(now = mtime + 120) == []
+
+def test_watch_once(tmp_path, monkeypatch):
+    """
+    assert every assembly is typed and appended to the rolling output, and skipped on a restart
+    """
+    monkeypatch.chdir(tmp_path)
+    incoming = tmp_path / "incoming"
+    incoming.mkdir()
+    sistr = pandas.read_csv(test_folder / "verify_sistr.csv")
+    for seqid in sistr['genome']:
+        (incoming / f"{seqid}.fa").write_text((test_folder / "contigs.fa").read_text())
+    def fake_sistr(self, seqid, contigs):
+        pathlib.Path(seqid).mkdir()
+        sistr[sistr['genome'] == seqid].to_csv(f"{seqid}/sistr.csv", index = False)
+        return True
+    monkeypatch.setattr(RunTyping, "_run_sample", fake_sistr)
+    outfile = tmp_path / "out.csv"
+    typed = _watcher(tmp_path, outfile).watch_dir()
+    assert typed == set(sistr['genome'])
+    out = pandas.read_csv(outfile)
+    assert sorted(out['genome']) == sorted(sistr['genome'])
+    assert 'STATUS' in out.columns
+    # a restarted watch does not type the same samples again
+    monkeypatch.setattr(RunTyping, "_run_sample", lambda self, seqid, contigs: pytest.fail(seqid))
+    _watcher(tmp_path, outfile).watch_dir()
+    assert len(pandas.read_csv(outfile)) == len(sistr)
+
+def test_watch_once_unsettled(tmp_path, monkeypatch):
+    """
+    assert a single pass waits for assemblies still being written instead of skipping them
+    """
+    monkeypatch.chdir(tmp_path)
+    incoming = tmp_path / "incoming"
+    incoming.mkdir()
+    sistr = pandas.read_csv(test_folder / "verify_sistr.csv")
+    seqid = sistr['genome'][0]
+    (incoming / f"{seqid}.fa").write_text((test_folder / "contigs.fa").read_text())
+    def fake_sistr(self, seqid, contigs):
+        pathlib.Path(seqid).mkdir()
+        sistr[sistr['genome'] == seqid].to_csv(f"{seqid}/sistr.csv", index = False)
+        return True
+    monkeypatch.setattr(RunTyping, "_run_sample", fake_sistr)
+    typed = _watcher(tmp_path, tmp_path / "out.csv", settle = 1, interval = 0.2).watch_dir()
+    assert typed == {seqid}
+
+# test result stream
+
+def test_sample_cmd_stream():
+    """
+    assert no directory is made for a sample when results are streamed
+    """
+    with patch.object(RunTyping, "__init__", lambda x: None):
+        stype_obj = RunTyping()
+        stype_obj.threads = 2
+        stype_obj.tmp_dir = ''
+        stype_obj.cgmlst = ''
+        cmd = f"tmp_dir=$(mktemp -d -t sistr-XXXXXXXXXX) && trap 'rm -rf \"$tmp_dir\"' EXIT && sistr -i tests/contigs.fa s1 -f csv -o \"$tmp_dir\"/sistr.csv --threads 2 --tmp-dir \"$tmp_dir\" -m && cat \"$tmp_dir\"/sistr.csv"
+        assert stype_obj._sample_cmd('s1', 'tests/contigs.fa', stream = True) == cmd
+
+def test_stream_parse(tmp_path, monkeypatch):
+    """
+    assert streamed results are checked and typed as if they had been concatenated
+    """
+    import threading
+    from styping.Parse import ParseSistr
+    monkeypatch.chdir(tmp_path)
+    sistr = pandas.read_csv(test_folder / "verify_sistr.csv")
+    with patch.object(RunTyping, "__init__", lambda x: None):
+        stype_obj = RunTyping()
+        stype_obj.run_type = 'batch'
+        stype_obj.stream = f"{tmp_path / 'sistr.jsonl'}"
+        stype_obj.stream_lock = threading.Lock()
+        stype_obj.partial = False
+        stype_obj.samples = [(seqid, 'x.fa') for seqid in sistr['genome']]
+        open(stype_obj.stream, 'w').close()
+        for i in range(len(sistr)):
+            stype_obj._append_stream(sistr.iloc[[i]].to_csv(index = False))
+        assert stype_obj._check_outputs()
+        stype_obj.samples.append(('missing', 'x.fa'))
+        with pytest.raises(SystemExit):
+            stype_obj._check_outputs()
+    T = collections.namedtuple('T', ['run_type', 'input', 'prefix', 'samples', 'stream', 'outdir', 'merge'])
+    P = ParseSistr(T('batch', 'batch.txt', '', [], stype_obj.stream, '', ''))
+    P.parse()
+    streamed = pandas.read_csv("sistr_filtered.csv")
+    expected = ParseSistr(T('batch', 'batch.txt', '', [], '', '', '')).type_table(sistr)
+    assert streamed['STATUS'].tolist() == expected['STATUS'].tolist()
+    assert streamed['serovar'].tolist() == expected['serovar'].tolist()
+
+# test grouped sistr calls
+
+def _group_runner(tmp_path, stream = ''):
+    import threading
+    with patch.object(RunTyping, "__init__", lambda x: None):
+        stype_obj = RunTyping()
+    stype_obj.threads = 4
+    stype_obj.tmp_dir = ''
+    stype_obj.stream = stream
+    stype_obj.stream_lock = threading.Lock()
+    stype_obj.batch_size = 3
+    stype_obj.outdir = ''
+    stype_obj.partial = False
+    stype_obj.priority = {}
+    stype_obj.urgent = None
+    stype_obj.timings = []
+    stype_obj.journal = None
+    stype_obj.cgmlst = ''
+    return stype_obj
+
+def test_group_cmd(tmp_path):
+    """
+    assert all samples of a group are given to one sistr call
+    """
+    stype_obj = _group_runner(tmp_path)
+    contigs = tmp_path / "c.fa.gz"
+    with gzip.open(contigs, 'wt') as f:
+        f.write(">c\nACGT\n")
+    cmd = f"tmp_dir=$(mktemp -d -t sistr-XXXXXXXXXX) && trap 'rm -rf \"$tmp_dir\"' EXIT && gzip -dc {contigs} > \"$tmp_dir\"/contigs_1.fa && sistr -i tests/contigs.fa s1 -i \"$tmp_dir\"/contigs_1.fa s2 -f csv -o \"$tmp_dir\"/sistr.csv --threads 4 --tmp-dir \"$tmp_dir\" -m && cat \"$tmp_dir\"/sistr.csv"
+    assert stype_obj._group_cmd([('s1', 'tests/contigs.fa'), ('s2', contigs)]) == cmd
+
+def test_group_cmd_failure_cleanup(tmp_path):
+    """
+    assert the group temporary directory is removed when sistr fails
+    """
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "sistr").write_text("#!/bin/sh\nexit 3\n")
+    (bin_dir / "sistr").chmod(0o755)
+    tmp_dir = tmp_path / "tmp"
+    tmp_dir.mkdir()
+    stype_obj = _group_runner(tmp_path)
+    stype_obj.tmp_dir = f"{tmp_dir}"
+    cmd = stype_obj._group_cmd([('s1', 'tests/contigs.fa'), ('s2', 'tests/contigs.fa')])
+    env = dict(os.environ, PATH = f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    p = subprocess.run(cmd, shell = True, capture_output = True, encoding = "utf-8", env = env)
+    assert p.returncode == 3
+    assert list(tmp_dir.iterdir()) == []
+
+def test_run_group_split(tmp_path, monkeypatch):
+    """
+    assert the output of a group is split per sample and missing samples are retried on their own
+    """
+    import subprocess
+    monkeypatch.chdir(tmp_path)
+    sistr = pandas.read_csv(test_folder / "verify_sistr.csv", dtype = {'genome': str})
+    ids = sistr['genome'].tolist()
+    output = sistr.iloc[:2].to_csv(index = False)
+    monkeypatch.setattr("styping.Typing.subprocess.run", lambda *a, **k: subprocess.CompletedProcess(a, 0, output, ''))
+    retried = []
+    monkeypatch.setattr(RunTyping, "_run_sample", lambda self, seqid, contigs: retried.append(seqid) or True)
+    (tmp_path / 'x.fa').write_text(">c\nACGT\n")
+    stype_obj = _group_runner(tmp_path)
+    assert stype_obj._run_group([(seqid, 'x.fa') for seqid in ids[:3]]) == [True, True, True]
+    assert retried == [ids[2]]
+    for seqid in ids[:2]:
+        saved = pandas.read_csv(f"{seqid}/sistr.csv", dtype = {'genome': str})
+        assert saved['genome'].tolist() == [seqid]
+        assert saved['serovar'].tolist() == sistr[sistr['genome'] == seqid]['serovar'].tolist()
+
+def test_run_group_failed(tmp_path, monkeypatch):
+    """
+    assert every sample of a failed group is retried on its own
+    """
+    import subprocess
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr("styping.Typing.subprocess.run", lambda *a, **k: subprocess.CompletedProcess(a, 1, '', 'error'))
+    retried = []
+    monkeypatch.setattr(RunTyping, "_run_sample", lambda self, seqid, contigs: retried.append(seqid) or seqid != 's2')
+    (tmp_path / 'x.fa').write_text(">c\nACGT\n")
+    stype_obj = _group_runner(tmp_path)
+    assert stype_obj._run_group([('s1', 'x.fa'), ('s2', 'x.fa')]) == [True, False]
+    assert retried == ['s1', 's2']
+
+def test_run_batch_windows(tmp_path, monkeypatch):
+    """
+    assert samples are read lazily and dispatched largest first within each window
+    """
+    sizes = {'a': 10, 'b': 30, 'c': 20, 'd': 40, 'e': 5}
+    for seqid, size in sizes.items():
+        (tmp_path / f"{seqid}.fa").write_text(">c\n" + "A" * size + "\n")
+    order = []
+    monkeypatch.setattr(RunTyping, "_run_group", lambda self, group: order.extend(seqid for seqid, contigs in group) or [True] * len(group))
+    stype_obj = _group_runner(tmp_path)
+    stype_obj.jobs = 1
+    stype_obj.batch_size = 1
+    stype_obj.window = 2
+    stype_obj.samples = ((seqid, f"{tmp_path / seqid}.fa") for seqid in sizes)
+    assert stype_obj._run_batch()
+    assert order == ['b', 'a', 'd', 'c', 'e']
+    assert [seqid for seqid, contigs in stype_obj.samples] == order
+
+# test partial collation
+
+def test_check_outputs_partial(tmp_path, monkeypatch):
+    """
+    assert failed samples are saved as a manifest in the input format and the others kept
+    """
+    from styping.utils.manifest import Manifest
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'A').mkdir()
+    (tmp_path / 'A' / 'sistr.csv').write_text("genome\nA\n")
+    stype_obj = _group_runner(tmp_path)
+    stype_obj.run_type = 'batch'
+    stype_obj.samples = [('A', f"{tmp_path / 'a.fa'}"), ('B', f"{tmp_path / 'b.fa'}")]
+    with pytest.raises(SystemExit):
+        stype_obj._check_outputs()
+    stype_obj.partial = True
+    stype_obj.manifest_format = 'csv'
+    assert stype_obj._check_outputs()
+    assert stype_obj.samples == [('A', f"{tmp_path / 'a.fa'}")]
+    assert list(Manifest(tmp_path / 'failed_samples.csv')) == [('B', f"{tmp_path / 'b.fa'}")]
+    stype_obj.samples = [('B', f"{tmp_path / 'b.fa'}")]
+    with pytest.raises(SystemExit):
+        stype_obj._check_outputs()
+
+def test_merge_results(tmp_path):
+    """
+    assert results of a re-run replace earlier results of the same samples
+    """
+    from styping.Parse import ParseSistr
+    earlier = tmp_path / 'sistr_filtered.csv'
+    pandas.DataFrame({'genome': ['1', '2'], 'serovar': ['Typhi', 'Enteritidis'], 'STATUS': ['PASS', 'PASS']}).to_csv(earlier, index = False)
+    with patch.object(ParseSistr, "__init__", lambda x: None):
+        P = ParseSistr()
+    tab = pandas.DataFrame({'genome': [2, 3], 'serovar': ['Typhimurium', 'Agona'], 'STATUS': ['PASS', 'PASS']})
+    merged = P.merge_results(tab, earlier)
+    assert merged['genome'].tolist() == ['1', '2', '3']
+    assert merged['serovar'].tolist() == ['Typhi', 'Typhimurium', 'Agona']
+
+# test urgent samples
+
+def test_manifest_priority(tmp_path):
+    """
+    assert urgent samples are read first, highest priority first
+    """
+    from styping.utils.manifest import Manifest
+    source = tmp_path / 'input.csv'
+    source.write_text("ID,path,priority\nA,a.fa,\nB,b.fa,1\nC,c.fa,0\nD,d.fa,5\n")
+    m = Manifest(source)
+    assert [seqid for seqid, contigs in m] == ['D', 'B', 'A', 'C']
+    assert m.priorities == {'D': 5, 'B': 1}
+
+def test_run_batch_urgent(tmp_path, monkeypatch):
+    """
+    assert urgent samples are dispatched first and collated before the rest of the batch
+    """
+    for seqid, size in {'a': 10, 'b': 30, 'u': 5}.items():
+        (tmp_path / f"{seqid}.fa").write_text(">c\n" + "A" * size + "\n")
+    events = []
+    monkeypatch.setattr(RunTyping, "_run_group", lambda self, group: events.extend(seqid for seqid, contigs in group) or [True] * len(group))
+    class Urgent:
+        def record(self, samples):
+            events.append(('urgent', samples))
+    stype_obj = _group_runner(tmp_path)
+    stype_obj.jobs = 1
+    stype_obj.batch_size = 1
+    stype_obj.window = 3
+    stype_obj.priority = {'u': 1}
+    stype_obj.urgent = Urgent()
+    stype_obj.samples = iter([('u', f"{tmp_path / 'u.fa'}"), ('a', f"{tmp_path / 'a.fa'}"), ('b', f"{tmp_path / 'b.fa'}")])
+    assert stype_obj._run_batch()
+    assert events[0] == 'u'
+    assert events.count(('urgent', [('u', f"{tmp_path / 'u.fa'}")])) == 1
+    assert sorted(e for e in events if isinstance(e, str)) == ['a', 'b', 'u']
+
+def test_run_batch_urgent_last_window(tmp_path, monkeypatch):
+    """
+    assert urgent results are collated as soon as they finish, while routine samples are still typed
+    """
+    import threading
+    for seqid in 'ur':
+        (tmp_path / f"{seqid}.fa").write_text(">c\nACGT\n")
+    routine_done = threading.Event()
+    events = []
+    def fake_group(self, group):
+        if group[0][0] == 'r':
+            # the routine sample only finishes once the urgent results are saved, or after a timeout
+            routine_done.wait(5)
+            events.append('r')
+        return [True] * len(group)
+    monkeypatch.setattr(RunTyping, "_run_group", fake_group)
+    class Urgent:
+        def record(self, samples):
+            events.append('urgent')
+            routine_done.set()
+    stype_obj = _group_runner(tmp_path)
+    stype_obj.jobs = 2
+    stype_obj.batch_size = 1
+    stype_obj.window = 10
+    stype_obj.priority = {'u': 1}
+    stype_obj.urgent = Urgent()
+    stype_obj.samples = iter([('u', f"{tmp_path / 'u.fa'}"), ('r', f"{tmp_path / 'r.fa'}")])
+    assert stype_obj._run_batch()
+    assert events == ['urgent', 'r']
+
+def test_urgent_record(tmp_path):
+    """
+    assert urgent results are typed as in the collated output
+    """
+    from styping.Parse import UrgentSistr
+    sistr = pandas.read_csv(test_folder / "verify_sistr.csv")
+    samples = []
+    for i in range(2):
+        seqid = f"{sistr['genome'][i]}"
+        (tmp_path / seqid).mkdir()
+        sistr.iloc[[i]].to_csv(tmp_path / seqid / 'sistr.csv', index = False)
+        samples.append((seqid, 'x.fa'))
+    U = collections.namedtuple('U', ['stream', 'outdir'])
+    tab = UrgentSistr(U('', f"{tmp_path}")).record(samples)
+    assert pandas.read_csv(tmp_path / 'sistr_urgent.csv')['STATUS'].tolist() == tab['STATUS'].tolist()
+    assert len(tab) == 2
+
+# test planning
+
+def test_plan_timings(tmp_path):
+    """
+    assert the cost model is fitted to recorded timings and the batch planned as it is dispatched
+    """
+    import styping.utils.timings as timings
+    history = tmp_path / 'timings.csv'
+    timings.record(history, [['2024-01-01', 1, b, 1, 20 + b / 1e5] for b in (1e6, 2e6, 3e6, 4e6, 5e6)])
+    assert not timings.scales_with_threads(timings.load(history))
+    timings.record(history, [['2024-01-02', 2, 4e6, 4, 30]])
+    model = timings.fit(timings.load(history))
+    assert timings.scales_with_threads(timings.load(history))
+    assert model.points == 6
+    # the call with 4 threads shows the time per byte is shared between threads
+    assert round(model.overhead) == 20 and round(model.rate * 1e5, 3) == 0 and round(model.parallel_rate * 1e5, 3) == 1
+    assert timings.cost(model, 4e6, 4) < timings.cost(model, 4e6, 1)
+    one = timings.plan([5e6, 1e6, 1e6, 1e6, 1e6, 1e6], 1, 1, 1, 1000, model)
+    two = timings.plan([5e6, 1e6, 1e6, 1e6, 1e6, 1e6], 2, 1, 1, 1000, model)
+    grouped = timings.plan([5e6, 1e6, 1e6, 1e6, 1e6, 1e6], 2, 1, 3, 1000, model)
+    assert one.wall_h > two.wall_h > grouped.wall_h
+    assert one.core_h == two.core_h
+    assert grouped.calls == 2
+
+def test_mduify_table(tmp_path):
+    """
+    assert the typed table is used as is by stype run --mdu, without reading the concatenated file
+    """
+    from styping.Parse import MduifySistr
+    with patch.object(MduifySistr, "__init__", lambda x: None):
+        mdu_obj = MduifySistr()
+        mdu_obj.input = f"{tmp_path / 'missing.csv'}"
+        mdu_obj.runid = 'RUN1'
+        mdu_obj.outdir = f"{tmp_path}"
+        tab = pandas.DataFrame({'genome': ['2020-12345'], 'STATUS': ['PASS']})
+        with patch.object(MduifySistr, "make_spreadsheet") as sheet:
+            mdu_obj.mduify(tab = tab)
+        sheet.assert_called_once_with(tab, 'RUN1')
+
+def test_mdu_annotate():
+    """
+    assert MDU IDs and item codes are parsed and samples sorted into sheets over the whole table at once
+    """
+    from styping.Parse import MduifySistr
+    MDU = collections.namedtuple('MDU', ['runid', 'input', 'outdir'])
+    mdu_obj = MduifySistr(MDU('RUN1', '', ''))
+    tab = pandas.DataFrame({'genome': ['2020-12345-1A', '2020-123456', 'NOTANID'], 'STATUS': ['PASS', 'FAIL', 'REVIEW']})
+    tab, sheet = mdu_obj._annotate(tab)
+    assert list(tab['ID']) == ['2020-12345', '2020-123456', '']
+    assert list(tab['ITEMCODE']) == ['1A', '', '']
+    assert list(sheet) == ['MMS136', '', 'REVIEW']
+
+def test_mdu_runs(tmp_path):
+    """
+    assert runs are read from a list of run IDs and results, or from a results store, into one table
+    """
+    from styping.Typing import SetupMDU
+    from styping.Parse import MduifyRuns
+    (tmp_path / 'RUN1').mkdir()
+    pandas.DataFrame({'genome': ['2020-12345'], 'STATUS': ['PASS']}).to_csv(tmp_path / 'RUN1' / 'sistr_filtered.csv', index = False)
+    pandas.DataFrame({'genome': ['2020-54321'], 'STATUS': ['FAIL']}).to_csv(tmp_path / 'run2.csv', index = False)
+    (tmp_path / 'runs.tab').write_text(f"runid\tresults\nRUN1\t{tmp_path / 'RUN1'}\nRUN2\t{tmp_path / 'run2.csv'}\n")
+    pandas.DataFrame({'runid': ['RUN1', 'RUN2'], 'genome': ['2020-12345', '2020-54321'], 'STATUS': ['PASS', 'FAIL']}).to_csv(tmp_path / 'store.csv', index = False)
+    Runs = collections.namedtuple('Runs', ['runid', 'input', 'outdir', 'runs', 'jobs'])
+    with patch.object(SetupMDU, "__init__", lambda x: None):
+        setup_obj = SetupMDU()
+        setup_obj.runs = f"{tmp_path / 'runs.tab'}"
+        runs = setup_obj._runs()
+        assert [runid for runid, results in runs] == ['RUN1', 'RUN2']
+        from_list = MduifyRuns(Runs('', '', '', runs, 1))._read()
+        setup_obj.runs = f"{tmp_path / 'store.csv'}"
+        from_store = MduifyRuns(Runs('', '', '', setup_obj._runs(), 1))._read()
+        for tab in [from_list, from_store]:
+            assert sorted(zip(tab['runid'], tab['genome'])) == [('RUN1', '2020-12345'), ('RUN2', '2020-54321')]
+        (tmp_path / 'runs.tab').write_text(f"RUN1\t{tmp_path / 'RUN1'}\nRUN1\t{tmp_path / 'run2.csv'}\n")
+        setup_obj.runs = f"{tmp_path / 'runs.tab'}"
+        with pytest.raises(SystemExit):
+            setup_obj._runs()
+
+def test_mdu_setup_run_directory(tmp_path):
+    """
+    assert the results of a single run can be given as its run directory
+    """
+    from styping.Typing import SetupMDU
+    run = tmp_path / 'stype_20240101_120000_1'
+    run.mkdir()
+    pandas.DataFrame({'genome': ['2020-12345'], 'STATUS': ['PASS']}).to_csv(run / 'sistr_filtered.csv', index = False)
+    with patch.object(SetupMDU, "__init__", lambda x: None):
+        setup_obj = SetupMDU()
+        setup_obj.runid = 'RUN1'
+        setup_obj.input = f"{run}"
+        setup_obj.runs = ''
+        setup_obj.outdir = f"{tmp_path / 'reports'}"
+        assert setup_obj.setup().input == f"{(run / 'sistr_filtered.csv').resolve()}"
+        setup_obj.input = ''
+        with pytest.raises(SystemExit):
+            setup_obj.setup()
+
+def test_run_batch_resume(tmp_path, monkeypatch):
+    """
+    assert samples typed by an interrupted run are not typed again when it is resumed
+    """
+    from styping.utils.journal import Journal
+    for seqid in 'abc':
+        (tmp_path / f"{seqid}.fa").write_text(">c\nACGT\n")
+        (tmp_path / seqid).mkdir()
+        (tmp_path / seqid / 'sistr.csv').write_text(f"genome\n{seqid}\n")
+    samples = [(seqid, f"{tmp_path / seqid}.fa") for seqid in 'abc']
+    stype_obj = _group_runner(tmp_path)
+    stype_obj.outdir = f"{tmp_path}"
+    stype_obj.journal = Journal(tmp_path / 'stype_journal.jsonl')
+    for seqid, contigs in samples[:2]:
+        stype_obj._record_sample(seqid, contigs)
+    (tmp_path / 'b' / 'sistr.csv').write_text("genome\nchanged\n")
+    order = []
+    monkeypatch.setattr(RunTyping, "_run_group", lambda self, group: order.extend(seqid for seqid, contigs in group) or [True] * len(group))
+    stype_obj.journal = Journal(tmp_path / 'stype_journal.jsonl', resume = True)
+    stype_obj.jobs = 1
+    stype_obj.batch_size = 1
+    stype_obj.window = 10
+    stype_obj.samples = iter(samples)
+    assert stype_obj._run_batch()
+    assert sorted(order) == ['b', 'c']
+    assert sorted(seqid for seqid, contigs in stype_obj.samples) == ['a', 'b', 'c']
+
+def test_store_profiles(tmp_path):
+    """
+    assert the cgMLST profiles of the samples typed are kept by sistr and added to the store, and can be queried
+    """
+    from styping.Parse import QueryCgmlst
+    stype_obj = _group_runner(tmp_path)
+    stype_obj.cgmlst = f"{tmp_path / 'store'}"
+    cmd = stype_obj._group_cmd([('s1', 'tests/contigs.fa'), ('s2', 'tests/contigs.fa')])
+    assert "--cgmlst-profiles \"$tmp_dir\"/cgmlst.csv && cat \"$tmp_dir\"/sistr.csv && mv \"$tmp_dir\"/cgmlst.csv cgmlst_profiles/\"$(basename \"$tmp_dir\")\".csv" in cmd
+    stype_obj.outdir = f"{tmp_path}"
+    stype_obj.samples = [('s1', ''), ('s2', ''), ('s3', '')]
+    (tmp_path / 'cgmlst_profiles').mkdir()
+    (tmp_path / 'cgmlst_profiles' / 'sistr-1.csv').write_text(",l1,l2,l3\ns1,1,2,3\ns2,1,2,4\nfailed,1,1,1\n")
+    (tmp_path / 'cgmlst_profiles' / 'sistr-2.csv').write_text(",l1,l2,l3\ns3,5,2,\n")
+    stype_obj._store_profiles()
+    Query = collections.namedtuple('Query', ['store', 'queries', 'samples', 'k', 'max_distance', 'pairwise', 'jobs', 'outfile'])
+    tab = QueryCgmlst(Query(stype_obj.cgmlst, None, ['s1'], 2, None, f"{tmp_path / 'pairwise.csv'}", 1, f"{tmp_path / 'neighbours.csv'}")).query()
+    assert list(zip(tab['NEIGHBOUR'], tab['DISTANCE'], tab['SHARED_LOCI'])) == [('s2', 1, 3), ('s3', 1, 2)]
+    assert pandas.read_csv(tmp_path / 'pairwise.csv', index_col = 0).loc['s1', 's1'] == 0